@@ -31,23 +31,34 @@ functionality for particular pipeline commands.
 of long log messages, while
 :class:`LoggingFilterRabbitMQ` intercepts ruffus log
 messages and sends event information to a rabbitMQ message exchange
-for task process monitoring.
+for task process monitoring. Messages are sent from a background
+thread by :class:`AsyncPublisher` to a sink such as
+:class:`RabbitMQSink` or :class:`FileSink`.
+
+:class:`FileStateCache` scans the working directory once and
+serves the file checks that ruffus performs to determine which tasks
+are up-to-date from memory.
 
 Reference
 ---------
 
 """
 
+import collections
+import errno
 import inspect
 import json
 import logging
 import os
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import Queue
 from cStringIO import StringIO
 from multiprocessing.pool import ThreadPool
 
@@ -69,7 +80,7 @@ except RuntimeError:
     HAS_DRMAA = False
 
 from ruffus import pipeline_printout_graph, pipeline_printout, \
-    pipeline_run, ruffus_exceptions, task
+    pipeline_run, ruffus_exceptions, task, file_name_parameters
 
 
 import CGAT.Experiment as E
@@ -80,6 +91,7 @@ from CGATPipelines.Pipeline.Utils import isTest, getCaller, getCallerLocals
 from CGATPipelines.Pipeline.Execution import execute, startSession,\
     closeSession
 from CGATPipelines.Pipeline.Local import getProjectName, getPipelineName
+from CGATPipelines.Pipeline.Files import cleanupTempPaths
 
 # Set from Pipeline.py
 PARAMS = {}
@@ -376,6 +388,201 @@ def peekParameters(workingdir,
     return dump
 
 
+def _scanDirectory(dirname):
+    '''stat all entries in `dirname`.
+
+    Returns a tuple of the directory name, a dictionary mapping
+    entries to their stat result (None if the stat failed, for
+    example for dangling links) and a list of sub-directories to
+    descend into. Symbolic links to directories are not followed.
+    '''
+    entries, subdirs = {}, []
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return dirname, None, subdirs
+
+    for name in names:
+        path = os.path.join(dirname, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        entries[name] = st
+        if st is not None and stat.S_ISDIR(st.st_mode) and \
+           not os.path.islink(path):
+            subdirs.append(path)
+    return dirname, entries, subdirs
+
+
+class FileStateCache(object):
+    '''cache of file states used by ruffus to check if tasks are
+    up-to-date.
+
+    On :meth:`sweep`, the directory tree below `workingdir` is scanned
+    once with a pool of threads and the stat results of all files are
+    recorded. Subsequent lookups of files within the tree are served
+    from memory, including lookups of files that do not exist. Files
+    outside the tree are stat-ed on demand and then memoised.
+
+    The cache is installed into ruffus with :meth:`install`. Only the
+    file checks performed by ruffus to determine the up-to-date state
+    are served from the cache, all other code sees the file system
+    directly.
+
+    The cache is emptied after every job that ruffus runs, as the job
+    might have created or modified files. After that, file states are
+    memoised on demand. This requires that jobs run in threads of the
+    pipeline process (see :meth:`install`).
+
+    Arguments
+    ---------
+    workingdir : string
+        Root of directory tree to scan.
+    threads : int
+        Number of threads to use for scanning.
+
+    '''
+
+    def __init__(self, workingdir=None, threads=10):
+        if workingdir is None:
+            workingdir = os.getcwd()
+        self.workingdir = os.path.abspath(workingdir)
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.directories = {}
+        self.files = {}
+        # incremented whenever the cache is emptied
+        self.generation = 0
+        self.installed = []
+
+    def sweep(self):
+        '''scan directory tree below working directory.'''
+        pool = ThreadPool(self.threads)
+        todo = [self.workingdir]
+        ndirs, nfiles = 0, 0
+        try:
+            while todo:
+                subdirs = []
+                for dirname, entries, s in pool.map(_scanDirectory, todo):
+                    if entries is None:
+                        continue
+                    self.directories[dirname] = entries
+                    ndirs += 1
+                    nfiles += len(entries)
+                    subdirs.extend(s)
+                todo = subdirs
+        finally:
+            pool.close()
+            pool.join()
+        E.info("file state cache: %i files in %i directories" %
+               (nfiles, ndirs))
+
+    def clear(self):
+        '''empty the cache.'''
+        with self.lock:
+            self.directories = {}
+            self.files = {}
+            self.generation += 1
+
+    def stat(self, path):
+        '''return stat result for `path` or None if it does not exist.'''
+        path = os.path.abspath(path)
+        dirname, basename = os.path.split(path)
+        with self.lock:
+            entries = self.directories.get(dirname, None)
+            if entries is not None:
+                return entries.get(basename, None)
+            if path in self.files:
+                return self.files[path]
+            generation = self.generation
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        with self.lock:
+            # do not memoise if a job has finished in the meantime
+            if generation == self.generation:
+                self.files[path] = st
+        return st
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def getmtime(self, path):
+        st = self.stat(path)
+        if st is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return st.st_mtime
+
+    @staticmethod
+    def canClearAfterJobs():
+        '''return True if the cache can be emptied after each job.'''
+        return hasattr(task, "run_pooled_job_without_exceptions")
+
+    def install(self, clear_after_jobs=True):
+        '''serve up-to-date checks in ruffus from this cache.
+
+        If `clear_after_jobs` is set, the function ruffus uses to
+        run each job is wrapped so that the cache is emptied once
+        the job has finished. This only has an effect if jobs run
+        in threads of this process, for example if ``task.Pool`` is
+        a ThreadPool. Without it, the cache must only be used if no
+        jobs are run.
+        '''
+        # ruffus checks file existence and modification times
+        # through the os module imported in file_name_parameters
+        for module in (file_name_parameters,):
+            self.installed.append((module, "os", module.os))
+            module.os = _CachedOs(self)
+
+        if clear_after_jobs:
+            if not self.canClearAfterJobs():
+                raise ValueError(
+                    "can not clear file state cache after jobs with "
+                    "this version of ruffus")
+            run_job = task.run_pooled_job_without_exceptions
+
+            def runJobAndClear(*args, **kwargs):
+                try:
+                    return run_job(*args, **kwargs)
+                finally:
+                    self.clear()
+
+            self.installed.append(
+                (task, "run_pooled_job_without_exceptions", run_job))
+            task.run_pooled_job_without_exceptions = runJobAndClear
+
+    def uninstall(self):
+        '''restore direct file system access in ruffus.'''
+        while self.installed:
+            module, name, original = self.installed.pop()
+            setattr(module, name, original)
+
+
+class _CachedOsPath(object):
+    '''proxy for :mod:`os.path` serving file checks from a
+    :class:`FileStateCache`.'''
+
+    def __init__(self, cache):
+        self.exists = cache.exists
+        self.getmtime = cache.getmtime
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
+
+
+class _CachedOs(object):
+    '''proxy for :mod:`os` serving file checks from a
+    :class:`FileStateCache`.'''
+
+    def __init__(self, cache):
+        self.path = _CachedOsPath(cache)
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
 class MultiLineFormatter(logging.Formatter):
     """add identation for multi-line entries.
     """
@@ -388,6 +595,229 @@ class MultiLineFormatter(logging.Formatter):
         return s
 
 
+RX_JOB_NAME = re.compile("\[.*-> ([^\]]+)\]")
+RX_TASK_NAME = re.compile("Task = (.*)")
+
+
+def splitPrintoutByJob(lines):
+    '''split a block of ruffus printout lines into jobs.
+
+    Yields tuples of ``(job_name, job_status, job_message)``.
+    '''
+    text = "".join(lines)
+    job_message = ""
+    # ignore first entry which is the docstring
+    for line in text.split(" Job  = ")[1:]:
+        try:
+            # long file names cause additional wrapping and
+            # additional white-space characters
+            job_name = RX_JOB_NAME.search(line).groups()
+        except AttributeError:
+            raise AttributeError("could not parse '%s'" % line)
+        job_status = "ignore"
+        if "Job needs update" in line:
+            job_status = "update"
+
+        yield job_name, job_status, job_message
+
+
+def splitPrintoutByTask(text):
+    '''split the output of ruffus.pipeline_printout into tasks.
+
+    Yields tuples of ``(task_name, task_status, jobs)``.
+    '''
+    block, task_name = [], None
+    task_status = None
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("Tasks which will be run"):
+            task_status = "update"
+        elif line.startswith("Tasks which are up-to-date"):
+            task_status = "ignore"
+
+        if line.startswith("Task = "):
+            if task_name:
+                yield task_name, task_status, list(
+                    splitPrintoutByJob(block))
+            block = []
+            task_name = RX_TASK_NAME.match(line).groups()[0]
+            continue
+        block.append(line)
+
+    if task_name:
+        yield task_name, task_status, list(splitPrintoutByJob(block))
+
+
+class RabbitMQSink(object):
+    '''send messages to a topic exchange on a RabbitMQ server.
+
+    The connection is opened lazily by the first call to
+    :meth:`publish` so that it is owned by the thread that is
+    publishing.
+
+    Arguments
+    ---------
+    host : string
+        RabbitMQ host name
+    exchange : string
+        RabbitMQ exchange name
+    '''
+
+    def __init__(self, host="localhost", exchange="ruffus_pipelines"):
+        self.host = host
+        self.exchange = exchange
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        '''open connection. Returns False if the server can not
+        be reached.'''
+        if not HAS_PIKA:
+            return False
+        try:
+            self.connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=self.host))
+        except pika.exceptions.AMQPConnectionError:
+            return False
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=self.exchange,
+            type='topic')
+        return True
+
+    def publish(self, messages):
+        '''publish a list of (key, body) tuples.'''
+        if self.channel is None:
+            if not self.connect():
+                raise IOError("could not connect to RabbitMQ host %s" %
+                              self.host)
+        for key, body in messages:
+            self.channel.basic_publish(exchange=self.exchange,
+                                       routing_key=key,
+                                       body=body)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = self.channel = None
+
+
+class FileSink(object):
+    '''append messages to a local file.
+
+    Each message is written as a line with the routing key and the
+    message body separated by a tab. This sink is useful as a stand-in
+    for a message broker, for example in tests.
+
+    Arguments
+    ---------
+    filename : string
+        Filename to append messages to.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def publish(self, messages):
+        with open(self.filename, "a") as outf:
+            for key, body in messages:
+                outf.write("%s\t%s\n" % (key, body))
+
+    def close(self):
+        pass
+
+
+class AsyncPublisher(object):
+    '''publish messages to a sink from a background thread.
+
+    Messages are put into a bounded queue and never block the
+    caller. If the queue is full, the message is dropped and counted.
+
+    The background thread collects messages for `flush_interval`
+    seconds. Messages with the same key are coalesced so that only
+    the latest message for a key is sent. The collected messages are
+    then passed to the sink in a single batch.
+
+    Arguments
+    ---------
+    sink : object
+        Object with a ``publish`` method accepting a list of
+        (key, body) tuples and a ``close`` method.
+    queue_size : int
+        Maximum number of messages waiting to be processed.
+    flush_interval : float
+        Interval in seconds between sending batches.
+    '''
+
+    def __init__(self, sink, queue_size=10000, flush_interval=1.0):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, key, body):
+        '''queue message `body` with routing `key`. Does not block.'''
+        try:
+            self.queue.put_nowait((key, body))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _send(self, pending):
+        if not pending:
+            return
+        try:
+            self.sink.publish(list(pending.items()))
+        except Exception as e:
+            self.failed += len(pending)
+            E.warn("could not send %i messages: %s" % (len(pending), str(e)))
+        pending.clear()
+
+    def _run(self):
+        pending = collections.OrderedDict()
+        stop = False
+        while not stop:
+            deadline = time.time() + self.flush_interval
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                key, body = item
+                # coalesce - keep only latest message per key, but
+                # move it to the end to preserve order of updates
+                pending.pop(key, None)
+                pending[key] = body
+            self._send(pending)
+
+        self.sink.close()
+
+    def close(self, timeout=None):
+        '''send remaining messages and stop the background thread.'''
+        if not self.thread.is_alive():
+            return
+        # blocking put to guarantee that the sentinel is received
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.dropped:
+            E.warn("%i status messages were dropped" % self.dropped)
+
+
 class LoggingFilterRabbitMQ(logging.Filter):
     """pass event information to a rabbitMQ message queue.
 
@@ -410,6 +840,11 @@ class LoggingFilterRabbitMQ(logging.Filter):
     ignore
        ignore task/job (is up-to-date)
 
+    Messages are not sent from within the logging call, but are
+    handed to an :class:`AsyncPublisher` that sends them in batches
+    from a background thread. Logging thus never blocks on a slow
+    message broker.
+
     Arguments
     ---------
     ruffus_text : string
@@ -424,6 +859,13 @@ class LoggingFilterRabbitMQ(logging.Filter):
         RabbitMQ host name
     exchange : string
         RabbitMQ exchange name
+    sink : object
+        Sink to send messages to. If None, a :class:`RabbitMQSink`
+        for `host` and `exchange` is used.
+    queue_size : int
+        Maximum number of unsent messages.
+    flush_interval : float
+        Interval in seconds between sending batches of messages.
 
     """
 
@@ -431,76 +873,36 @@ class LoggingFilterRabbitMQ(logging.Filter):
                  project_name,
                  pipeline_name,
                  host="localhost",
-                 exchange="ruffus_pipelines"):
+                 exchange="ruffus_pipelines",
+                 sink=None,
+                 queue_size=10000,
+                 flush_interval=1.0):
 
         self.project_name = project_name
         self.pipeline_name = pipeline_name
         self.exchange = exchange
+        self.publisher = None
 
         # dictionary of jobs to run
         self.jobs = {}
         self.tasks = {}
 
-        if not HAS_PIKA:
-            self.connected = False
-            return
-
-        def split_by_job(text):
-            text = "".join(text)
-            job_message = ""
-            # ignore first entry which is the docstring
-            for line in text.split(" Job  = ")[1:]:
-                try:
-                    # long file names cause additional wrapping and
-                    # additional white-space characters
-                    job_name = re.search(
-                        "\[.*-> ([^\]]+)\]", line).groups()
-                except AttributeError:
-                    raise AttributeError("could not parse '%s'" % line)
-                job_status = "ignore"
-                if "Job needs update" in line:
-                    job_status = "update"
-
-                yield job_name, job_status, job_message
-
-        def split_by_task(text):
-            block, task_name = [], None
-            task_status = None
-            for line in text.split("\n"):
-                line = line.strip()
-
-                if line.startswith("Tasks which will be run"):
-                    task_status = "update"
-                elif line.startswith("Tasks which are up-to-date"):
-                    task_status = "ignore"
-
-                if line.startswith("Task = "):
-                    if task_name:
-                        yield task_name, task_status, list(split_by_job(block))
-                    block = []
-                    task_name = re.match("Task = (.*)", line).groups()[0]
-                    continue
-                if line:
-                    block.append(line)
-            if task_name:
-                yield task_name, task_status, list(split_by_job(block))
-
-        # create connection
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(
-                host=host))
-            self.connected = True
-        except pika.exceptions.AMQPConnectionError:
-            self.connected = False
-            return
+        if sink is None:
+            sink = RabbitMQSink(host=host, exchange=exchange)
+            # test connection before starting publisher
+            if not sink.connect():
+                self.connected = False
+                return
+            # the connection is re-opened within the publishing thread
+            sink.close()
 
-        self.channel = connection.channel()
-        self.channel.exchange_declare(
-            exchange=self.exchange,
-            type='topic')
+        self.connected = True
+        self.publisher = AsyncPublisher(sink,
+                                        queue_size=queue_size,
+                                        flush_interval=flush_interval)
 
         # populate with initial messages
-        for task_name, task_status, jobs in split_by_task(ruffus_text):
+        for task_name, task_status, jobs in splitPrintoutByTask(ruffus_text):
             if task_name.startswith("(mkdir"):
                 continue
 
@@ -514,13 +916,8 @@ class LoggingFilterRabbitMQ(logging.Filter):
                                      len(jobs) - to_run]
             self.send_task(task_name)
 
-    def send_task(self, task_name):
-        '''send task status.'''
-
-        if not self.connected:
-            return
-
-        task_status, task_total, task_completed = self.tasks[task_name]
+    def _publish(self, task_name, task_status):
+        task_total, task_completed = self.tasks[task_name][1:]
 
         data = {}
         data['created_at'] = time.time()
@@ -531,45 +928,34 @@ class LoggingFilterRabbitMQ(logging.Filter):
         data['task_completed'] = task_completed
 
         key = "%s.%s.%s" % (self.project_name, self.pipeline_name, task_name)
-        try:
-            self.channel.basic_publish(exchange=self.exchange,
-                                       routing_key=key,
-                                       body=json.dumps(data))
-        except pika.exceptions.ConnectionClosed:
-            E.warn("could not send message - connection closed")
-        except Exception as e:
-            E.warn("could not send message: %s" % str(e))
+        self.publisher.put(key, json.dumps(data))
+
+    def send_task(self, task_name):
+        '''send task status.'''
+
+        if not self.connected:
+            return
+
+        self._publish(task_name, self.tasks[task_name][0])
 
     def send_error(self, task_name, job, error=None, msg=None):
 
         if not self.connected:
             return
 
-        try:
-            task_status, task_total, task_completed = self.tasks[task_name]
-        except KeyError:
+        if task_name not in self.tasks:
             E.warn("could not get task information for %s, no message sent" %
                    task_name)
             return
 
-        data = {}
-        data['created_at'] = time.time()
-        data['pipeline'] = self.pipeline_name
-        data['task_name'] = task_name
-        data['task_status'] = 'failed'
-        data['task_total'] = task_total
-        data['task_completed'] = task_completed
-
-        key = "%s.%s.%s" % (self.project_name, self.pipeline_name, task_name)
+        self._publish(task_name, 'failed')
 
-        try:
-            self.channel.basic_publish(exchange=self.exchange,
-                                       routing_key=key,
-                                       body=json.dumps(data))
-        except pika.exceptions.ConnectionClosed:
-            E.warn("could not send message - connection closed")
-        except Exception as e:
-            E.warn("could not send message: %s" % str(e))
+    def close(self):
+        '''send all remaining messages and close connection.'''
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+        self.connected = False
 
     def filter(self, record):
 
@@ -755,6 +1141,24 @@ def main(args=sys.argv):
                       help="RabbitMQ host to send log messages to "
                       "[default=%default].")
 
+    parser.add_option("--no-messenger", dest="without_messenger",
+                      action="store_true",
+                      help="do not send status messages to RabbitMQ. "
+                      "This also skips computing the initial pipeline "
+                      "state [default=%default].")
+
+    parser.add_option("--no-file-cache", dest="without_file_cache",
+                      action="store_true",
+                      help="do not cache file states when checking "
+                      "which tasks are up-to-date. The cache is not used "
+                      "when running jobs with --local "
+                      "[default=%default].")
+
+    parser.add_option("--file-cache-threads", dest="file_cache_threads",
+                      type="int",
+                      help="number of threads to use for scanning "
+                      "the working directory [default=%default].")
+
     parser.set_defaults(
         pipeline_action=None,
         pipeline_format="svg",
@@ -770,7 +1174,10 @@ def main(args=sys.argv):
         is_test=False,
         ruffus_checksums_level=0,
         rabbitmq_host="saruman",
-        rabbitmq_exchange="ruffus_pipelines")
+        rabbitmq_exchange="ruffus_pipelines",
+        without_messenger=False,
+        without_file_cache=False,
+        file_cache_threads=10)
 
     (options, args) = E.Start(parser,
                               add_cluster_options=True)
@@ -862,27 +1269,60 @@ def main(args=sys.argv):
         logger = logging.getLogger()
         logger.addHandler(handler)
         messenger = None
+        file_cache = None
+
+        # serve up-to-date checks from a single scan of the
+        # working directory. Touching and regenerating modify
+        # files, so do not cache there. When making, the cache is
+        # emptied after each job, which requires jobs to run in
+        # threads of this process.
+        use_file_cache = not options.without_file_cache and (
+            options.pipeline_action == "show" or (
+                options.pipeline_action == "make" and
+                not options.without_cluster and
+                FileStateCache.canClearAfterJobs()))
+        if use_file_cache:
+            file_cache = FileStateCache(
+                PARAMS.get("workingdir"),
+                threads=options.file_cache_threads)
+            file_cache.sweep()
+            file_cache.install(
+                clear_after_jobs=options.pipeline_action == "make")
 
         try:
             if options.pipeline_action == "make":
 
-                # get tasks to be done. This essentially replicates
-                # the state information within ruffus.
-                stream = StringIO()
-                pipeline_printout(
-                    stream,
-                    options.pipeline_targets,
-                    verbose=5,
-                    checksum_level=options.ruffus_checksums_level)
-
-                messenger = LoggingFilterRabbitMQ(
-                    stream.getvalue(),
-                    project_name=getProjectName(),
-                    pipeline_name=getPipelineName(),
-                    host=options.rabbitmq_host,
-                    exchange=options.rabbitmq_exchange)
-
-                logger.addFilter(messenger)
+                sink = None
+                if not options.without_messenger:
+                    sink = RabbitMQSink(host=options.rabbitmq_host,
+                                        exchange=options.rabbitmq_exchange)
+                    # skip the initial printout if there is nobody
+                    # to send messages to.
+                    if sink.connect():
+                        sink.close()
+                    else:
+                        E.info("could not connect to RabbitMQ host %s, "
+                               "no status messages will be sent" %
+                               options.rabbitmq_host)
+                        sink = None
+
+                if sink is not None:
+                    # get tasks to be done. This essentially replicates
+                    # the state information within ruffus.
+                    stream = StringIO()
+                    pipeline_printout(
+                        stream,
+                        options.pipeline_targets,
+                        verbose=5,
+                        checksum_level=options.ruffus_checksums_level)
+
+                    messenger = LoggingFilterRabbitMQ(
+                        stream.getvalue(),
+                        project_name=getProjectName(),
+                        pipeline_name=getPipelineName(),
+                        sink=sink)
+
+                    logger.addFilter(messenger)
 
                 if not options.without_cluster:
                     global task
@@ -920,6 +1360,9 @@ def main(args=sys.argv):
 
                 closeSession()
 
+                if messenger:
+                    messenger.close()
+
             elif options.pipeline_action == "show":
                 pipeline_printout(
                     options.stdout,
@@ -985,6 +1428,13 @@ def main(args=sys.argv):
                     E.error("%i: Task=%s Error=%s %s: %s" %
                             (idx, task, error, job, msg))
 
+                if messenger:
+                    messenger.close()
+
+                # remove temporary files created by failed tasks
+                cleanupTempPaths([re.sub("__main__.", "", x[0])
+                                  for x in value.args if x[0] is not None])
+
                 E.error("full traceback is in %s" % options.logfile)
 
                 # write full traceback to log file only by removing the stdout
@@ -1002,6 +1452,10 @@ def main(args=sys.argv):
             else:
                 raise
 
+        finally:
+            if file_cache is not None:
+                file_cache.uninstall()
+
     elif options.pipeline_action == "dump":
         # convert to normal dictionary (not defaultdict) for parsing purposes
         # do not change this format below as it is exec'd in peekParameters()
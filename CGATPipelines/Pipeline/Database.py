@@ -145,7 +145,8 @@ def load(infile,
          retry=True,
          limit=0,
          shuffle=False,
-         job_memory=None):
+         job_memory=None,
+         to_cluster=True):
     """import data from a tab-separated file into database.
 
     The table name is given by outfile without the
@@ -188,6 +189,9 @@ def load(infile,
     job_memory : string
         Amount of memory to allocate for job. If unset, uses the global
         default.
+    to_cluster : bool
+        If False, load data locally. Use this if `infile` is not
+        visible from cluster nodes.
     """
 
     if job_memory is None:
@@ -651,7 +655,9 @@ def importFromIterator(
         List of column names to add indices on.
     '''
 
-    tmpfile = getTempFile(".")
+    # data is loaded locally, so keep temporary
+    # file off the shared file system
+    tmpfile = getTempFile()
 
     if columns:
         keys, values = zip(*columns.items())
@@ -676,6 +682,7 @@ def importFromIterator(
     load(tmpfile.name,
          outfile,
          tablename=tablename,
-         options=indices)
+         options=indices,
+         to_cluster=False)
 
     os.unlink(tmpfile.name)
@@ -60,7 +60,8 @@ PARAMS = {}
 
 from CGATPipelines.Pipeline.Utils import getCallerLocals
 from CGATPipelines.Pipeline.Parameters import substituteParameters
-from CGATPipelines.Pipeline.Files import getTempFilename, getTempFile
+from CGATPipelines.Pipeline.Files import getTempFilename, getTempFile, \
+    getJobTempDir, buildTempDirStatement
 from CGATPipelines.Pipeline.Cluster import *
 
 # global drmaa session
@@ -242,6 +243,10 @@ def joinStatements(statements, infile):
 
     The last statement should move @IN@ to outfile.
 
+    The temporary files are created in a temporary directory
+    on node-local scratch space that is removed once the job
+    finishes, see :func:`getJobTempDir`.
+
     Arguments
     ---------
     statements : list
@@ -256,10 +261,11 @@ def joinStatements(statements, infile):
 
     '''
 
-    prefix = getTempFilename()
+    tmpdir = getJobTempDir()
+    prefix = os.path.join(tmpdir, "ctmp")
     pattern = "%s_%%i" % prefix
 
-    result = []
+    result = [buildTempDirStatement(tmpdir)]
     for x, statement in enumerate(statements):
         if x == 0:
             s = re.sub("@IN@", infile, statement)
@@ -272,9 +278,7 @@ def joinStatements(statements, infile):
             s = s[:-1]
         result.append(s)
 
-    assert prefix != ""
-    result.append("rm -f %s*" % prefix)
-
+    # tmpdir is removed by the exit handler after recording its usage
     result = "; checkpoint ; ".join(result)
     return result
 
@@ -317,6 +321,52 @@ def getJobMemory(options=False, PARAMS=False):
     return job_memory
 
 
+def buildProfileStatement(options, job_name):
+    '''build a statement sampling the resource usage of a job.
+
+    The statement starts :file:`cgat_profile_job.py` in the background
+    to sample the process tree of the current shell at intervals of
+    ``job_profile_interval`` seconds. The samples are written to
+    :file:`<job_profile_dir>/<job_name>.profile.tsv`.
+
+    Arguments
+    ---------
+    options : dict
+        Job options.
+    job_name : string
+        Name of the job. This is used to name the output file.
+
+    Returns
+    -------
+    statement : string
+        Statement to prepend to a job statement. Empty if profiling
+        is not enabled.
+    '''
+    interval = options.get("job_profile_interval", 0)
+    if not interval:
+        return ""
+
+    profile_dir = os.path.join(PARAMS["workingdir"],
+                               options.get("job_profile_dir",
+                                           "profiles.dir"))
+    try:
+        os.makedirs(profile_dir)
+    except OSError:
+        # directory exists or has been created by another job
+        pass
+
+    # distinguish tasks in array jobs
+    if options.get("job_array", None) is not None:
+        job_name += ".${SGE_TASK_ID:-${SLURM_ARRAY_TASK_ID}}"
+
+    profile_file = os.path.join(profile_dir, "%s.profile.tsv" % job_name)
+
+    return ("python %s/cgat_profile_job.py --pid=$$ "
+            "--sampling-interval=%f -v 0 --stdout=%s "
+            "< /dev/null > /dev/null 2>&1 & " %
+            (PARAMS["pipeline_scriptsdir"], float(interval), profile_file))
+
+
 def run(**kwargs):
     """run a command line statement.
 
@@ -360,6 +410,10 @@ def run(**kwargs):
           and not ``hl`` for ``host:local``. Note that qrsh/qsub directly
           still works.
 
+    The resource usage of each job can be recorded by setting the
+    variable ``job_profile_interval`` to the sampling interval in
+    seconds, see :func:`buildProfileStatement`.
+
     """
 
     # combine options using correct preference
@@ -406,7 +460,8 @@ def run(**kwargs):
         "[:]", "_",
         os.path.basename(options.get("outfile", "ruffus")))
 
-    def _writeJobScript(statement, job_memory, job_name, shellfile):
+    def _writeJobScript(statement, job_memory, job_name, shellfile,
+                        index=None):
         # disabled - problems with quoting
         # tmpfile.write( '''echo 'statement=%s' >> %s\n''' %
         # (shellquote(statement), shellfile) )
@@ -421,6 +476,13 @@ def run(**kwargs):
                     echo "%(job_name)s : END -> ${0}" >> %(shellfile)s
                  ''' % locals()
 
+        # start profiler before limiting memory
+        if index is not None:
+            script += buildProfileStatement(
+                options, "%s.%i" % (job_name, index)) + "\n"
+        else:
+            script += buildProfileStatement(options, job_name) + "\n"
+
         # restrict virtual memory
         # Note that there are resources in SGE which could do this directly
         # such as v_hmem.
@@ -455,10 +517,11 @@ def run(**kwargs):
 
             job_ids, filenames = [], []
 
-            for statement in statement_list:
+            for index, statement in enumerate(statement_list):
                 E.debug("running statement:\n%s" % statement)
 
-                job_path = _writeJobScript(statement, job_memory, job_name, shellfile)
+                job_path = _writeJobScript(statement, job_memory, job_name,
+                                           shellfile, index=index)
 
                 jt, stdout_path, stderr_path = setDrmaaJobPaths(jt, job_path)
 
@@ -542,9 +605,15 @@ def run(**kwargs):
         if options.get("dryrun", False):
             return
 
-        for statement in statement_list:
+        for index, statement in enumerate(statement_list):
             E.debug("running statement:\n%s" % statement)
 
+            if len(statement_list) > 1:
+                profile = buildProfileStatement(
+                    options, "%s.%i" % (job_name, index))
+            else:
+                profile = buildProfileStatement(options, job_name)
+
             # process substitution <() and >() does not
             # work through subprocess directly. Thus,
             # the statement needs to be wrapped in
@@ -561,7 +630,7 @@ def run(**kwargs):
                 statement = "%s -c %s" % (shell, statement)
 
             process = subprocess.Popen(
-                expandStatement(
+                profile + expandStatement(
                     statement,
                     ignore_pipe_errors=ignore_pipe_errors),
                 cwd=PARAMS["workingdir"],
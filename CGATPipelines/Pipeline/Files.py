@@ -23,18 +23,107 @@
 """Files.py - Working with files in ruffus pipelines
 ====================================================
 
+Temporary files
+---------------
+
+The functions :func:`getTempFile`, :func:`getTempFilename` and
+:func:`getTempDir` create temporary files and directories from within
+the pipeline process. As these might be used by jobs running on other
+nodes, they are created in the ``tmpdir`` or ``shared_tmpdir``
+locations. Paths created by these functions are recorded for each
+task, so that they can be removed with :func:`cleanupTempPaths` if a
+task fails.
+
+Intermediate files that are created and used within a single job
+should be placed into a directory returned by :func:`getJobTempDir`.
+This directory is located on node-local scratch space (``local_tmpdir``)
+and is only created when the job runs. The statement to create the
+directory is obtained from :func:`buildTempDirStatement`. The
+directory is removed when the job finishes, even if the job fails,
+and its size is recorded in :file:`tmpdir_usage.tsv` in the working
+directory. Optionally, a quota can be imposed on the directory.
+
 Reference
 ---------
 
 """
+import collections
 import os
+import shutil
+import sys
 import tempfile
+import uuid
 
+import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
 
 # Set from Pipeline.py
 PARAMS = {}
 
+# temporary files and directories created by the pipeline process
+# for each task.
+TEMP_PATHS = collections.defaultdict(list)
+
+# file in working directory recording temporary space used by jobs
+TMPDIR_USAGE_FILE = "tmpdir_usage.tsv"
+
+
+def getTaskName():
+    """return the name of the task calling the current function.
+
+    The task is the innermost function defined in the pipeline
+    script, i.e., the ``__main__`` module.
+
+    Returns
+    -------
+    name : string
+        Name of task or None if not called from a task.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_globals.get("__name__") == "__main__" and \
+           frame.f_code.co_name != "<module>":
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return None
+
+
+def registerTempPath(path):
+    """record a temporary path for the current task."""
+    TEMP_PATHS[getTaskName()].append(path)
+
+
+def cleanupTempPaths(tasks=None):
+    """remove temporary files and directories created by tasks.
+
+    Arguments
+    ---------
+    tasks : list
+        Names of tasks to clean up after. If None, clean up
+        after all tasks.
+
+    Returns
+    -------
+    nremoved : int
+        Number of files and directories removed.
+    """
+    if tasks is None:
+        tasks = list(TEMP_PATHS.keys())
+
+    nremoved = 0
+    for task in tasks:
+        for path in TEMP_PATHS.pop(task, []):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.unlink(path)
+            else:
+                continue
+            nremoved += 1
+
+    E.debug("removed %i temporary files and directories" % nremoved)
+    return nremoved
+
 
 def getTempFile(dir=None, shared=False, suffix=""):
     '''get a temporary file.
@@ -64,8 +153,11 @@ def getTempFile(dir=None, shared=False, suffix=""):
         else:
             dir = PARAMS['tmpdir']
 
-    return tempfile.NamedTemporaryFile(dir=dir, delete=False, prefix="ctmp",
-                                       suffix=suffix)
+    tmpfile = tempfile.NamedTemporaryFile(dir=dir, delete=False,
+                                          prefix="ctmp",
+                                          suffix=suffix)
+    registerTempPath(tmpfile.name)
+    return tmpfile
 
 
 def getTempFilename(dir=None, shared=False, suffix=""):
@@ -123,7 +215,101 @@ def getTempDir(dir=None, shared=False):
         else:
             dir = PARAMS['tmpdir']
 
-    return tempfile.mkdtemp(dir=dir, prefix="ctmp")
+    tmpdir = tempfile.mkdtemp(dir=dir, prefix="ctmp")
+    registerTempPath(tmpdir)
+    return tmpdir
+
+
+def getJobTempDir(shared=False):
+    """return the name of a temporary directory for use within a job.
+
+    The directory is not created, use :func:`buildTempDirStatement` to
+    create it inside the job. By default, the directory is located on
+    node-local scratch space given by ``local_tmpdir``. The location
+    may contain shell variables such as ``$SCRATCH_DIR`` that will be
+    expanded on the node where the job is executed.
+
+    Arguments
+    ---------
+    shared : bool
+        If set, the directory will be in the shared temporary location
+        and can thus be used by several jobs.
+
+    Returns
+    -------
+    dirname : string
+        Name of temporary directory.
+    """
+    if shared:
+        dir = PARAMS['shared_tmpdir']
+    else:
+        dir = PARAMS.get('local_tmpdir', PARAMS['tmpdir'])
+
+    return os.path.join(dir, "ctmp%s" % uuid.uuid4().hex[:12])
+
+
+def buildTempDirStatement(tmpdir, quota=None):
+    """build statement to manage a temporary directory within a job.
+
+    The statement creates `tmpdir` and installs a handler that removes
+    it once the job exits, whether successfully or not. Before
+    removal, the disk space used by the directory is appended to
+    :file:`tmpdir_usage.tsv` in the working directory together with
+    the name of the task.
+
+    If a `quota` is given, the job will fail immediately if there is
+    less than `quota` space available. While the job is running, the
+    size of the directory is monitored and the commands of the job
+    are terminated if the directory exceeds the `quota`.
+
+    Several temporary directories can be managed within the same job.
+
+    Arguments
+    ---------
+    tmpdir : string
+        Name of temporary directory, see :func:`getJobTempDir`.
+    quota : string
+        Maximum size of directory, for example ``10G``. If None, the
+        value of the configuration parameter ``tmpdir_quota`` is
+        used. If neither is set, no quota is imposed.
+
+    Returns
+    -------
+    statement : string
+        Statement to insert at the start of a job.
+    """
+    if quota is None:
+        quota = PARAMS.get("tmpdir_quota", None)
+
+    usage_file = os.path.join(PARAMS["workingdir"], TMPDIR_USAGE_FILE)
+    task = getTaskName()
+
+    statement = [
+        "mkdir -p %s" % tmpdir,
+        'CGAT_TMPDIRS="$CGAT_TMPDIRS %s"' % tmpdir]
+
+    if quota:
+        kb = IOTools.human2bytes(quota) // 1024
+        parent = os.path.dirname(tmpdir)
+        statement.append(
+            "[ $(df -Pk %(parent)s | awk 'NR == 2 {print $4}') -ge %(kb)i ]"
+            " || { echo 'less than %(quota)s available in %(parent)s' >&2;"
+            " exit 1; }" % locals())
+        statement.append(
+            "( while sleep 30; do"
+            " [ $(du -sk %(tmpdir)s | cut -f 1) -le %(kb)i ]"
+            " || { echo 'temporary directory %(tmpdir)s exceeds"
+            " quota of %(quota)s' >&2; pkill -TERM -P $$; exit 1; };"
+            " done ) > /dev/null &"
+            ' CGAT_TMPWATCH="$CGAT_TMPWATCH $!"' % locals())
+
+    statement.append(
+        "trap '[ -z \"$CGAT_TMPWATCH\" ] || kill $CGAT_TMPWATCH 2> /dev/null;"
+        " for d in $CGAT_TMPDIRS; do du -sk $d | sed \"s/^/%(task)s\\t/\""
+        " >> %(usage_file)s; done;"
+        " rm -rf $CGAT_TMPDIRS' EXIT" % locals())
+
+    return "; ".join(statement)
 
 
 def checkExecutables(filenames):
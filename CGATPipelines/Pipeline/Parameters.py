@@ -147,6 +147,9 @@ HARDCODED_PARAMS = {
     'local_tmpdir': os.environ.get("TMPDIR", '/scratch'),
     # directory used for temporary files shared across machines
     'shared_tmpdir': os.environ.get("SHARED_TMPDIR", "/ifs/scratch"),
+    # maximum size of temporary directories created within jobs,
+    # for example 100G. If empty, no quota is imposed.
+    'tmpdir_quota': "",
     # queue manager (supported: sge, slurm)
     'cluster_queue_manager': 'sge',
     # cluster queue to use
@@ -163,6 +166,11 @@ HARDCODED_PARAMS = {
     'cluster_options': "",
     # parallel environment to use for multi-threaded jobs
     'cluster_parallel_environment': 'dedicated',
+    # interval in seconds for sampling resource usage of jobs.
+    # Set to 0 to disable sampling.
+    'job_profile_interval': 0,
+    # directory to save resource usage samples of jobs to
+    'job_profile_dir': "profiles.dir",
     # ruffus job limits for databases
     'jobs_limit_db': 10,
     # ruffus job limits for R
@@ -130,6 +130,11 @@ that are visible only within a particular compute node, and ``shared``
 locations that are visible between compute nodes and typically on a
 network mounted location.
 
+Intermediate files that are only used within a single job should be
+placed into a directory returned by :func:`getJobTempDir`. This
+directory is located on node-local scratch space and is created and
+removed by the job itself, see :func:`buildTempDirStatement`.
+
 Requirements
 ------------
 
@@ -413,6 +418,9 @@ __all__ = [
     "getTempFile",
     "getTempDir",
     "getTempFilename",
+    "getJobTempDir",
+    "buildTempDirStatement",
+    "cleanupTempPaths",
     "checkScripts",
     "checkExecutables",
     # Local.py
@@ -0,0 +1,224 @@
+'''PipelineDEStats.py - summary statistics of differential expression tests
+==========================================================================
+
+This module counts the number of tested, up/down regulated,
+significant, etc. features in the output of differential expression
+tests (see :mod:`scripts/runExpression`). It is used by the
+rnaseq, windows and medip pipelines.
+
+The results can be read from files or from database tables. Files
+are read in chunks and the counts are computed for each chunk with
+numpy. For tables, all counts are computed with a single aggregate
+query.
+
+Counts are computed for each combination of treatment, control and
+status. The following counts are computed, see :data:`DE_COUNTS`:
+
+tested
+   number of tests
+significant
+   number of significant tests
+up, down
+   number of tests with positive/negative fold change
+l2fold_up, l2fold_down
+   number of tests with a log2 fold change above 1/below -1
+significant_up, significant_down
+   number of significant tests with positive/negative fold change
+significant_l2fold_up, significant_l2fold_down
+   number of significant tests with a log2 fold change above 1/below -1
+twofold
+   number of significant tests with an absolute log2 fold change
+   of at least 1
+
+Reference
+---------
+
+'''
+
+import collections
+import numpy
+import pandas
+
+import CGAT.Database as Database
+import CGAT.IOTools as IOTools
+
+# columns identifying a test
+DE_KEYS = ("treatment_name", "control_name", "status")
+
+# counts and the SQL conditions they are based on
+DE_COUNTS = (
+    ("tested", "1"),
+    ("significant", "significant"),
+    ("up", "l2fold > 0"),
+    ("down", "l2fold < 0"),
+    ("l2fold_up", "l2fold > 1"),
+    ("l2fold_down", "l2fold < -1"),
+    ("significant_up", "significant AND l2fold > 0"),
+    ("significant_down", "significant AND l2fold < 0"),
+    ("significant_l2fold_up", "significant AND l2fold > 1"),
+    ("significant_l2fold_down", "significant AND l2fold < -1"),
+    ("twofold", "significant AND (l2fold >= 1 OR l2fold <= -1)"))
+
+
+def summarizeDEData(data):
+    '''count tests in a table of differential expression results.
+
+    Arguments
+    ---------
+    data : pandas.DataFrame
+        Dataframe with the columns ``treatment_name``, ``control_name``,
+        ``status``, ``significant`` and ``l2fold``. ``significant``
+        is a string and a test is significant if it is ``1``.
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        Dataframe indexed by treatment, control and status with
+        one column for each count in :data:`DE_COUNTS`.
+    '''
+    significant = (data["significant"] == "1").values
+    l2fold = pandas.to_numeric(data["l2fold"], errors="coerce").values
+
+    with numpy.errstate(invalid="ignore"):
+        up, down = l2fold > 0, l2fold < 0
+        l2fold_up, l2fold_down = l2fold > 1, l2fold < -1
+        twofold = (l2fold >= 1) | (l2fold <= -1)
+
+    counts = pandas.DataFrame(
+        collections.OrderedDict((
+            ("tested", numpy.ones(len(data), dtype=numpy.int64)),
+            ("significant", significant),
+            ("up", up),
+            ("down", down),
+            ("l2fold_up", l2fold_up),
+            ("l2fold_down", l2fold_down),
+            ("significant_up", significant & up),
+            ("significant_down", significant & down),
+            ("significant_l2fold_up", significant & l2fold_up),
+            ("significant_l2fold_down", significant & l2fold_down),
+            ("twofold", significant & twofold))),
+        index=data.index).astype(numpy.int64)
+
+    for key in DE_KEYS:
+        counts[key] = data[key].values
+
+    return counts.groupby(list(DE_KEYS), sort=False).sum()
+
+
+def summarizeDEFiles(infiles, chunk_size=1000000):
+    '''count tests in files with differential expression results.
+
+    Files are read in chunks of `chunk_size` rows. Only the columns
+    required for counting are read.
+
+    Arguments
+    ---------
+    infiles : list
+        List of filenames in :term:`tsv` format.
+    chunk_size : int
+        Number of rows to read at a time.
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        See :func:`summarizeDEData`. Counts are summed over all files.
+    '''
+    columns = list(DE_KEYS) + ["significant", "l2fold"]
+
+    summaries = []
+    for infile in infiles:
+        inf = IOTools.openFile(infile)
+        for chunk in pandas.read_csv(inf,
+                                     sep="\t",
+                                     usecols=columns,
+                                     dtype=str,
+                                     keep_default_na=False,
+                                     chunksize=chunk_size):
+            summaries.append(summarizeDEData(chunk))
+        inf.close()
+
+    return _combineSummaries(summaries)
+
+
+def summarizeDETable(dbhandle, tablename):
+    '''count tests in a database table with differential expression
+    results.
+
+    All counts are computed with a single query.
+
+    Arguments
+    ---------
+    dbhandle : object
+        Database handle.
+    tablename : string
+        Table with differential expression results.
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        See :func:`summarizeDEData`.
+    '''
+    keys = ", ".join(DE_KEYS)
+    counts = ",\n".join(
+        ["SUM(CASE WHEN %s THEN 1 ELSE 0 END) AS %s" % (condition, name)
+         for name, condition in DE_COUNTS])
+
+    statement = '''SELECT %(keys)s,
+    %(counts)s
+    FROM %(tablename)s
+    GROUP BY %(keys)s''' % locals()
+
+    rows = Database.executewait(dbhandle, statement).fetchall()
+    return _combineSummaries([pandas.DataFrame.from_records(
+        rows,
+        columns=list(DE_KEYS) + [x[0] for x in DE_COUNTS],
+        index=list(DE_KEYS))])
+
+
+def _combineSummaries(summaries):
+    '''sum counts across summaries.'''
+    names = [x[0] for x in DE_COUNTS]
+    summaries = [x for x in summaries if len(x) > 0]
+    if not summaries:
+        return pandas.DataFrame(
+            columns=list(DE_KEYS) + names).set_index(list(DE_KEYS))
+
+    summary = pandas.concat(summaries)
+    return summary.groupby(level=list(DE_KEYS)).sum()[names].astype(
+        numpy.int64)
+
+
+def getTestSummary(summary, status=None):
+    '''return counts for each pair of treatment and control.
+
+    Arguments
+    ---------
+    summary : pandas.DataFrame
+        Output of :func:`summarizeDEFiles` or :func:`summarizeDETable`.
+    status : string
+        If given, only count tests with this status. The number of
+        tested features is always the total over all tests.
+
+    Returns
+    -------
+    counts : pandas.DataFrame
+        Dataframe indexed by treatment and control with a column
+        for each count in :data:`DE_COUNTS`.
+    status : pandas.DataFrame
+        Dataframe indexed by treatment and control with the number
+        of tests for each status.
+    '''
+    levels = list(DE_KEYS[:2])
+    tested = summary["tested"].groupby(level=levels).sum()
+    status_counts = summary["tested"].unstack("status").reindex(
+        tested.index).fillna(0).astype(numpy.int64)
+
+    if status is not None:
+        summary = summary[
+            summary.index.get_level_values("status") == status]
+
+    counts = summary.groupby(level=levels).sum().reindex(
+        tested.index).fillna(0).astype(numpy.int64)
+    counts["tested"] = tested
+
+    return counts, status_counts
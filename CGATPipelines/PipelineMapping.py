@@ -44,6 +44,17 @@ The basic usage inside a pipeline task is as such::
 
         P.run()
 
+Large data sets can be mapped in parallel by splitting the reads into
+shards that are mapped as separate jobs and merged afterwards::
+
+        PipelineMapping.runShards(m, (infile,), outfile, 10, locals())
+
+Remote (:file:`.remote`) and :term:`sra` input can be downloaded and
+extracted into a shared cache in a separate task before mapping with
+:func:`stageReads`. If :attr:`SequenceCollectionProcessor.staging_dir`
+is set to the cache directory, the mapping job uses the staged reads
+instead of downloading them itself.
+
 When implementing a tool, avoid specifying algorithmic options as
 class variables. Instead use an option string that can be set in
 :file:`pipeline.ini`. The only arguments to a tool constructor should
@@ -428,6 +439,286 @@ def resetGTFAttributes(infile, genome, gene_ids, outfile):
     os.unlink(tmpfile2)
 
 
+def runShards(mapper, infiles, outfile, nshards, params):
+    '''map reads in parallel with `mapper`.
+
+    The reads are split into `nshards` shards that are mapped as
+    separate jobs. The sorted output of the shards is then merged
+    into `outfile`. See :meth:`Mapper.buildShards`.
+
+    Arguments
+    ---------
+    mapper : Mapper
+        The mapper to use.
+    infiles : list
+        List of input filenames.
+    outfile : string
+        Output filename in :term:`bam` format.
+    nshards : int
+        Number of shards.
+    params : dict
+        Parameters for :func:`Pipeline.run`, usually the locals of
+        the calling task. ``job_threads`` and ``job_memory`` apply
+        to the mapping of each shard.
+    '''
+
+    split_statement, shard_statements, merge_statement = \
+        mapper.buildShards(infiles, outfile, nshards)
+
+    options = dict(params)
+    options.update({"statement": split_statement,
+                    "job_threads": 1,
+                    "job_memory": "2G"})
+    P.run(**options)
+
+    options = dict(params)
+    options["statements"] = shard_statements
+    P.run(**options)
+
+    options = dict(params)
+    options.update({"statement": merge_statement,
+                    "job_threads": 1,
+                    "job_memory": "2G"})
+    P.run(**options)
+
+
+def getRemoteAccessions(infile):
+    '''return accessions of reads in `infile`.
+
+    `infile` is either a :term:`sra` formatted file or a file with
+    the suffix ``.remote``. Each line of a ``.remote`` file contains
+    the repository, the accession and optional further fields
+    separated by tabs.
+
+    Returns
+    -------
+    accessions : list
+        List of tuples of (repository, accession, fields). Local
+        :term:`sra` files are returned with the repository
+        ``SRAFILE`` and the filename as the only field.
+    '''
+    if infile.endswith(".sra"):
+        return [("SRAFILE",
+                 P.snip(os.path.basename(infile), ".sra"),
+                 [infile])]
+
+    accessions = []
+    for line in IOTools.openFile(infile):
+        fields = line.strip().split("\t")
+        accessions.append((fields[0], fields[1], fields[2:]))
+    return accessions
+
+
+# compressed read files that are staged. Colour space data
+# extracted with abi-dump is staged as csfasta and qual files.
+STAGED_SUFFIXES = ("fastq", "csfasta", "qual")
+
+
+def getStagedFiles(cachedir, accession):
+    '''return staged read files of `accession`.
+
+    Returns an empty list if `accession` has not been staged
+    in `cachedir`. See :data:`STAGED_SUFFIXES` for the files
+    returned.
+    '''
+    stagedir = os.path.abspath(os.path.join(cachedir, accession))
+    if not os.path.exists(os.path.join(stagedir, "MD5SUMS")):
+        return []
+    filenames = []
+    for suffix in STAGED_SUFFIXES:
+        filenames.extend(
+            glob.glob(os.path.join(stagedir, "*.%s*.gz" % suffix)))
+    return sorted(filenames)
+
+
+def peekStagedFiles(filenames):
+    '''return information about staged reads as :func:`Sra.peek` does.
+
+    The staged files are inspected directly, so that the :term:`sra`
+    archive does not need to be accessed.
+
+    Arguments
+    ---------
+    filenames : list
+        Staged files, see :func:`getStagedFiles`.
+
+    Returns
+    -------
+    files : list
+        List of :term:`fastq` formatted files that :func:`Sra.peek`
+        would report. For colour space data, these are the names of
+        the files fastq-dump would create.
+    format : list
+        The quality score formats of the :term:`fastq` formatted files.
+        Empty for colour space data.
+    datatype : string
+        ``basecalls`` or ``colorspace``.
+    '''
+    fastqfiles = [x for x in filenames if ".fastq" in os.path.basename(x)]
+    if not fastqfiles:
+        csfastafiles = [x for x in filenames
+                        if x.endswith("_F3.csfasta.gz")]
+        if not csfastafiles:
+            raise ValueError("no reads in staged files %s" % filenames)
+        return ([x[:-len("_F3.csfasta.gz")] + "_1.fastq.gz"
+                 for x in csfastafiles], [], "colorspace")
+
+    fastq_format = Fastq.guessFormat(
+        IOTools.openFile(fastqfiles[0], "r"), raises=False)
+    fastq_datatype = Fastq.guessDataType(
+        IOTools.openFile(fastqfiles[0], "r"), raises=True)
+    return fastqfiles, fastq_format, fastq_datatype
+
+
+def buildStagingStatement(repository, accession, fields, cachedir,
+                          store=None, keep_sra=True):
+    '''return statement that stages reads of `accession` in `cachedir`.
+
+    The reads are downloaded or extracted into a temporary directory
+    within `cachedir`. The compressed read files (see
+    :data:`STAGED_SUFFIXES`) are tested
+    for integrity and their checksums are recorded in a file called
+    :file:`MD5SUMS`. The directory is then renamed to the accession
+    so that incomplete downloads never appear in the cache.
+
+    Arguments
+    ---------
+    repository : string
+        Repository to fetch reads from (SRA, ENA, TCGA or SRAFILE).
+    accession : string
+        Accession of the reads.
+    fields : list
+        Further fields describing the reads (see
+        :func:`getRemoteAccessions`).
+    cachedir : string
+        Directory with staged reads.
+    store : string
+        If given, copy compressed files called ``<accession>.*.gz`` or
+        ``<accession>_*.gz`` from this directory instead of fetching
+        them from `repository`. Useful for testing.
+    keep_sra : bool
+        If False, remove downloaded :term:`sra` files from the
+        SRA toolkit cache after extraction.
+
+    Returns
+    -------
+    statement : string
+        The command line statement.
+    '''
+    stagedir = os.path.abspath(os.path.join(cachedir, accession))
+    outdir = "$CGAT_STAGEDIR"
+
+    statement = ["mkdir -p %s" % os.path.dirname(stagedir),
+                 "CGAT_STAGEDIR=`mktemp -d %s.XXXXXX`" % stagedir]
+
+    if store:
+        statement.append("cp %s/%s[._]*.gz %s" %
+                         (os.path.abspath(store), accession, outdir))
+    elif repository == "SRA":
+        statement.append(Sra.prefetch(accession))
+        statement.append(Sra.extract(accession, outdir))
+        if not keep_sra:
+            statement.append(Sra.clean_cache(accession))
+    elif repository == "SRAFILE":
+        f, format, datatype = Sra.peek(fields[0])
+        if datatype == "colorspace":
+            tool = "abi-dump"
+        else:
+            tool = "fastq-dump"
+        statement.append(Sra.extract(fields[0], outdir, tool))
+    elif repository == "ENA":
+        filenames, dl_paths = Sra.fetch_ENA_files(accession)
+        for f in dl_paths:
+            statement.append(Sra.fetch_ENA(f, outdir))
+    elif repository == "TCGA":
+        token = glob.glob("gdc-user-token*")
+        if len(token) > 0:
+            token = os.path.abspath(token[0])
+        else:
+            token = None
+        statement.append(Sra.fetch_TCGA_fastq(accession,
+                                              fields[0],
+                                              token,
+                                              outdir))
+    else:
+        raise ValueError("Unknown repository: %s" % repository)
+
+    # fail if nothing has been downloaded or a file is truncated
+    statement.append(
+        "CGAT_STAGED=`cd %s && ls | grep -E '[.](%s).*[.]gz$'`" %
+        (outdir, "|".join(STAGED_SUFFIXES)))
+    statement.append('[ -n "$CGAT_STAGED" ]')
+    statement.append(
+        "for fn in $CGAT_STAGED; do gzip -t %s/$fn || exit 1; done" % outdir)
+    statement.append("( cd %s && md5sum $CGAT_STAGED > MD5SUMS )" % outdir)
+    statement.append("chmod a+rx %s" % outdir)
+    # another job might have staged the same accession in the meantime
+    statement.append(
+        "if [ -e %(stagedir)s ]; then rm -rf %(outdir)s; "
+        "else mv %(outdir)s %(stagedir)s; fi" % locals())
+
+    return "; checkpoint; ".join(statement)
+
+
+def stageReads(infile, outfile, cachedir, params, store=None,
+               keep_sra=True):
+    '''stage reads in `infile` in the shared cache `cachedir`.
+
+    Reads of accessions that are not yet in the cache are fetched
+    concurrently with one job per accession. Accessions that are
+    already in the cache are not fetched again. See
+    :func:`buildStagingStatement`.
+
+    Arguments
+    ---------
+    infile : string
+        A :term:`sra` formatted file or a file with the suffix
+        ``.remote``.
+    outfile : string
+        Output filename. A table of staged files for each accession
+        is written to this file.
+    cachedir : string
+        Directory with staged reads.
+    params : dict
+        Parameters for :func:`Pipeline.run`, usually the locals of
+        the calling task. ``job_threads`` and ``job_memory`` apply
+        to each staging job.
+    store : string
+        Directory to copy files from instead of remote repositories.
+    keep_sra : bool
+        If False, remove downloaded :term:`sra` files from the
+        SRA toolkit cache.
+    '''
+
+    accessions = []
+    statements = []
+    for repository, accession, fields in getRemoteAccessions(infile):
+        if accession in accessions:
+            continue
+        accessions.append(accession)
+        if getStagedFiles(cachedir, accession):
+            E.info("reads for %s are in cache %s" % (accession, cachedir))
+            continue
+        statements.append(buildStagingStatement(
+            repository, accession, fields, cachedir,
+            store=store, keep_sra=keep_sra))
+
+    if statements:
+        options = dict(params)
+        options["statements"] = statements
+        P.run(**options)
+
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("accession\tfilename\n")
+        for accession in accessions:
+            filenames = getStagedFiles(cachedir, accession)
+            if not filenames:
+                raise ValueError("reads for %s have not been staged" %
+                                 accession)
+            for filename in filenames:
+                outf.write("%s\t%s\n" % (accession, filename))
+
+
 class SequenceCollectionProcessor(object):
     """base class for processors of sequence collections.
 
@@ -450,6 +741,10 @@ class SequenceCollectionProcessor(object):
         Directory with the locations of temporary :term:`fastq`
         formatted files. This directory can be used as a general
         temporary directory by a mapper.
+    staging_dir : string
+        Directory with reads staged by :func:`stageReads`. If set,
+        staged reads are used instead of downloading or extracting
+        remote and :term:`sra` input within the job.
     """
 
     # compress temporary fastq files with gzip
@@ -468,9 +763,26 @@ class SequenceCollectionProcessor(object):
 
     keep_sra = True
 
+    # Directory with staged reads
+    staging_dir = None
+
     def __init__(self, *args, **kwargs):
         pass
 
+    def linkStagedFiles(self, accession, outdir):
+        '''return statement linking staged reads of `accession`
+        into `outdir`.
+
+        Returns None if :attr:`staging_dir` is not set or `accession`
+        has not been staged.
+        '''
+        if not self.staging_dir:
+            return None
+        filenames = getStagedFiles(self.staging_dir, accession)
+        if not filenames:
+            return None
+        return "ln -s %s %s" % (" ".join(filenames), outdir)
+
     def quoteFile(self, filename):
         '''return a quoted file for in-situ uncompression.
 
@@ -506,10 +818,12 @@ class SequenceCollectionProcessor(object):
 
         assert len(infiles) > 0, "no input files for processing"
 
-        tmpdir_fastq = P.getTempDir(shared=True)
+        # temporary files are only used within the job, so
+        # keep them on node-local scratch space
+        tmpdir_fastq = P.getJobTempDir()
 
-        # create temporary directory again for nodes
-        statement = ["mkdir -p %s" % tmpdir_fastq]
+        # create temporary directory on the node
+        statement = [P.buildTempDirStatement(tmpdir_fastq)]
         fastqfiles = []
 
         # get track by extension of outfile
@@ -549,22 +863,32 @@ class SequenceCollectionProcessor(object):
                 files = []
                 for line in IOTools.openFile(infile):
                     repo, acc = line.strip().split("\t")[:2]
+                    staged = self.linkStagedFiles(acc, tmpdir_fastq)
                     if repo == "SRA":
-                        statement.append(Sra.prefetch(acc))
-                        f, format = Sra.peek(acc)
-                        statement.append(Sra.extract(acc, tmpdir_fastq))
+                        if staged:
+                            f, format, datatype = peekStagedFiles(
+                                getStagedFiles(self.staging_dir, acc))
+                            statement.append(staged)
+                        else:
+                            f, format, datatype = Sra.peek(acc)
+                            statement.append(Sra.prefetch(acc))
+                            statement.append(Sra.extract(acc, tmpdir_fastq))
+                            if not self.keep_sra:
+                                statement.append(Sra.clean_cache(acc))
 
                         extracted_files = ["%s/%s" % (
                             tmpdir_fastq, os.path.basename(x))
-                                                for x in sorted(f)]
-                        if not self.keep_sra:
-                            statement.append(Sra.clean_cache(acc))
+                            for x in sorted(f)]
                         files.extend(extracted_files)
                     
                     elif repo == "ENA":
                         filenames, dl_paths = Sra.fetch_ENA_files(acc)
-                        for f in dl_paths:
-                            statement.append(Sra.fetch_ENA(f, tmpdir_fastq))
+                        if staged:
+                            statement.append(staged)
+                        else:
+                            for f in dl_paths:
+                                statement.append(
+                                    Sra.fetch_ENA(f, tmpdir_fastq))
                         files.extend([os.path.join(tmpdir_fastq, x) for x
                                       in filenames])
                     
@@ -577,10 +901,14 @@ class SequenceCollectionProcessor(object):
                         else:
                             token = None
 
-                        statement.append(Sra.fetch_TCGA_fastq(acc,
-                                                              tar_name,
-                                                              token,
-                                                              tmpdir_fastq))
+                        if staged:
+                            statement.append(staged)
+                        else:
+                            statement.append(
+                                Sra.fetch_TCGA_fastq(acc,
+                                                     tar_name,
+                                                     token,
+                                                     tmpdir_fastq))
 
                         files.append(os.path.join(tmpdir_fastq, acc + "_1.fastq.gz"))
                         files.append(os.path.join(tmpdir_fastq, acc + "_2.fastq.gz"))
@@ -602,7 +930,8 @@ class SequenceCollectionProcessor(object):
                     new_files = files
 
                 out_base = os.path.basename(os.path.splitext(outfile)[0])
-                new_files = [re.sub(r"%s/(.+).(fastq..*gz)" % tmpdir_fastq,
+                new_files = [re.sub(r"%s/(.+).(fastq..*gz)" %
+                                    re.escape(tmpdir_fastq),
                                     r"%s/%s_\1.\2" % (tmpdir_fastq, out_base),
                                     nf) for nf in new_files]
 
@@ -613,9 +942,15 @@ class SequenceCollectionProcessor(object):
                 fastqfiles.append(new_files)
                         
             elif infile.endswith(".sra"):
-                # sneak preview to determine if paired end or single end
-                outdir = P.getTempDir()
-                f, format, datatype = Sra.peek(infile)
+                # sneak preview to determine if paired end or single end,
+                # use the staged reads if there are any
+                accession = P.snip(os.path.basename(infile), ".sra")
+                staged = self.linkStagedFiles(accession, tmpdir_fastq)
+                if staged:
+                    f, format, datatype = peekStagedFiles(
+                        getStagedFiles(self.staging_dir, accession))
+                else:
+                    f, format, datatype = Sra.peek(infile)
                 E.info("sra file contains the following files: %s" % f)
 
                 # T.S need to use abi-dump for colorspace files
@@ -626,8 +961,12 @@ class SequenceCollectionProcessor(object):
                     tool = "abi-dump"
                     self.datatype = "solid"
 
-                # add extraction command to statement
-                statement.append(Sra.extract(infile, tmpdir_fastq, tool))
+                # add extraction command to statement unless the
+                # reads have been staged
+                if staged:
+                    statement.append(staged)
+                else:
+                    statement.append(Sra.extract(infile, tmpdir_fastq, tool))
 
                 sra_extraction_files = ["%s/%s" % (
                     tmpdir_fastq, os.path.basename(x)) for x in sorted(f)]
@@ -955,10 +1294,12 @@ class Mapper(SequenceCollectionProcessor):
         return ""
 
     def cleanup(self, outfile):
-        '''clean up.'''
-        statement = '''rm -rf %s;''' % (self.tmpdir_fastq)
+        '''clean up.
 
-        return statement
+        :attr:`tmpdir_fastq` is removed when the job exits, see
+        :func:`Pipeline.buildTempDirStatement`.
+        '''
+        return ""
 
     def build(self, infiles, outfile):
         '''run mapper
@@ -1005,6 +1346,184 @@ class Mapper(SequenceCollectionProcessor):
 
         return statement
 
+    def splitFastq(self, infiles, outdir, nshards):
+        '''build statement to split :term:`fastq` files into shards.
+
+        Reads are distributed across shards in turn so that all
+        shards are of the same size. Paired files are split in the
+        same way, thus keeping mates in the same shard.
+
+        Arguments
+        ---------
+        infiles : list
+            List of tuples of :term:`fastq` formatted files as returned
+            by :meth:`preprocess`.
+        outdir : string
+            Output directory for shards.
+        nshards : int
+            Number of shards.
+
+        Returns
+        -------
+        statement : string
+            The command line statement for splitting.
+        files : list
+            List of :term:`fastq` formatted files for each shard.
+        '''
+        if self.datatype != "fastq":
+            raise NotImplementedError(
+                "splitting is only implemented for fastq files, "
+                "not for %s" % self.datatype)
+
+        num_files = [len(x) for x in infiles]
+        if max(num_files) != min(num_files):
+            raise ValueError(
+                "mixing single and paired-ended data not possible.")
+        nfiles = max(num_files)
+
+        if nfiles == 1:
+            suffixes = [".fastq.gz"]
+        elif nfiles == 2:
+            suffixes = [".fastq.1.gz", ".fastq.2.gz"]
+        else:
+            raise ValueError(
+                "unexpected number of read files to split: %i " % nfiles)
+
+        statement = []
+        for files, suffix in zip(zip(*infiles), suffixes):
+            files = " ".join(files)
+            prefix = os.path.join(outdir, "shard")
+            statement.append('''zcat -f %(files)s
+            | awk -v n=%(nshards)i -v prefix=%(prefix)s
+            'NR %%%% 4 == 1 {shard = int((NR - 1) / 4) %%%% n}
+            {print | ("gzip -1 > " prefix shard "%(suffix)s")}'
+            ''' % locals())
+
+        shards = [[tuple([os.path.join(outdir, "shard%i%s" % (x, suffix))
+                          for suffix in suffixes])]
+                  for x in range(nshards)]
+
+        return "; checkpoint; ".join(statement) + ";", shards
+
+    def mergeShards(self, infiles, outfile):
+        '''build statement to merge the output of mapping shards.
+
+        The sorted :term:`bam` files are merged in a single streaming
+        pass into `outfile`. Other files created by the mapper, such
+        as log files, are concatenated.
+
+        Arguments
+        ---------
+        infiles : list
+            List of :term:`bam` formatted files, one for each shard.
+        outfile : string
+            Output filename in :term:`bam` format.
+
+        Returns
+        -------
+        statement : string
+            The command line statement for merging.
+        '''
+        bamfiles = " ".join(infiles)
+        first = infiles[0]
+        track = os.path.basename(outfile)
+        outdir = os.path.dirname(os.path.abspath(outfile))
+
+        # files with auxiliary output are named after the bam file
+        shard_prefixes = " ".join(
+            [os.path.join(os.path.dirname(x), "") for x in infiles])
+
+        statement = '''
+        for f in %(first)s?*; do
+            name=`basename $f`;
+            case $name in
+                %(track)s.bai) ;;
+                *) for p in %(shard_prefixes)s; do
+                       cat $p$name;
+                   done > %(outdir)s/$name ;;
+            esac;
+        done;
+        samtools merge -f %(outfile)s %(bamfiles)s
+        2>> %(outfile)s.log;
+        samtools index %(outfile)s;
+        ''' % locals()
+
+        return statement
+
+    def buildShards(self, infiles, outfile, nshards):
+        '''build statements to map reads in parallel.
+
+        The reads are split into `nshards` shards that are mapped
+        independently, see :meth:`splitFastq`. Each shard is mapped
+        and post-processed like a complete data set by :meth:`build`.
+        Finally the shards are merged, see :meth:`mergeShards`.
+
+        The shards are kept in the shared temporary directory so
+        that they can be accessed from different nodes.
+
+        Post-processing steps applied per shard need to be local to
+        each read such as removing non-unique matches or setting the
+        NH tag.
+
+        Arguments
+        ---------
+        infiles : list
+             List of input filenames
+        outfile : string
+             Output filename
+        nshards : int
+             Number of shards
+
+        Returns
+        -------
+        split_statement : string
+             Statement to pre-process input files and split
+             them into shards.
+        shard_statements : list
+             List of statements, one for each shard. These can be
+             run in parallel.
+        merge_statement : string
+             Statement to merge the output of all shards and
+             to remove the shards.
+        '''
+
+        sharddir = P.getTempDir(shared=True)
+
+        cmd_preprocess, mapfiles = self.preprocess(infiles, outfile)
+        cmd_split, shards = self.splitFastq(mapfiles, sharddir, nshards)
+        cmd_clean = self.cleanup(outfile)
+
+        split_statement = " checkpoint; ".join(
+            (cmd_preprocess, cmd_split, cmd_clean))
+
+        shard_statements, shard_outfiles = [], []
+        for x, shard in enumerate(shards):
+            shard_outfile = os.path.join(
+                sharddir, "shard%i.dir" % x, os.path.basename(outfile))
+
+            tmpdir_fastq = P.getJobTempDir()
+            self.tmpdir_fastq = tmpdir_fastq
+
+            cmd_preprocess = "%s; mkdir -p %s;" % (
+                P.buildTempDirStatement(tmpdir_fastq),
+                os.path.dirname(shard_outfile))
+            cmd_mapper = self.mapper(shard, shard_outfile)
+            cmd_postprocess = self.postprocess(infiles, shard_outfile)
+            cmd_clean = "rm -f %s;" % " ".join(shard[0])
+
+            shard_statements.append(" checkpoint; ".join(
+                [cmd for cmd in (cmd_preprocess,
+                                 cmd_mapper,
+                                 cmd_postprocess,
+                                 cmd_clean) if cmd]))
+            shard_outfiles.append(shard_outfile)
+
+        merge_statement = " checkpoint; ".join(
+            (self.mergeShards(shard_outfiles, outfile),
+             "rm -rf %s;" % sharddir))
+
+        return split_statement, shard_statements, merge_statement
+
 
 class FastQc(Mapper):
     """run the FastQC_ tool.
@@ -1099,6 +1618,59 @@ class FastQc(Mapper):
         return " ".join(statement)
 
 
+class FastqStats(FastQc):
+    """compute read statistics with :file:`cgat_fastq_stats.py`.
+
+    The statistics are output in the same format as FastQC_ output
+    and can be loaded in the same way. No html report or plots are
+    created.
+
+    Arguments
+    ---------
+    threads : int
+        Number of worker processes per input file.
+    nogroup : bool
+        If True, do not group positions.
+
+    """
+
+    def __init__(self,
+                 threads=1,
+                 nogroup=False,
+                 *args, **kwargs):
+        FastQc.__init__(self, *args, **kwargs)
+        self.threads = threads
+        self.nogroup = nogroup
+
+    def mapper(self, infiles, outfile):
+        '''build statement computing statistics for all files in
+        `infiles`.'''
+
+        contaminants = self.contaminants
+        outdir = self.outdir
+        threads = self.threads
+        filenames = " ".join([x for f in infiles for x in f])
+
+        options = []
+        if contaminants:
+            options.append("--contaminants=%s" % contaminants)
+        if self.nogroup:
+            options.append("--nogroup")
+        options = " ".join(options)
+
+        statement = '''python %%(pipeline_scriptsdir)s/cgat_fastq_stats.py
+        --outdir=%(outdir)s
+        --threads=%(threads)i
+        %(options)s
+        %(filenames)s
+        > %(outfile)s ;''' % locals()
+
+        if contaminants:
+            statement += " rm -f %(contaminants)s ;" % locals()
+
+        return statement
+
+
 class FastqScreen(Mapper):
     '''run Fastq_screen to test contamination by other organisms.'''
 
@@ -1322,8 +1894,7 @@ class Kallisto(Mapper):
 
     def cleanup(self, outfile):
         '''clean up.'''
-        statement = '''rm -rf %s; rm -rf %s;''' % (
-            self.tmpdir_fastq, self.tmpdir)
+        statement = '''rm -rf %s;''' % self.tmpdir
 
         return statement
 
@@ -1348,44 +1919,83 @@ class Counter(Mapper):
         return " ".join(statement)
 
 
-class SubsetHead(Mapper):
-    """subset fastq files by taking the first n sequences"""
+class Subset(Mapper):
+    """subset fastq files.
+
+    Samples of reads are taken with :file:`cgat_fastq_sample.py` in a
+    single pass through the data. Paired-end data are sampled in sync.
+
+    Arguments
+    ---------
+    limits : list
+        Sample sizes in number of reads or read pairs.
+    seed : int
+        Seed for the random number generator. Set to obtain
+        reproducible random samples.
+    """
 
     compress = True
 
-    def __init__(self, limit=1000000, *args, **kwargs):
+    # sampling method, see cgat_fastq_sample.py
+    method = None
+
+    # suffix of sentinel output file
+    suffix = None
+
+    def __init__(self, limits=[1000000], seed=None, *args, **kwargs):
         Mapper.__init__(self, *args, **kwargs)
-        self.limit = limit
+        self.limits = limits
+        self.seed = seed
 
     def mapper(self, infiles, outfile):
-        '''count number of reads by counting number of lines
-        in fastq files.
+        '''build statement to sample reads from infiles.
+
+        Output files are named after `outfile`.
         '''
-        limit = self.limit * 4  # 4 lines per fastq entry
-        statement = []
-        output_prefix = P.snip(outfile, ".subset")
+        output_prefix = P.snip(outfile, self.suffix)
         assert len(infiles) == 1
         infiles = infiles[0]
+
+        # "%%" as statement is interpolated by P.run()
+        if len(self.limits) > 1:
+            output_prefix += "_%%(sample)i"
         if len(infiles) == 1:
-            output_filename = output_prefix + ".fastq.gz"
-            f = infiles[0]
-            statement.append(
-                '''zcat %(f)s
-                | awk 'NR > %(limit)i {exit} {print}'
-                | gzip
-                > %(output_filename)s;''' % locals())
-        elif len(infiles) > 1:
-            for x, f in enumerate(infiles):
-                output_filename = output_prefix + ".fastq.%i.gz" % (x + 1)
-                statement.append(
-                    '''zcat %(f)s
-                    | awk 'NR > %(limit)i {exit} {print}'
-                    | gzip
-                    > %(output_filename)s;''' % locals())
-        return " ".join(statement)
+            output_pattern = output_prefix + ".fastq.gz"
+        else:
+            output_pattern = output_prefix + ".fastq.%%(mate)i.gz"
+
+        method = self.method
+        limits = ",".join(map(str, self.limits))
+        if self.seed is not None:
+            seed_option = "--seed=%i" % self.seed
+        else:
+            seed_option = ""
+        infiles = " ".join(infiles)
+
+        statement = '''python %%(pipeline_scriptsdir)s/cgat_fastq_sample.py
+        --method=%(method)s
+        --sample-size=%(limits)s
+        %(seed_option)s
+        --output-filename-pattern="%(output_pattern)s"
+        --log=%(outfile)s.log
+        %(infiles)s;''' % locals()
+
+        return statement
+
 
+class SubsetHead(Subset):
+    """subset fastq files by taking the first n sequences"""
+
+    method = "head"
 
-class SubsetHeads(Mapper):
+    suffix = ".subset"
+
+    def __init__(self, limit=1000000, *args, **kwargs):
+        Subset.__init__(self, [limit], *args, **kwargs)
+        self.limit = limit
+
+
+class SubsetHeads(Subset):
     """subset fastq files by taking the first n sequences.
 
     This differs from SubsetHeads in that list of limits is passed
@@ -1395,103 +2005,53 @@ class SubsetHeads(Mapper):
     A single file can then be parsed once and subsetted to multiple
     outfiles"""
 
-    compress = True
+    method = "head"
 
-    def __init__(self, limits=[1000000], *args, **kwargs):
-        Mapper.__init__(self, *args, **kwargs)
-        self.limits = limits
-
-    def mapper(self, infiles, outfile):
-        '''count number of reads by counting number of lines
-        in fastq files.
-        '''
-
-        limits = [x * 4 for x in sorted(self.limits)]  # 4 lines per fastq entry
-        output_prefix = P.snip(outfile, ".sentinel")
-        assert len(infiles) == 1
-        infiles = infiles[0]
-        statement = []
-        if len(infiles) == 1:
-            f = infiles[0]
-            awk_cmd = ""
-            for n, ix in enumerate(range(0, len(limits))):
-                limit = limits[ix]
-                output_filename = output_prefix + "_%i.fastq.gz" % n
-                awk_cmd += '''{if (NR<%(limit)s) print |
-                "gzip > %(output_filename)s"};''' % locals()
-            awk_cmd += '{if (NR>%s) {exit}};' % limits[-1]
+    suffix = ".sentinel"
 
-            statement.append(
-                """zcat %(f)s| awk '%(awk_cmd)s';""" % locals())
-
-        elif len(infiles) > 1:
-            for x, f in enumerate(infiles):
-                awk_cmd = ""
-                for n, ix in enumerate(range(0, len(limits))):
-                    limit = limits[ix]
-                    output_filename = output_prefix + "_%i.fastq.%i.gz" % (n, x + 1)
-                    awk_cmd += '''{if (NR<%(limit)s) print |
-                    "gzip > %(output_filename)s"};''' % locals()
-                awk_cmd += '{if (NR>%s) {exit}};' % limits[-1]
+    def __init__(self, limits=[1000000], *args, **kwargs):
+        Subset.__init__(self, sorted(limits), *args, **kwargs)
 
-                statement.append(
-                    """zcat %(f)s| awk '%(awk_cmd)s';""" % locals())
 
-        return " ".join(statement)
+class SubsetRandom(Subset):
+    """subset fastq files by taking a random n sequences.
 
+    Set `seed` to obtain reproducible samples.
+    """
 
-class SubsetRandom(Mapper):
-    """subset fastq files by taking a random n sequences"""
+    method = "random"
 
-    compress = True
+    suffix = ".subset"
 
     def __init__(self, limit=1000000, *args, **kwargs):
-        Mapper.__init__(self, *args, **kwargs)
+        Subset.__init__(self, [limit], *args, **kwargs)
         self.limit = limit
 
-    def mapper(self, infiles, outfile):
-        '''count number of reads by counting number of lines
-        in fastq files.
-        '''
-        limit = self.limit * 4  # 4 lines per fastq entry
-        statement = []
-        output_prefix = P.snip(outfile, ".subset")
-        assert len(infiles) == 1
-        infiles = infiles[0]
-
-        # check if single or paired end
-        if len(infiles) == 1:
-            fastq = infiles[0]
-            statement = """
-            zcat %(fastq1)s |
-            paste - - - - |
-            sort -R |
-            awk -F'\\t'  'NR > %(limit)i {exit} {OFS="\\n";
-            print $1,$3,$5,$7 | "gzip > %(output_prefix)s.fastq.gz}"}';
-            """ % locals()
-
-        if len(infiles) == 2:
-            fastq1, fastq2 = infiles
-            statement = """
-            paste <(zcat %(fastq1)s) <(zcat %(fastq2)s) |
-            paste - - - - |
-            sort -R |
-            awk -F'\\t'  'NR > %(limit)i {exit} {OFS="\\n";
-            print $1,$3,$5,$7 | "gzip > %(output_prefix)s.fastq.1.gz";
-            print $2,$4,$6,$8 | "gzip > %(output_prefix)s.fastq.2.gz"}';
-            """ % locals()
-
-        return statement
-
 
 class BWA(Mapper):
-    '''Mapper for BWA'''
+    '''Mapper for BWA
+
+    Arguments
+    ---------
+    set_nh : bool
+        If True, set the NH tag in postprocessing.
+    sort_threads : int
+        Number of threads for sorting in postprocessing.
+    sort_memory : string
+        Maximum memory per sorting thread. Reads are sorted in
+        chunks of this size that are merged afterwards.
+    '''
 
     def __init__(self,
-                 set_nh=False, *args, **kwargs):
+                 set_nh=False,
+                 sort_threads=1,
+                 sort_memory="768M",
+                 *args, **kwargs):
         Mapper.__init__(self, *args, **kwargs)
 
         self.set_nh = set_nh
+        self.sort_threads = sort_threads
+        self.sort_memory = sort_memory
 
     def mapper(self, infiles, outfile):
         '''
@@ -1612,34 +2172,42 @@ class BWA(Mapper):
         # note, this postprocess method is inherited by multiple mappers
 
         track = P.snip(os.path.basename(outfile), ".bam")
-        outf = P.snip(outfile, ".bam")
         tmpdir = self.tmpdir
+        sort_threads = self.sort_threads
+        sort_memory = self.sort_memory
 
-        strip_cmd, unique_cmd, set_nh_cmd = "", "", ""
-
+        # all filtering is done in a single pass that outputs
+        # uncompressed bam directly into the sort
+        options = []
         if self.remove_non_unique:
-            unique_cmd = '''| python %%(scriptsdir)s/bam2bam.py
-            --method=filter
-            --filter-method=unique,mapped
-            --log=%(outfile)s.log''' % locals()
-
+            options.append("--method=remove-non-unique")
         if self.strip_sequence:
-            strip_cmd = '''| python %%(scriptsdir)s/bam2bam.py
-            --strip-method=all
-            --method=strip-sequence
-            --log=%(outfile)s.log''' % locals()
-
+            options.append("--method=strip-sequence")
         if self.set_nh:
-            set_nh_cmd = '''| python %%(scriptsdir)s/bam2bam.py
-            --method=set-nh
-            --log=%(outfile)s.log''' % locals()
+            options.append("--method=set-nh")
+
+        if options:
+            options = " ".join(options)
+            postprocess_cmd = '''python
+            %%(pipeline_scriptsdir)s/cgat_bam_postprocess.py
+            %(options)s
+            --log=%(outfile)s.log
+            < %(tmpdir)s/%(track)s.bam |''' % locals()
+            sort_input = "-"
+        else:
+            postprocess_cmd = ""
+            sort_input = "%(tmpdir)s/%(track)s.bam" % locals()
 
         statement = '''
-                cat %(tmpdir)s/%(track)s.bam
-                %(unique_cmd)s
-                %(strip_cmd)s
-                %(set_nh_cmd)s
-                | samtools sort -o %(outfile)s 2>>%(outfile)s.bwa.log;
+                %(postprocess_cmd)s
+                samtools sort
+                -@ %(sort_threads)i
+                -m %(sort_memory)s
+                -T %(tmpdir)s/%(track)s.sort
+                -o %(outfile)s
+                %(sort_input)s
+                2>>%(outfile)s.bwa.log;
+                checkpoint;
                 samtools index %(outfile)s;''' % locals()
 
         return statement
@@ -2065,7 +2633,7 @@ class Butter(BWA):
         return " ".join(statement)
 
     def cleanup(self, outfile):
-        statement = '''rm -rf %s %s;''' % (self.tmpdir_fastq, self.tmpdir)
+        statement = '''rm -rf %s;''' % self.tmpdir
 
         return statement
 
@@ -2605,6 +3173,18 @@ class Hisat(Mapper):
 
         return statement
 
+    def mergeShards(self, infiles, outfile):
+        '''build statement to merge the output of mapping shards.
+
+        In addition to :meth:`Mapper.mergeShards`, duplicate entries
+        are removed from the list of novel junctions.
+        '''
+        statement = Mapper.mergeShards(self, infiles, outfile)
+        statement += '''
+        sort -u -o %(outfile)s_novel_junctions %(outfile)s_novel_junctions;
+        ''' % locals()
+        return statement
+
 
 class GSNAP(Mapper):
     ''' Mapper for GSNAP'''
@@ -2922,6 +3502,58 @@ class STAR(Mapper):
 
         return statement
 
+    def mergeShards(self, infiles, outfile):
+        '''build statement to merge the output of mapping shards.
+
+        In addition to :meth:`Mapper.mergeShards`, the junction
+        counts and the summary statistics of the shards are
+        combined. In the summary, counts and mapping speeds are
+        summed and other numeric values such as rates or lengths are
+        averaged weighted by the number of input reads in each shard.
+        '''
+        statement = Mapper.mergeShards(self, infiles, outfile)
+
+        final_logs = " ".join([x + ".final.log" for x in infiles])
+        junctions = " ".join([x + ".junctions" for x in infiles])
+
+        # not interpolated locally, "%%" is required by P.run()
+        merge_log = '''awk -F "|"
+        'FNR == 1 {nfiles++}
+        NF != 2 {if (nfiles == 1) {lines[++n] = $0}; next}
+        {key = $1; raw = $2; value = raw;
+         gsub(/^[ \\t]+|[ \\t%%]+$/, "", value);
+         if (nfiles == 1) {lines[++n] = key; iskey[n] = 1; first[key] = raw}
+         if (key ~ /Finished on/) {first[key] = raw}
+         if (value !~ /^[0-9.]+$/) {next}
+         if (key ~ /Number of input reads/) {weight = value; total += value}
+         if (key ~ /[Nn]umber|speed/) {sum[key] += value}
+         else {wsum[key] += value * weight}}
+        END {for (i = 1; i <= n; i++) {
+             if (!iskey[i]) {print lines[i]; continue}
+             key = lines[i]; value = first[key];
+             if (key in sum) {value = sum[key]}
+             else if (key in wsum && total > 0) {
+                 value = int(100 * wsum[key] / total + 0.5) / 100}
+             else {gsub(/^[ \\t]+|[ \\t]+$/, "", value)}
+             if (first[key] ~ /%%$/ && value !~ /%%$/) {value = value "%%"}
+             print key "|\\t" value}}'
+        '''
+
+        statement += '''
+        %(merge_log)s %(final_logs)s > %(outfile)s.final.log;
+        cat %(junctions)s
+        | awk -v OFS="\\t"
+        '{key = $1 OFS $2 OFS $3 OFS $4 OFS $5 OFS $6;
+          unique[key] += $7; multi[key] += $8;
+          if ($9 > overhang[key]) {overhang[key] = $9}}
+        END {for (key in unique) {
+             print key, unique[key], multi[key], overhang[key]}}'
+        | sort -k1,1 -k2,2n
+        > %(outfile)s.junctions;
+        ''' % locals()
+
+        return statement
+
 
 class Bowtie(Mapper):
     '''Mapper for Bowtie'''
@@ -3530,6 +4162,6 @@ class Shortstack(Bowtie):
         return statement
 
     def cleanup(self, outfile):
-        statement = '''rm -rf %s %s;''' % (self.tmpdir_fastq, self.tmpdir)
+        statement = '''rm -rf %s;''' % self.tmpdir
 
         return statement
@@ -16,6 +16,9 @@ import CGATPipelines.Pipeline as P
 
 PICARD_MEMORY = "5G"
 
+# set from calling module
+PARAMS = {}
+
 
 def getNumReadsFromReadsFile(infile):
     '''get number of reads from a .nreads file.'''
@@ -569,6 +572,175 @@ def buildBAMStats(infile, outfile):
     P.run()
 
 
+class BAMQCMetric(object):
+    '''a metric computed from a stream of alignments.
+
+    Metrics are used by :func:`buildSinglePassBAMQC`. Derived classes
+    define :attr:`template`, a command that reads a :term:`BAM`
+    formatted stream from stdin and writes the same output files as
+    the corresponding stand-alone task. The template is interpolated
+    with the configuration parameters and the attributes of the
+    metric.
+
+    Arguments
+    ---------
+    outfile : string
+        Output filename of the metric.
+    '''
+
+    template = None
+    job_memory = "1G"
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def buildCommand(self):
+        '''return command reading a :term:`BAM` stream from stdin.'''
+        if self.template is None:
+            raise NotImplementedError(
+                "metric %s does not define a template" %
+                self.__class__.__name__)
+        return P.buildStatement(statement=self.template, **self.__dict__)
+
+
+class PicardAlignmentMetric(BAMQCMetric):
+    '''picard:CollectMultipleMetrics, see
+    :func:`buildPicardAlignmentStats`.'''
+
+    template = '''python %(scriptsdir)s/bam2bam.py -v 0
+    --method=set-sequence --output-sam
+    | CollectMultipleMetrics
+    INPUT=/dev/stdin
+    REFERENCE_SEQUENCE=%(genome_file)s
+    ASSUME_SORTED=true
+    OUTPUT=%(outfile)s
+    VALIDATION_STRINGENCY=SILENT
+    >& %(outfile)s'''
+
+    job_memory = PICARD_MEMORY
+
+    def __init__(self, outfile, genome_file):
+        BAMQCMetric.__init__(self, outfile)
+        self.genome_file = genome_file
+
+
+class BAMStatsMetric(BAMQCMetric):
+    '''bam2stats.py, see :func:`buildBAMStats`.
+
+    Arguments
+    ---------
+    outfile : string
+        Output filename.
+    options : string
+        Additional options for bam2stats.py.
+    '''
+
+    template = '''python %(scriptsdir)s/bam2stats.py
+    %(options)s
+    --force-output
+    --output-filename-pattern=%(outfile)s.%%s
+    > %(outfile)s'''
+
+    def __init__(self, outfile, options="", job_memory="1G"):
+        BAMQCMetric.__init__(self, outfile)
+        self.options = options
+        self.job_memory = job_memory
+
+
+class ExonValidationMetric(BAMQCMetric):
+    '''bam_vs_gtf.py, compare alignments to exon models.
+
+    Arguments
+    ---------
+    outfile : string
+        Output filename, will be compressed.
+    exons_file : string
+        Filename with exons in :term:`gtf` format.
+    '''
+
+    template = '''python %(scriptsdir)s/bam_vs_gtf.py
+    --exons-file=%(exons_file)s
+    --force-output
+    --log=%(outfile)s.log
+    --output-filename-pattern="%(outfile)s.%%s.gz"
+    | gzip
+    > %(outfile)s'''
+
+    def __init__(self, outfile, exons_file):
+        BAMQCMetric.__init__(self, outfile)
+        self.exons_file = exons_file
+
+
+def buildSinglePassBAMQC(infile, metrics, outfile):
+    '''compute several metrics in a single pass through a BAM file.
+
+    The BAM file is decompressed once with multiple threads and the
+    uncompressed stream is copied to each metric through a named
+    pipe. Each metric writes the same output files as if it had been
+    run separately, so that the existing load functions such as
+    :func:`loadPicardAlignmentStats` and :func:`loadBAMStats` can be
+    applied to the output.
+
+    Metrics requiring random access to the BAM file such as
+    picard:MarkDuplicates can not be computed in this way.
+
+    The job fails if decompressing the BAM file or any of the metrics
+    fails. `outfile` is only created after all metrics have completed
+    successfully.
+
+    Arguments
+    ---------
+    infile : string
+        Input filename in :term:`BAM` format.
+    metrics : list
+        List of :class:`BAMQCMetric` objects.
+    outfile : string
+        Output filename. The file contains the list of metric
+        output files.
+    '''
+
+    if BamTools.getNumReads(infile) == 0:
+        E.warn("no reads in %s - no metrics" % infile)
+        for metric in metrics:
+            P.touch(metric.outfile)
+        P.touch(outfile)
+        return
+
+    tmpdir = P.getJobTempDir()
+
+    # decompression threads and one thread per metric
+    decompression_threads = PARAMS.get("qc_decompression_threads", 2)
+    job_threads = decompression_threads + len(metrics)
+    job_memory = "%iM" % (
+        sum([IOTools.human2bytes(x.job_memory) for x in metrics]) //
+        (1024 * 1024 * job_threads) + 1)
+
+    # escape "%" as statement is interpolated again by P.run()
+    statement = [P.buildTempDirStatement(tmpdir)]
+    fifos = []
+    for x, metric in enumerate(metrics):
+        fifo = os.path.join(tmpdir, "metric%i" % x)
+        fifos.append(fifo)
+        statement.append("mkfifo %s" % fifo)
+        # pipefail so that errors anywhere in a metric are reported
+        statement.append(
+            "( set -o pipefail; %s ) < %s & CGAT_PIDS=\"$CGAT_PIDS $!\"" %
+            (metric.buildCommand().replace("%", "%%"), fifo))
+
+    statement.append(
+        "samtools view -h -u -@ %i %s | tee %s > /dev/null" %
+        (decompression_threads, infile, " ".join(fifos)))
+    statement.append(
+        "for pid in $CGAT_PIDS; do wait $pid || exit 1; done")
+    statement.append(
+        "echo %s > %s" % (" ".join([x.outfile for x in metrics]), outfile))
+    # stop if decompression fails, as the metrics will then have
+    # received a partial stream
+    statement = "; checkpoint; ".join(statement)
+
+    P.run()
+
+
 def loadBAMStats(infiles, outfile):
     '''load output of :func:`buildBAMStats` into database.
 
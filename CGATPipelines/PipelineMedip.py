@@ -6,10 +6,10 @@ PipelineMedip.py - tasks associated with MedipSeq analysis
 
 import re
 import os
-import collections
 
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
+import CGATPipelines.PipelineDEStats as PipelineDEStats
 
 import CGAT.Database as Database
 import CGAT.IOTools as IOTools
@@ -64,85 +64,27 @@ def buildDMRStats(tables, method, outfile, dbhandle):
         prefix = P.snip(tablename, "_%s" % method)
         tileset, design = prefix.split("_")
 
-        def toDict(vals, l=2):
-            return collections.defaultdict(
-                int, [(tuple(x[:l]), x[l]) for x in vals])
-
         E.info("collecting data from %s" % tablename)
 
-        tested = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, COUNT(*)
-            FROM %(tablename)s 
-            GROUP BY treatment_name,control_name""" % locals()).fetchall())
-        status = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, status,
-            COUNT(*) FROM %(tablename)s 
-            GROUP BY treatment_name,control_name,status""" %
-            locals()).fetchall(), 3)
-        signif = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name,
-            COUNT(*) FROM %(tablename)s 
-            WHERE significant
-            GROUP BY treatment_name,control_name""" %
-            locals()).fetchall())
-        fold2 = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name,
-            COUNT(*) FROM %(tablename)s
-            WHERE (l2fold >= 1 or l2fold <= -1) AND significant
-            GROUP BY treatment_name,control_name,significant""" %
-            locals()).fetchall())
-        up = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, COUNT(*)
-            FROM %(tablename)s 
-            WHERE l2fold > 0 AND significant
-            GROUP BY treatment_name,control_name,significant""" %
-            locals()).fetchall())
-
-        down = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, COUNT(*)
-            FROM %(tablename)s 
-            WHERE l2fold < 0 AND significant
-            GROUP BY treatment_name,control_name,significant""" %
-            locals()).fetchall())
-
-        fold2up = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, COUNT(*)
-            FROM %(tablename)s 
-            WHERE l2fold > 1 AND significant
-            GROUP BY treatment_name,control_name,significant""" %
-            locals()).fetchall())
-
-        fold2down = toDict(Database.executewait(
-            dbhandle,
-            """SELECT treatment_name, control_name, COUNT(*)
-            FROM %(tablename)s 
-            WHERE l2fold < -1 AND significant
-            GROUP BY treatment_name,control_name,significant""" %
-            locals()).fetchall())
-        
-        groups = tested.keys()
-
-        for treatment_name, control_name in groups:
+        counts, status = PipelineDEStats.getTestSummary(
+            PipelineDEStats.summarizeDETable(dbhandle, tablename))
+
+        for treatment_name, control_name in counts.index:
             k = (treatment_name, control_name)
+            r = counts.loc[k]
             outf.write("\t".join(map(str, (
                 tileset,
                 design,
                 treatment_name,
                 control_name,
-                tested[k],
-                "\t".join([str(status[(treatment_name, control_name, x)])
+                r["tested"],
+                "\t".join([str(status.loc[k].get(x, 0))
                           for x in keys_status]),
-                signif[(k)],
-                up[k], down[k],
-                fold2[k],
-                fold2up[k], fold2down[k]))) + "\n")
+                r["significant"],
+                r["significant_up"], r["significant_down"],
+                r["twofold"],
+                r["significant_l2fold_up"],
+                r["significant_l2fold_down"]))) + "\n")
 
         ###########################################
         ###########################################
@@ -45,6 +45,7 @@ import re
 import glob
 import os
 import collections
+import multiprocessing
 import sqlite3
 import numpy
 import pysam
@@ -207,6 +208,158 @@ def getPeakShift(filename):
         return getPeakShiftFromSPP("%s.spp" % filename)
 
 
+def _mergeRanges(starts, ends):
+    '''merge overlapping or book-ended ranges.
+
+    Arguments
+    ---------
+    starts : numpy.array
+        Start coordinates of ranges.
+    ends : numpy.array
+        End coordinates of ranges.
+
+    Returns
+    -------
+    starts : numpy.array
+        Sorted start coordinates of merged ranges.
+    ends : numpy.array
+        End coordinates of merged ranges.
+    '''
+    order = numpy.argsort(starts, kind="mergesort")
+    starts, ends = starts[order], ends[order]
+    reach = numpy.maximum.accumulate(ends)
+    first = numpy.ones(len(starts), dtype=numpy.bool_)
+    first[1:] = starts[1:] > reach[:-1]
+    first = numpy.flatnonzero(first)
+    last = numpy.append(first[1:], len(starts)) - 1
+    return starts[first], reach[last]
+
+
+def _compressCoordinates(positions, seg_starts, seg_ends, seg_offsets):
+    '''map genomic coordinates onto the concatenation of segments.
+
+    Positions before, between or after segments are mapped onto the
+    start of the next segment, so that tag extents are clipped to the
+    segments.
+    '''
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    index = numpy.searchsorted(seg_ends, positions, side="right")
+    inside = numpy.minimum(index, len(seg_starts) - 1)
+    result = seg_offsets[inside] + numpy.clip(
+        positions - seg_starts[inside], 0, seg_ends[inside] - seg_starts[inside])
+    result[index == len(seg_starts)] = seg_offsets[-1]
+    return result
+
+
+def getTagExtents(samfiles, contig, starts, ends, offsets=None):
+    '''collect the extents of all tags within a set of regions.
+
+    Each region is fetched once and reads overlapping two regions
+    are only reported for the first region.
+
+    If an offset is given for a file, tags are shifted by `offset` /
+    2 and extended by `offset` / 2. Without offset, the read itself
+    is used.
+
+    Arguments
+    ---------
+    samfiles : list
+        List of pysam file handles to :term:`bam` formatted files.
+    contig : string
+        Chromosome
+    starts : numpy.array
+        Sorted start coordinates of non-overlapping regions, 0-based
+    ends : numpy.array
+        End coordinates of regions, 0-based
+    offsets : list
+        Peak shifts to apply to reads
+
+    Returns
+    -------
+    tag_starts : numpy.array
+        Start coordinates of tags.
+    tag_ends : numpy.array
+        End coordinates of tags.
+    '''
+    offsets = offsets or [0] * len(samfiles)
+    assert len(samfiles) == len(offsets)
+
+    tag_starts, tag_ends = [], []
+    for samfile, offset in zip(samfiles, offsets):
+        reads = []
+        last_end = 0
+        for start, end in zip(starts, ends):
+            for read in samfile.fetch(contig, start, end):
+                # some unmapped reads might have a position
+                if read.is_unmapped or read.pos < last_end:
+                    continue
+                reads.append((read.pos, read.aend, read.rlen,
+                              read.is_reverse))
+            last_end = end
+
+        reads = numpy.array(reads, dtype=numpy.int64).reshape((-1, 4))
+        pos, aend, rlen, is_reverse = reads.T
+
+        if offset:
+            # for peak counting I follow the MACS protocoll,
+            # see the function def __tags_call_peak in PeakDetect.py
+            # In words
+            # Only take the start of reads (taking into account the strand)
+            # add d/2=offset to each side of peak and start accumulate counts.
+            # for counting, extend reads by offset
+            # on + strand shift tags upstream
+            # i.e. look at the downstream window
+            shift = offset // 2
+            tag_start = numpy.where(is_reverse, aend - offset, pos + shift)
+            tag_end = tag_start + shift
+        else:
+            tag_start, tag_end = pos, pos + rlen
+
+        tag_starts.append(tag_start)
+        tag_ends.append(tag_end)
+
+    tag_starts = numpy.concatenate(tag_starts)
+    tag_ends = numpy.concatenate(tag_ends)
+    keep = tag_ends > tag_starts
+    return tag_starts[keep], tag_ends[keep]
+
+
+def buildCoverage(tag_starts, tag_ends, seg_starts, seg_ends):
+    '''compute tag coverage across a set of segments.
+
+    Coverage is computed with a difference array over the
+    concatenated segments.
+
+    Arguments
+    ---------
+    tag_starts : numpy.array
+        Start coordinates of tags.
+    tag_ends : numpy.array
+        End coordinates of tags.
+    seg_starts : numpy.array
+        Sorted start coordinates of non-overlapping segments.
+    seg_ends : numpy.array
+        End coordinates of segments.
+
+    Returns
+    -------
+    coverage : numpy.array
+        Tag coverage of the concatenated segments.
+    seg_offsets : numpy.array
+        Position of each segment within `coverage`. The last
+        element is the total length.
+    '''
+    seg_offsets = numpy.zeros(len(seg_starts) + 1, dtype=numpy.int64)
+    numpy.cumsum(seg_ends - seg_starts, out=seg_offsets[1:])
+    total = seg_offsets[-1]
+    diff = numpy.bincount(
+        _compressCoordinates(tag_starts, seg_starts, seg_ends, seg_offsets),
+        minlength=total + 1) - numpy.bincount(
+        _compressCoordinates(tag_ends, seg_starts, seg_ends, seg_offsets),
+        minlength=total + 1)
+    return numpy.cumsum(diff[:total]).astype(numpy.float64), seg_offsets
+
+
 def getCounts(contig, start, end, samfiles, offsets=[]):
     '''count number of reads within a genomic interval
 
@@ -235,49 +388,158 @@ def getCounts(contig, start, end, samfiles, offsets=[]):
     '''
     assert len(offsets) == 0 or len(samfiles) == len(offsets)
 
-    length = end - start
-    counts = numpy.zeros(length)
+    pad = max(offsets or [0])
+    tag_starts, tag_ends = getTagExtents(
+        samfiles, contig,
+        [max(0, start - pad)], [end + pad],
+        offsets)
+    nreads = numpy.sum((tag_starts < end) & (tag_ends > start))
+    counts, seg_offsets = buildCoverage(
+        tag_starts, tag_ends,
+        numpy.array([start]), numpy.array([end]))
+    return nreads, counts
 
-    nreads = 0
 
-    if offsets:
-        # if offsets are given, shift tags.
-        for samfile, offset in zip(samfiles, offsets):
+def _peakStatistics(coverage, positions, starts, lengths):
+    '''compute peak parameters for a batch of intervals.
 
-            shift = offset / 2
-            # for peak counting I follow the MACS protocoll,
-            # see the function def __tags_call_peak in PeakDetect.py
-            # In words
-            # Only take the start of reads (taking into account the strand)
-            # add d/2=offset to each side of peak and start accumulate counts.
-            # for counting, extend reads by offset
-            # on + strand shift tags upstream
-            # i.e. look at the downstream window
-            xstart, xend = max(0, start - shift), max(0, end + shift)
+    `positions` are the locations of the intervals within `coverage`.
+    '''
+    nintervals = len(starts)
+    labels = numpy.repeat(numpy.arange(nintervals), lengths)
+    bounds = numpy.zeros(nintervals, dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=bounds[1:])
+    within = numpy.arange(len(labels)) - bounds[labels]
+    values = coverage[positions[labels] + within]
 
-            for read in samfile.fetch(contig, xstart, xend):
-                # some unmapped reads might have a position
-                if read.is_unmapped:
-                    continue
-                if read.is_reverse:
-                    # offset = 2 * shift
-                    rstart = read.pos + read.alen - offset
-                else:
-                    rstart = read.pos + shift
+    peakval = numpy.maximum.reduceat(values, bounds)
+    avgval = numpy.add.reduceat(values, bounds) / lengths
 
-                rend = rstart + shift
-                rstart = max(0, rstart - start)
-                rend = min(length, rend - start)
-                counts[rstart:rend] += 1
+    # peakcenter is median coordinate between peaks
+    # such that it is a valid peak in the middle
+    is_peak = values >= peakval[labels]
+    npeaks = numpy.bincount(labels[is_peak], minlength=nintervals)
+    rank = numpy.cumsum(is_peak) - 1
+    before = numpy.zeros(nintervals, dtype=numpy.int64)
+    numpy.cumsum(npeaks[:-1], out=before[1:])
+    is_center = is_peak & (rank - before[labels] == npeaks[labels] // 2)
+    peakcenter = starts + within[is_center]
+
+    return npeaks, peakcenter, avgval, peakval
+
+
+def _checkIntervals(contig, starts, ends):
+    '''return interval coordinates as arrays.'''
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    if numpy.any(ends <= starts):
+        raise ValueError(
+            "intervals of non-positive length on contig %s" % contig)
+    return starts, ends
+
+
+def _countPeaksInSegments(coverage, seg_starts, seg_ends, seg_offsets,
+                          starts, ends, tag_starts=None, tag_ends=None,
+                          chunk_size=10000000):
+    '''compute peak parameters for intervals within segments.
+
+    `coverage` is the tag coverage of the concatenated segments and
+    `tag_starts` and `tag_ends` are the sorted start and end
+    coordinates of tags.
+    '''
+    lengths = ends - starts
+    npeaks = numpy.zeros(len(starts), dtype=numpy.int64)
+    peakcenter = numpy.zeros(len(starts), dtype=numpy.int64)
+    avgval = numpy.zeros(len(starts))
+    peakval = numpy.zeros(len(starts))
+    nreads = numpy.zeros(len(starts), dtype=numpy.int64)
+
+    if len(starts) == 0:
+        return npeaks, peakcenter, lengths, avgval, peakval, nreads
+
+    positions = _compressCoordinates(
+        starts, seg_starts, seg_ends, seg_offsets)
+
+    if tag_starts is not None:
+        nreads = numpy.searchsorted(tag_starts, ends, side="left") - \
+            numpy.searchsorted(tag_ends, starts, side="right")
+
+    cumlengths = numpy.cumsum(lengths)
+    first = 0
+    while first < len(starts):
+        # always include at least one interval
+        last = max(first + 1, numpy.searchsorted(
+            cumlengths, cumlengths[first] - lengths[first] + chunk_size,
+            side="right"))
+        batch = slice(first, last)
+        (npeaks[batch], peakcenter[batch],
+         avgval[batch], peakval[batch]) = _peakStatistics(
+             coverage, positions[batch], starts[batch], lengths[batch])
+        first = last
+
+    return npeaks, peakcenter, lengths, avgval, peakval, nreads
+
+
+def countPeaksOnContig(contig, starts, ends, samfiles, offsets=None,
+                       chunk_size=10000000):
+    '''compute peak parameters for all intervals on a contig.
+
+    Tags are collected once for all intervals and the tag coverage
+    is built in a single pass. Peak parameters are then computed for
+    batches of intervals with a total length of up to `chunk_size`.
 
-    else:
-        for samfile in samfiles:
-            for read in samfile.fetch(contig, start, end):
-                nreads += 1
-                rstart = max(0, read.pos - start)
-                rend = min(length, read.pos - start + read.rlen)
-                counts[rstart:rend] += 1
-    return nreads, counts
+    If offsets are given, tags are shifted by `offset` / 2 and
+    extended by `offset` / 2.
+
+    Arguments
+    ---------
+    contig : string
+        Chromosome
+    starts : list
+        Start coordinates, 0-based
+    ends : list
+        End coordinates, 0-based, position after end of interval
+    samfiles : list
+        List of pysam file handles to :term:`bam` formatted files.
+    offsets : list
+        Peak shifts to apply to reads
+    chunk_size : int
+        Maximum number of bases to process at once.
+
+    Returns
+    -------
+    npeaks : numpy.array
+        Number of bases with maximum read counts.
+    peakcenter : numpy.array
+        Position of maximum tag density.
+    length : numpy.array
+        Size of interval.
+    avgval : numpy.array
+        Average tag density in interval
+    peakval : numpy.array
+        Maximum tag density in interval.
+    nreads : numpy.array
+        Number of tags overlapping interval.
+    '''
+    starts, ends = _checkIntervals(contig, starts, ends)
+    if len(starts) == 0:
+        return _countPeaksInSegments(None, None, None, None, starts, ends)
+
+    pad = max(offsets or [0])
+    fetch_starts, fetch_ends = _mergeRanges(
+        numpy.maximum(0, starts - pad), ends + pad)
+    tag_starts, tag_ends = getTagExtents(
+        samfiles, contig, fetch_starts, fetch_ends, offsets)
+
+    seg_starts, seg_ends = _mergeRanges(starts, ends)
+    coverage, seg_offsets = buildCoverage(
+        tag_starts, tag_ends, seg_starts, seg_ends)
+
+    return _countPeaksInSegments(
+        coverage, seg_starts, seg_ends, seg_offsets,
+        starts, ends,
+        numpy.sort(tag_starts), numpy.sort(tag_ends),
+        chunk_size)
 
 
 def countPeaks(contig, start, end, samfiles, offsets=None):
@@ -286,6 +548,9 @@ def countPeaks(contig, start, end, samfiles, offsets=None):
     If offsets are given, tags are shifted by `offset` / 2 and
     extended by `offset` / 2.
 
+    To process many intervals, use :func:`countPeaksOnContig` or
+    :func:`countPeaksInIntervals`.
+
     Arguments
     ---------
     contig : string
@@ -314,21 +579,372 @@ def countPeaks(contig, start, end, samfiles, offsets=None):
     nreads : int
         Number of tags contained in interval.
     '''
+    return tuple(x[0] for x in countPeaksOnContig(
+        contig, [start], [end], samfiles, offsets))
 
-    nreads, counts = getCounts(contig, start, end, samfiles, offsets)
 
-    length = end - start
-    avgval = numpy.mean(counts)
-    peakval = max(counts)
+def _countPeaksInContig(args):
+    '''open bam files and count peaks on a single contig.'''
+    contig, starts, ends, bamfiles, offsets = args
+    samfiles = [pysam.Samfile(fn, "rb") for fn in bamfiles]
+    result = countPeaksOnContig(contig, starts, ends, samfiles, offsets)
+    for samfile in samfiles:
+        samfile.close()
+    return result
 
-    # set other peak parameters
-    peaks = numpy.array(range(0, length))[counts >= peakval]
-    npeaks = len(peaks)
-    # peakcenter is median coordinate between peaks
-    # such that it is a valid peak in the middle
-    peakcenter = start + peaks[npeaks // 2]
 
-    return npeaks, peakcenter, length, avgval, peakval, nreads
+def countPeaksInIntervals(intervals, bamfiles, offsets=None, threads=1):
+    '''compute peak parameters for a collection of intervals.
+
+    Intervals are grouped by contig and each contig is processed
+    with :func:`countPeaksOnContig`. If `threads` is larger than 1,
+    contigs are processed in parallel worker processes, unless the
+    function is called from a daemon process.
+
+    Arguments
+    ---------
+    intervals : list
+        List of tuples of (contig, start, end).
+    bamfiles : list
+        List of :term:`bam` formatted files.
+    offsets : list
+        Peak shifts to apply to reads
+    threads : int
+        Number of worker processes.
+
+    Returns
+    -------
+    results : list
+        List of tuples (npeaks, peakcenter, length, avgval, peakval,
+        nreads) in the same order as `intervals`.
+    '''
+    by_contig = collections.OrderedDict()
+    for index, (contig, start, end) in enumerate(intervals):
+        by_contig.setdefault(contig, []).append((index, start, end))
+
+    jobs = []
+    for contig, values in by_contig.items():
+        index, starts, ends = zip(*values)
+        jobs.append((contig, starts, ends, bamfiles, offsets))
+
+    if threads > 1 and multiprocessing.current_process().daemon:
+        # jobs run in daemonic worker processes with --without-cluster,
+        # which can not start processes of their own
+        E.warn("running in a daemon process - counting peaks serially")
+        threads = 1
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        counts = pool.map(_countPeaksInContig, jobs)
+        pool.close()
+        pool.join()
+    else:
+        counts = map(_countPeaksInContig, jobs)
+
+    results = [None] * len(intervals)
+    for values, columns in zip(by_contig.values(), counts):
+        for (index, start, end), result in zip(values, zip(*columns)):
+            results[index] = result
+
+    return results
+
+
+def getTagCoverageFile(bamfile):
+    '''return the name of the tag coverage file of a :term:`bam` file.
+
+    See :func:`buildTagCoverage`.
+    '''
+    return P.snip(bamfile, ".bam") + ".coverage.tsv"
+
+
+def _buildContigTagCoverage(samfile, contig, length, offset, window_size):
+    '''compute run-length encoded tag coverage of a contig.
+
+    The contig is processed in windows of `window_size`.
+
+    Returns
+    -------
+    runs : numpy.array
+        Two-column array with start and coverage of each run.
+    tags : numpy.array
+        Two-column array with sorted starts and sorted ends of tags.
+    '''
+    run_starts, run_values = [], []
+    tag_starts, tag_ends = [], []
+    for start in range(0, length, window_size):
+        end = min(start + window_size, length)
+        starts, ends = getTagExtents(
+            [samfile], contig,
+            [max(0, start - offset)], [end + offset],
+            [offset])
+
+        # tags are assigned to the window containing their start
+        keep = numpy.ones(len(starts), dtype=numpy.bool_)
+        if start > 0:
+            keep &= starts >= start
+        if end < length:
+            keep &= starts < end
+        tag_starts.append(starts[keep])
+        tag_ends.append(ends[keep])
+
+        coverage, seg_offsets = buildCoverage(
+            starts, ends, numpy.array([start]), numpy.array([end]))
+        changes = numpy.flatnonzero(numpy.diff(coverage)) + 1
+        changes = numpy.concatenate(([0], changes))
+        run_starts.append(changes + start)
+        run_values.append(coverage[changes])
+
+    # add a run of zero coverage beyond the end of the contig
+    run_starts = numpy.concatenate(run_starts + [[length]])
+    run_values = numpy.concatenate(run_values + [[0]])
+
+    # merge runs across window boundaries
+    keep = numpy.ones(len(run_values), dtype=numpy.bool_)
+    keep[1:] = run_values[1:] != run_values[:-1]
+
+    runs = numpy.column_stack((run_starts[keep], run_values[keep]))
+    empty = [numpy.zeros(0, dtype=numpy.int64)]
+    tags = numpy.column_stack((
+        numpy.sort(numpy.concatenate(tag_starts + empty)),
+        numpy.sort(numpy.concatenate(tag_ends + empty))))
+    return runs, tags
+
+
+def _saveRawArray(infile, outfile, nrows, chunk_size=1000000):
+    '''convert a raw file of two-column int32 rows into a
+    :file:`.npy` file.'''
+    if nrows == 0:
+        numpy.save(outfile, numpy.zeros((0, 2), dtype=numpy.int32))
+    else:
+        outf = numpy.lib.format.open_memmap(
+            outfile, mode="w+", dtype=numpy.int32, shape=(nrows, 2))
+        with open(infile, "rb") as inf:
+            for start in range(0, nrows, chunk_size):
+                block = numpy.fromfile(
+                    inf, dtype=numpy.int32, count=2 * chunk_size)
+                outf[start:start + len(block) // 2] = block.reshape((-1, 2))
+        outf.flush()
+        del outf
+    os.unlink(infile)
+
+
+@P.cluster_runnable
+def buildTagCoverage(bamfile, outfile, offset=0, window_size=10000000):
+    '''build a tag coverage file for a :term:`bam` file.
+
+    The tag coverage is computed once per :term:`bam` file and can
+    then be queried with :class:`TagCoverage` instead of reading the
+    :term:`bam` file again.
+
+    Tags are shifted by `offset` / 2 and extended by `offset` / 2
+    as in :func:`getCounts`. If `offset` is 0, the reads are used.
+
+    Coverage is stored run-length encoded in :file:`.runs.npy` and
+    the coordinates of tags in :file:`.tags.npy` next to `outfile`.
+    Both files can be memory-mapped. `outfile` is a tab-separated
+    index with the location of each contig in these files.
+
+    Arguments
+    ---------
+    bamfile : string
+        Filename of input file in :term:`bam` format.
+    outfile : string
+        Filename of output index. Should end in ``.tsv``.
+    offset : int
+        Peak shift to apply to reads.
+    window_size : int
+        Size of windows in which coverage is computed.
+    '''
+    prefix = P.snip(outfile, ".tsv")
+    runs_file, tags_file = prefix + ".runs.npy", prefix + ".tags.npy"
+
+    samfile = pysam.Samfile(bamfile, "rb")
+
+    index = []
+    nruns, ntags = 0, 0
+    with open(runs_file + ".tmp", "wb") as outf_runs, \
+            open(tags_file + ".tmp", "wb") as outf_tags:
+        for contig, length in zip(samfile.references, samfile.lengths):
+            runs, tags = _buildContigTagCoverage(
+                samfile, contig, length, offset, window_size)
+            runs.astype(numpy.int32).tofile(outf_runs)
+            tags.astype(numpy.int32).tofile(outf_tags)
+            index.append((contig, length,
+                          nruns, nruns + len(runs),
+                          ntags, ntags + len(tags)))
+            nruns += len(runs)
+            ntags += len(tags)
+
+    samfile.close()
+
+    _saveRawArray(runs_file + ".tmp", runs_file, nruns)
+    _saveRawArray(tags_file + ".tmp", tags_file, ntags)
+
+    # write index last as it marks the coverage as complete
+    outf = IOTools.openFile(outfile, "w")
+    outf.write("# offset=%i\n" % offset)
+    outf.write("contig\tlength\truns_start\truns_end\ttags_start\ttags_end\n")
+    for row in index:
+        outf.write("\t".join(map(str, row)) + "\n")
+    outf.close()
+
+    E.info("%s: %i tags, %i runs of coverage in %i contigs" %
+           (bamfile, ntags, nruns, len(index)))
+
+
+class TagCoverage(object):
+    '''tag coverage of a :term:`bam` file.
+
+    The coverage is read from files created by :func:`buildTagCoverage`
+    and is memory-mapped.
+
+    Arguments
+    ---------
+    filename : string
+        Filename of the index written by :func:`buildTagCoverage`.
+    '''
+
+    def __init__(self, filename):
+        prefix = P.snip(filename, ".tsv")
+
+        self.contigs = {}
+        with IOTools.openFile(filename) as inf:
+            self.offset = int(inf.readline().strip().split("=")[1])
+            inf.readline()
+            for line in inf:
+                data = line[:-1].split("\t")
+                self.contigs[data[0]] = tuple(map(int, data[1:]))
+
+        self.runs = self._loadArray(prefix + ".runs.npy")
+        self.tags = self._loadArray(prefix + ".tags.npy")
+
+    def _loadArray(self, filename):
+        try:
+            return numpy.load(filename, mmap_mode="r")
+        except ValueError:
+            # empty arrays can not be memory-mapped
+            return numpy.load(filename)
+
+    def getRuns(self, contig):
+        '''return start and coverage of each run on `contig`.'''
+        if contig not in self.contigs:
+            return (numpy.array([0], dtype=numpy.int32),
+                    numpy.array([0], dtype=numpy.int32))
+        length, first, last, tags_first, tags_last = self.contigs[contig]
+        runs = self.runs[first:last]
+        return runs[:, 0], runs[:, 1]
+
+    def getTags(self, contig):
+        '''return sorted starts and sorted ends of tags on `contig`.'''
+        if contig not in self.contigs:
+            return (numpy.zeros(0, dtype=numpy.int32),
+                    numpy.zeros(0, dtype=numpy.int32))
+        length, first, last, tags_first, tags_last = self.contigs[contig]
+        tags = self.tags[tags_first:tags_last]
+        return tags[:, 0], tags[:, 1]
+
+    def getSegmentCoverage(self, contig, seg_starts, seg_ends):
+        '''return coverage of the concatenated segments.'''
+        run_starts, run_values = self.getRuns(contig)
+        lengths = seg_ends - seg_starts
+        seg_offsets = numpy.zeros(len(seg_starts) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=seg_offsets[1:])
+        positions = numpy.arange(seg_offsets[-1]) + numpy.repeat(
+            seg_starts - seg_offsets[:-1], lengths)
+        index = numpy.searchsorted(run_starts, positions, side="right") - 1
+        coverage = numpy.where(index >= 0,
+                               run_values[numpy.maximum(index, 0)],
+                               0).astype(numpy.float64)
+        return coverage, seg_offsets
+
+    def getCoverage(self, contig, start, end):
+        '''return tag coverage within a genomic interval.'''
+        coverage, seg_offsets = self.getSegmentCoverage(
+            contig, numpy.array([start]), numpy.array([end]))
+        return coverage
+
+    def countPeaks(self, contig, starts, ends, chunk_size=10000000):
+        '''compute peak parameters for intervals on a contig.
+
+        The output is the same as for :func:`countPeaksOnContig`.
+        '''
+        starts, ends = _checkIntervals(contig, starts, ends)
+        if len(starts) == 0:
+            return _countPeaksInSegments(
+                None, None, None, None, starts, ends)
+
+        seg_starts, seg_ends = _mergeRanges(starts, ends)
+        coverage, seg_offsets = self.getSegmentCoverage(
+            contig, seg_starts, seg_ends)
+        tag_starts, tag_ends = self.getTags(contig)
+        return _countPeaksInSegments(
+            coverage, seg_starts, seg_ends, seg_offsets,
+            starts, ends, tag_starts, tag_ends,
+            chunk_size)
+
+
+def buildPeakCountingStatement(bamfile, offset, headers, logfile,
+                               controlfile=None):
+    '''return a command computing peak parameters for intervals.
+
+    The command reads :term:`bed` formatted intervals from stdin and
+    outputs them together with the peak parameters.
+
+    If tag coverage files (see :func:`buildTagCoverage`) exist for
+    the :term:`bam` files, the peak parameters are computed with
+    :file:`cgat_bed2peaks.py` from the tag coverage and `offset` is
+    ignored in favour of the peak shift of the tag coverage.
+    Otherwise, :file:`bed2table.py` counts tags in the :term:`bam`
+    files using `offset` for the sample and the control.
+
+    The two methods output the same columns, but ``nreads`` has a
+    different meaning. :file:`cgat_bed2peaks.py` counts the shifted
+    tags that overlap an interval. :file:`bed2table.py` counts all
+    reads in the interval widened by half the offset on each side,
+    including reads flagged as unmapped.
+
+    Arguments
+    ---------
+    bamfile : string
+        Filename of :term:`bam` file with tags.
+    offset : int
+        Peak shift to apply to reads.
+    headers : string
+        Comma-separated list of column headers of the intervals.
+    logfile : string
+        Filename of log file.
+    controlfile : string
+        Filename of :term:`bam` file with control tags.
+
+    Returns
+    -------
+    statement : string
+    '''
+    bamfiles = [bamfile]
+    if controlfile:
+        bamfiles.append(controlfile)
+    coverage_files = [getTagCoverageFile(x) for x in bamfiles]
+
+    if all([os.path.exists(x) for x in coverage_files]):
+        statement = ["python %s/cgat_bed2peaks.py" %
+                     PARAMS["pipeline_scriptsdir"],
+                     "--coverage-file=%s" % coverage_files[0]]
+        if controlfile:
+            statement.append(
+                "--control-coverage-file=%s" % coverage_files[1])
+    else:
+        statement = ["python %s/bed2table.py" % PARAMS["scriptsdir"],
+                     "--counter=peaks",
+                     "--bam-file=%s" % bamfile,
+                     "--offset=%i" % offset,
+                     "--output-all-fields"]
+        if controlfile:
+            statement.extend(["--control-bam-file=%s" % controlfile,
+                              "--control-offset=%i" % offset])
+
+    statement.extend(["--output-bed-headers=%s" % headers,
+                      "--log=%s" % logfile])
+    return " ".join(statement)
 
 
 def buildBAMforPeakCalling(infiles, outfile, dedup, mask):
@@ -1370,26 +1986,16 @@ def loadMACS(infile, outfile, bamfile, controlfile=None):
         "pvalue", "fold", "qvalue",
         "macs_summit", "macs_nprobes"))
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s "
-        "--control-offset=%(shift)i" % locals()
-    else:
-        control = ""
-
     load_statement = P.build_load_statement(
         P.toTable(outfile) + "_peaks",
         options="--add-index=contig,start "
         "--add-index=interval_id "
         "--allow-empty-file")
 
-    statement = '''python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(shift)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    peak_counter = buildPeakCountingStatement(
+        bamfile, shift, headers, outfile, controlfile)
+
+    statement = '''%(peak_counter)s
     < %(tmpfilename)s
     | %(load_statement)s
     > %(outfile)s'''
@@ -1414,17 +2020,13 @@ def loadMACS(infile, outfile, bamfile, controlfile=None):
             "--allow-empty-file")
 
         # add a peak identifier and remove header
+        peak_counter = buildPeakCountingStatement(
+            bamfile, shift, headers, outfile, controlfile)
+
         statement = '''
         awk '/Chromosome/ {next; } {printf("%%s\\t%%i\\t%%i\\t%%i\\t%%i\\t%%i\\n", $1,$2,$3,++a,$4,$5)}'
         < %(filename_subpeaks)s
-        | python %(scriptsdir)s/bed2table.py
-        --counter=peaks
-        --bam-file=%(bamfile)s
-        --offset=%(shift)i
-        %(control)s
-        --output-all-fields
-        --output-bed-headers=%(headers)s
-        --log=%(outfile)s
+        | %(peak_counter)s
         | %(load_statement)s
         > %(outfile)s'''
 
@@ -1571,25 +2173,16 @@ def loadMACS2(infile, outfile, bamfile, controlfile=None):
         "pvalue", "fold", "qvalue",
         "macs_nprobes"))
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s --control-offset=%(shift)i" % locals()
-    else:
-        control = ""
-
     load_statement = P.build_load_statement(
         P.toTable(outfile) + "_peaks",
         options="--add-index=contig,start "
         "--add-index=interval_id "
         "--allow-empty-file")
 
-    statement = '''python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(shift)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    peak_counter = buildPeakCountingStatement(
+        bamfile, shift, headers, outfile, controlfile)
+
+    statement = '''%(peak_counter)s
     < %(tmpfilename)s
     | %(load_statement)s
     > %(outfile)s'''
@@ -1614,17 +2207,13 @@ def loadMACS2(infile, outfile, bamfile, controlfile=None):
             "--allow-empty-file")
 
         # add a peak identifier and remove header
+        peak_counter = buildPeakCountingStatement(
+            bamfile, shift, headers, outfile, controlfile)
+
         statement = '''
         zcat %(filename_subpeaks)s
         | awk '/Chromosome/ {next; } {printf("%%s\\t%%i\\t%%i\\t%%i\\t%%i\\t%%i\\n", $1,$2,$3,++a,$4,$5)}'
-        | python %(scriptsdir)s/bed2table.py
-        --counter=peaks
-        --bam-file=%(bamfile)s
-        --offset=%(shift)i
-        %(control)s
-        --output-all-fields
-        --output-bed-headers=%(headers)s
-        --log=%(outfile)s
+        | %(peak_counter)s
         | %(load_statement)s
         > %(outfile)s'''
 
@@ -1645,17 +2234,13 @@ def loadMACS2(infile, outfile, bamfile, controlfile=None):
             "--allow-empty-file")
 
         # add a peak identifier and remove header
+        peak_counter = buildPeakCountingStatement(
+            bamfile, shift, headers, outfile, controlfile)
+
         statement = '''
         cat %(filename_broadpeaks)s
         | awk '/Chromosome/ {next; } {printf("%%s\\t%%i\\t%%i\\t%%i\\t%%i\\n", $1,$2,$3,++a,$4)}'
-        | python %(scriptsdir)s/bed2table.py
-        --counter=peaks
-        --bam-file=%(bamfile)s
-        --offset=%(shift)i
-        %(control)s
-        --output-all-fields
-        --output-bed-headers=%(headers)s
-        --log=%(outfile)s
+        | %(peak_counter)s
         | %(load_statement)s
         > %(outfile)s'''
 
@@ -1712,10 +2297,6 @@ def loadZinba(infile, outfile, bamfile,
 
         E.info("%s: found peak shift of %i" % (track, offset))
 
-        if controlfile:
-            control = ("--control-bam-file=%(controlfile)s "
-                       "--control-offset=%(offset)i" % locals())
-
         # Steve - Guessing these are actually "peak calls"
         load_statement = P.build_load_statement(
             P.toTable(outfile) + "_peaks",
@@ -1725,20 +2306,16 @@ def loadZinba(infile, outfile, bamfile,
 
         headers = "contig,start,end,interval_id,sig,maxloc,maxval,median,qvalue"
 
+        peak_counter = buildPeakCountingStatement(
+            bamfile, offset, headers, outfile, controlfile)
+
         statement = '''cat %(infilename)s
         | python %(scriptsdir)s/csv_cut.py
         Chrom Start Stop Sig Maxloc Max Median qValue
         | awk -v FS='\\t' -v OFS='\\t' \
         '/Chrom/ {next; } \
         {$4=sprintf("%%i\\t%%s", ++a, $4); print}'
-        | python %(scriptsdir)s/bed2table.py
-        --counter=peaks
-        --bam-file=%(bamfile)s
-        --offset=%(offset)i
-        %(control)s
-        --output-all-fields
-        --output-bed-headers=%(headers)s
-        --log=%(outfile)s
+        | %(peak_counter)s
         | %(load_statement)s
         > %(outfile)s'''
 
@@ -1750,19 +2327,15 @@ def loadZinba(infile, outfile, bamfile,
             "--add-index=interval_id "
             "--allow-empty-file")
 
+        peak_counter = buildPeakCountingStatement(
+            bamfile, offset, headers, outfile, controlfile)
+
         statement = '''cat %(infilename)s
         | python %(scriptsdir)s/csv_cut.py Chrom pStart pStop Sig Maxloc Max Median qValue
         | awk -v FS='\\t' -v OFS='\\t' \
         '/Chrom/ {next; } \
         {$4=sprintf("%%i\\t%%s", ++a, $4); print}'
-        | python %(scriptsdir)s/bed2table.py
-        --counter=peaks
-        --bam-file=%(bamfile)s
-        --offset=%(offset)i
-        %(control)s
-        --output-all-fields
-        --output-bed-headers=%(headers)s
-        --log=%(outfile)s
+        | %(peak_counter)s
         | %(load_statement)s
         > %(outfile)s'''
 
@@ -1864,9 +2437,6 @@ def loadSICER(infile, outfile, bamfile, controlfile=None, mode="narrow",
 
     assert os.path.exists(bedfile)
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s --control-offset=%(offset)i" % locals()
-
     tablename = P.toTable(outfile) + "_regions"
     load_statement = P.build_load_statement(
         tablename,
@@ -1877,17 +2447,13 @@ def loadSICER(infile, outfile, bamfile, controlfile=None, mode="narrow",
     headers = "contig,start,end,interval_id,chip_reads,control_reads,pvalue,fold,fdr"
 
     # add new interval id at fourth column
+    peak_counter = buildPeakCountingStatement(
+        bamfile, offset, headers, outfile, controlfile)
+
     statement = '''cat < %(bedfile)s
     | awk '{printf("%%s\\t%%s\\t%%s\\t%%i", $1,$2,$3,++a);
     for (x = 4; x <= NF; ++x) {printf("\\t%%s", $x)}; printf("\\n" ); }'
-    | python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(offset)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    | %(peak_counter)s
     | %(load_statement)s
     > %(outfile)s'''
 
@@ -2017,9 +2583,6 @@ def loadPeakRanger(infile, outfile, bamfile, controlfile=None, table_suffix="pea
 
     offset = PARAMS["peakranger_extension_length"] // 2
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s --control-offset=%(offset)i" % locals()
-
     # Steve - This was set to _details, but _details = regions (peaks)
     # + summits. Hence changed.  Note that Peak ranger reports peaks
     # even when the given fdr cut-off has failed and labels them
@@ -2037,14 +2600,10 @@ def loadPeakRanger(infile, outfile, bamfile, controlfile=None, table_suffix="pea
         "--add-index=interval_id "
         "--allow-empty-file")
 
-    statement = '''python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(offset)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    peak_counter = buildPeakCountingStatement(
+        bamfile, offset, headers, outfile, controlfile)
+
+    statement = '''%(peak_counter)s
     < <( grep -v "fdrFailed" %(bedfile)s )
     | %(load_statement)s
     > %(outfile)s'''
@@ -2059,14 +2618,10 @@ def loadPeakRanger(infile, outfile, bamfile, controlfile=None, table_suffix="pea
         "--add-index=interval_id "
         "--allow-empty-file")
 
-    statement = '''python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(offset)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    peak_counter = buildPeakCountingStatement(
+        bamfile, offset, headers, outfile, controlfile)
+
+    statement = '''%(peak_counter)s
     < <( grep -v "fdrFailed" %(bedfile)s )
     | %(load_statement)s
     > %(outfile)s'''
@@ -2206,9 +2761,6 @@ def loadSPP(infile, outfile, bamfile, controlfile=None):
 
     offset = getPeakShift(infile) * 2
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s --control-offset=%(offset)i" % locals()
-
     #
     # Now commented out - the broadpeaks file records arbitrary broad
     # regions of enrichment not controlled by p or q value, it is a
@@ -2246,16 +2798,12 @@ def loadSPP(infile, outfile, bamfile, controlfile=None):
         "--add-index=interval_id "
         "--allow-empty-file")
 
+    peak_counter = buildPeakCountingStatement(
+        bamfile, offset, headers, outfile, controlfile)
+
     statement = '''awk '{printf("%%s\\t%%i\\t%%i\\t%%s\\t%%f\\t%%f\\t%%i\\n", $1,$2,$3,++a,$7,$9,$1+$10);}'
     < %(bedfile)s
-    | python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(offset)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    | %(peak_counter)s
     | %(load_statement)s
     > %(outfile)s'''
 
@@ -2345,215 +2893,159 @@ def estimateSPPQualityMetrics(infile, track, controlfile, outfile):
         shutil.move(track + ".pdf", dest)
 
 
-def createGenomeWindows(genome, outfile, windows):
-
-    statement = '''
-        python %(scriptsdir)s/windows2gff.py
-            --genome=%(genome)s
-            --output-format=bed
-            --fixed-width-windows=%(windows)s
-            --log=%(outfile)s.log |
-        bedtools sort -i stdin |
-        gzip > %(outfile)s
-        '''
-    P.run()
+def countReadsInBins(samfile, contig, length, window_size, overlap,
+                     threshold=1.0, rng=None, chunk_size=10000000):
+    '''count reads in fixed-width bins along a contig.
 
+    A read is counted in a bin if it overlaps the bin by at least
+    a fraction `overlap` of the bin length, as ``intersectBed -c -f``
+    does. A read can be counted in several bins.
 
-def normalize(infile, larger_nreads, outfile, smaller_nreads):
-    threshold = float(smaller_nreads) / float(larger_nreads)
+    Reads are fetched in chunks of `chunk_size` bases so that memory
+    usage does not depend on the depth of the contig.
 
-    pysam_in = pysam.Samfile(infile, "rb")
-    pysam_out = pysam.Samfile(outfile, "wb", template=pysam_in)
-
-    for read in pysam_in.fetch():
-        if random.random() <= threshold:
-            pysam_out.write(read)
+    Arguments
+    ---------
+    samfile : pysam.Samfile
+        File handle to a :term:`bam` formatted file.
+    contig : string
+        Chromosome
+    length : int
+        Length of the contig. The last bin is truncated at the end
+        of the contig.
+    window_size : int
+        Width of bins.
+    overlap : float
+        Minimum overlap of a read with a bin as fraction of the bin
+        length.
+    threshold : float
+        If less than 1, each read is kept with this probability
+        before counting.
+    rng : numpy.random.RandomState
+        Random number generator used for downsampling.
+    chunk_size : int
+        Number of bases to fetch reads from at a time.
 
-    pysam_in.close()
-    pysam_out.close()
-    pysam.index(outfile)
+    Returns
+    -------
+    counts : numpy.array
+        Number of reads in each bin.
+    '''
+    nbins = (length + window_size - 1) // window_size
+    counts = numpy.zeros(nbins, dtype=numpy.int64)
+
+    for chunk_start in range(0, length, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, length)
+        # reads are assigned to the chunk containing their start,
+        # some unmapped reads might have a position
+        reads = numpy.array(
+            [(read.pos, read.aend)
+             for read in samfile.fetch(contig, chunk_start, chunk_end)
+             if not read.is_unmapped and read.pos >= chunk_start],
+            dtype=numpy.int64).reshape((-1, 2))
+
+        if threshold < 1.0:
+            reads = reads[rng.random_sample(len(reads)) <= threshold]
+
+        if len(reads) == 0:
+            continue
 
-    return outfile
-
-
-def normalizeFileSize(sample_file, input_file, sample_outfile, input_outfile):
-    sample_sam = pysam.Samfile(sample_file, "rb")
-    sample_nreads = 0
-    for read in sample_sam:
-        sample_nreads += 1
-
-    input_sam = pysam.Samfile(input_file, "rb")
-    input_nreads = 0
-    for read in input_sam:
-        input_nreads += 1
-
-    if input_nreads > sample_nreads:
-        E.info("INPUT bam has %s reads, SAMPLE bam has %s reads"
-               % (input_nreads, sample_nreads))
-        E.info("INPUT being downsampled to match SAMPLE")
-        input_outfile = normalize(input_file,
-                                  input_nreads,
-                                  input_outfile,
-                                  sample_nreads)
-        shutil.copyfile(sample_file, sample_outfile)
-        pysam.index(sample_outfile)
-
-        return sample_outfile, input_outfile
-
-    elif sample_nreads > input_nreads:
-        E.info("SAMPLE bam has %s reads, INPUT bam has %s reads"
-               % (sample_nreads, input_nreads))
-        E.info("SAMPLE being downsampled to match INPUT")
-        sample_outfile = normalize(sample_file,
-                                   sample_nreads,
-                                   sample_outfile,
-                                   input_nreads)
-        shutil.copyfile(input_file, input_outfile)
-        pysam.index(input_outfile)
-
-        return sample_outfile, input_outfile
+        starts, ends = reads[:, 0], numpy.minimum(reads[:, 1], length)
+        first = starts // window_size
+        last = (ends - 1) // window_size
 
-    else:
-        P.warn("WARNING: input and sample bamfiles are the same size!!")
-        shutil.copyfile(sample_file, sample_outfile)
-        pysam.index(sample_outfile)
-        shutil.copyfile(input_file, input_outfile)
-        pysam.index(input_outfile)
+        # reads spanning several bins are counted in each
+        # bin separately
+        for step in range(int((last - first).max()) + 1):
+            bins = first + step
+            bin_starts = bins * window_size
+            bin_ends = numpy.minimum(bin_starts + window_size, length)
+            overlaps = (numpy.minimum(ends, bin_ends) -
+                        numpy.maximum(starts, bin_starts))
+            take = ((bins <= last) &
+                    (overlaps >= overlap * (bin_ends - bin_starts)))
+            counts += numpy.bincount(bins[take], minlength=nbins)
 
-        return sample_outfile, input_outfile
+    return counts
 
 
-def buildBedFile(infile, outfile):
-    statement = ("python %(scriptsdir)s/bam2bed.py %(infile)s"
-                 " | sortBed -i stdin"
-                 " > %(outfile)s")
-    P.run()
-    return(outfile)
+@P.cluster_runnable
+def buildBroadPeakBedgraph(bamfile, outfile, window_size, overlap,
+                           controlfile=None, seed=None):
+    '''build a :term:`bedGraph` file of read counts in fixed-width
+    bins for BroadPeak.
 
+    Reads are counted in bins with :func:`countReadsInBins`. If
+    `controlfile` is given, the larger of the two :term:`bam` files
+    is randomly downsampled to the number of reads in the smaller
+    one and the control counts are subtracted from the sample counts.
+    Bins with negative counts are set to 0.
 
-def createBedgraphFile(infile, outfile, windows_file, overlap):
-    statement = ("intersectBed"
-                 " -c"
-                 " -f %(overlap)s"
-                 " -a %(windows_file)s"
-                 " -b %(infile)s"
-                 " | sortBed -i stdin"
-                 " > %(outfile)s")
-    P.run()
-    return(outfile)
+    Only bins with a count are output. The output is sorted by
+    contig and position.
 
+    Arguments
+    ---------
+    bamfile : string
+        Filename of sample in :term:`bam` format.
+    outfile : string
+        Filename of output file in :term:`bedGraph` format.
+    window_size : int
+        Width of bins.
+    overlap : float
+        Minimum overlap of a read with a bin as fraction of the bin
+        length.
+    controlfile : string
+        Filename of control in :term:`bam` format.
+    seed : int
+        Seed for random number generator used for downsampling.
+    '''
+    rng = numpy.random.RandomState(seed)
 
-def removeBackground(sample_bedgraph, input_bedgraph, outfile):
-    inf = IOTools.openFile(sample_bedgraph, "r").readlines()
-    contf = IOTools.openFile(input_bedgraph, "r").readlines()
-    outf = IOTools.openFile(outfile, "w")
+    samfile = pysam.Samfile(bamfile, "rb")
+    sample_threshold, control_threshold = 1.0, 1.0
 
-    for i in range(0, len(inf)):
-        line_inf = inf[i].split()
-        line_contf = contf[i].split()
-        if line_inf[0] == line_contf[0] and line_inf[1] == line_contf[1]:
-            if int(line_inf[3]) >= int(line_contf[3]):
-                outf.write(str(line_inf[0]) +
-                           "\t" + str(line_inf[1]) +
-                           "\t" + str(line_inf[2]) +
-                           "\t" + str(int(line_inf[3]) -
-                                      int(line_contf[3])) + "\n")
-            else:
-                outf.write(str(line_inf[0]) +
-                           "\t" + str(line_inf[1]) +
-                           "\t" + str(line_inf[2]) +
-                           "\t0" + "\n")
+    if controlfile:
+        controlsam = pysam.Samfile(controlfile, "rb")
+        sample_nreads = BamTools.getNumReads(bamfile)
+        control_nreads = BamTools.getNumReads(controlfile)
+        E.info("SAMPLE bam has %i reads, INPUT bam has %i reads" %
+               (sample_nreads, control_nreads))
+        if control_nreads > sample_nreads:
+            E.info("INPUT being downsampled to match SAMPLE")
+            control_threshold = float(sample_nreads) / control_nreads
+        elif sample_nreads > control_nreads:
+            E.info("SAMPLE being downsampled to match INPUT")
+            sample_threshold = float(control_nreads) / sample_nreads
         else:
-            raise Exception("Windows in '%s' aren't aligned with windows in %s"
-                            % (sample_bedgraph, input_bedgraph))
-    return outfile
-
-
-def removeEmptyBins(infile, outfile):
-    statement = '''cat %(infile)s
-    | awk '$4!=0 {print $1"\t"$2"\t"$3"\t"$4}'
-    > %(outfile)s '''
-    P.run()
+            E.warn("input and sample bamfiles are the same size")
 
+    outf = IOTools.openFile(outfile, "w")
+    nbins = 0
+    for contig, length in sorted(zip(samfile.references, samfile.lengths)):
+        counts = countReadsInBins(samfile, contig, length,
+                                  window_size, overlap,
+                                  sample_threshold, rng)
+        if controlfile:
+            counts -= countReadsInBins(controlsam, contig, length,
+                                       window_size, overlap,
+                                       control_threshold, rng)
+            counts[counts < 0] = 0
+
+        bins = numpy.flatnonzero(counts)
+        starts = bins * window_size
+        ends = numpy.minimum(starts + window_size, length)
+        outf.write("".join(
+            ["%s\t%i\t%i\t%i\n" % (contig, start, end, count)
+             for start, end, count in zip(starts, ends, counts[bins])]))
+        nbins += len(bins)
 
-def createBroadPeakBedgraphFile(infiles, outfile, params):
-    tmpdir = P.getTempDir("/scratch")
-    E.info("Creating tempdir: %s" % tmpdir)
-    sample_bed = P.getTempFilename(tmpdir)
-    sample_bedgraph = P.getTempFilename(tmpdir)
-    input_bed = P.getTempFilename(tmpdir)
-    input_bedgraph = P.getTempFilename(tmpdir)
-    bgremoved_bedgraph = P.getTempFilename(tmpdir)
-
-    overlap, remove_background = params
-
-    if remove_background == "true":
-        sample_file, windows_file, input_file = infiles
-        E.info("Background removal:"
-               " Input reads will be deducted from sample reads\n"
-               "Normalizing size of bamfiles by down-sampling larger file")
-
-        sample_norm = P.snip(sample_file, ".call.bam") + "_normalized.bam"
-        input_norm = P.snip(input_file, ".call.bam") + "_normalized.bam"
-        sample_norm, input_norm = normalizeFileSize(sample_file,
-                                                    input_file,
-                                                    sample_norm,
-                                                    input_norm)
-        E.info("Created normalized SAMPLE bam:\t %s "
-               "\nCreated normalized INPUT bam:\t %s"
-               % (sample_norm, input_norm))
-
-        E.info("Creating bed file from SAMPLE bam file")
-        sample_bed = buildBedFile(sample_norm, sample_bed)
-
-        E.info("Created SAMPLE bed file:\t %s \nCreating SAMPLE bedgraph file.\n"
-               "Reads must have coverage >= %s*bin width in order to be binned"
-               % (sample_bed, overlap))
-        sample_bedgraph = createBedgraphFile(sample_bed,
-                                             sample_bedgraph,
-                                             windows_file,
-                                             overlap)
-
-        E.info("Created SAMPLE bedgraph file:\t %s\nCreating INPUT bed file"
-               % sample_bedgraph)
-        input_bed = buildBedFile(input_norm, input_bed)
-
-        E.info("Created INPUT bed file:\t %s \nCreating INPUT bedgraph file\n"
-               "Reads must have coverage >= %s*bin width in order to be binned"
-               % (input_bed, overlap))
-        input_bedgraph = createBedgraphFile(input_bed,
-                                            input_bedgraph,
-                                            windows_file,
-                                            overlap)
-
-        E.info("Created INPUT bedgraph file:\t %s "
-               "\nSubtracting INPUT bedgraph from SAMPLE bedgraph"
-               % input_bedgraph)
-        bgremoved_bedgraph = removeBackground(sample_bedgraph,
-                                              input_bedgraph,
-                                              bgremoved_bedgraph)
-        removeEmptyBins(bgremoved_bedgraph, outfile)
-
-        E.info("Created SAMPLE bedgraph with INPUT removed:\t %s" % outfile)
-        shutil.rmtree(os.path.abspath(tmpdir))
-
-    else:
-        sample_file, windowsfile = infiles
-        E.info("Background ignored: bedgraph file does not account for INPUT")
-        E.info("Creating bed file from SAMPLE bam file")
-        sample_bed = buildBedFile(sample_file, sample_bed)
-
-        E.info("Created SAMPLE bed file:\n %s \nCreating SAMPLE bedgraph file"
-               % sample_bed)
-        sample_bedgraph = createBedgraphFile(sample_bed,
-                                             sample_bedgraph,
-                                             windows_file,
-                                             overlap)
-        removeEmptyBins(sample_bedgraph, outfile)
-        E.info("Created SAMPLE bedgraph (without accounting for INPUT):\n"
-               "%s" % outfile)
+    outf.close()
+    samfile.close()
+    if controlfile:
+        controlsam.close()
 
-        shutil.rmtree(os.path.abspath(tmpdir))
+    E.info("%s: %i bins with reads" % (outfile, nbins))
 
 
 def runBroadPeak(infile, stub, logfile, genome_size, training_set=False):
@@ -2921,9 +3413,6 @@ def loadScripture(infile, outfile, bamfile, controlfile=None):
     #    offset = getPeakShift( infile ) * 2
     offset = 0
 
-    if controlfile:
-        control = "--control-bam-file=%(controlfile)s --control-offset=%(offset)i" % locals()
-
     bedfile = infile + ".bed.gz"
 
     headers = "contig,start,end,interval_id,score,pvalue,score2,score3,score4"
@@ -2934,16 +3423,12 @@ def loadScripture(infile, outfile, bamfile, controlfile=None):
         "--add-index=interval_id "
         "--allow-empty-file")
 
+    peak_counter = buildPeakCountingStatement(
+        bamfile, offset, headers, outfile, controlfile)
+
     statement = '''zcat %(bedfile)s
     | awk '{printf("%%s\\t%%i\\t%%i\\t%%s\\t%%f\\t%%f\\t%%f\\t%%f\\t%%f\\n", $1,$2,$3,++a,$5,$7,$8,$9,$10);}'
-    | python %(scriptsdir)s/bed2table.py
-    --counter=peaks
-    --bam-file=%(bamfile)s
-    --offset=%(offset)i
-    %(control)s
-    --output-all-fields
-    --output-bed-headers=%(headers)s
-    --log=%(outfile)s
+    | %(peak_counter)s
     | %(load_statement)s
     > %(outfile)s'''
 
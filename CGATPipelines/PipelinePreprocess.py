@@ -36,11 +36,9 @@ import re
 import os
 import sqlite3
 import CGATPipelines.Pipeline as P
-import CGATPipelines.PipelineTracks as PipelineTracks
 import CGAT.IOTools as IOTools
 import CGAT.Fastq as Fastq
 import CGATPipelines.PipelineMapping as Mapping
-import CGAT.Sra as Sra
 
 
 def makeAdaptorFasta(infile, outfile, track, dbh, contaminants_file):
@@ -52,9 +50,7 @@ def makeAdaptorFasta(infile, outfile, track, dbh, contaminants_file):
     Arguments
     ---------
     infile : string
-        Input filename that has been QC'ed. The filename is used to
-        check if the input was a :term:`sra` file and guess the
-        number of tracks to check.
+        Input filename that has been QC'ed.
     outfile : string
         Output filename in :term:`fasta` format.
     track : string
@@ -66,28 +62,20 @@ def makeAdaptorFasta(infile, outfile, track, dbh, contaminants_file):
         Fastqc.
 
     '''
-    tracks = [track]
+    cc = dbh.cursor()
 
-    if infile.endswith(".sra"):
-        # patch for SRA files, look at multiple tracks
-        f, fastq_format, datatype = Sra.peek(infile)
-        if len(f) == 2:
-            tracks = [track + "_fastq_1", track + "_fastq_2"]
+    # FastQC results of all tracks are in a single table, see
+    # PipelineReadqc.loadFastqcTables. The table does not exist if
+    # no sample has overrepresented sequences.
+    tables = [x[0] for x in cc.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
 
     found_contaminants = []
-    for t in tracks:
-        table = PipelineTracks.AutoSample(os.path.basename(t)).asTable()
-
-        # if sample name starts with a number, sql table will have
-        # prepended "_"
-        if re.match("^\d+.*", table):
-            table = "_" + table
-
+    if "fastqc_Overrepresented_sequences" in tables:
+        # includes both mates of paired-end data
         query = '''SELECT Possible_Source, Sequence FROM
-        %s_fastqc_Overrepresented_sequences;''' % table
-
-        cc = dbh.cursor()
-        found_contaminants.extend(cc.execute(query).fetchall())
+        fastqc_Overrepresented_sequences WHERE track = ?;'''
+        found_contaminants = cc.execute(query, (track,)).fetchall()
 
     if len(found_contaminants) == 0:
         P.touch(outfile)
@@ -146,6 +134,8 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         If True, summarize the output after each step.
     threads : int
         Number of processing threads to use.
+    fuse : bool
+        If True, connect consecutive streaming tools by named pipes.
     outdir : string
         Output directory for intermediate files.
     processors : list
@@ -160,6 +150,12 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         If True, summarize the output after each step.
     threads : int
         Number of processing threads to use.
+    fuse : bool
+        If True, consecutive tools that can read and write streams
+        (see :attr:`ProcessTool.streaming`) are run concurrently and
+        connected by named pipes. Intermediate data are not
+        compressed and are not written to disk. Summaries are
+        computed from the streams as they pass.
 
     """
 
@@ -170,10 +166,12 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
                  save=True,
                  summarize=False,
                  threads=1,
+                 fuse=False,
                  *args, **kwargs):
         self.save = save
         self.summarize = summarize
         self.threads = threads
+        self.fuse = fuse
         if self.save:
             self.outdir = "processed.dir"
         else:
@@ -186,12 +184,15 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         self.processors.append(processor)
 
     def cleanup(self):
-        '''return statement to clean up temporary files after processing.'''
+        '''return statement to clean up temporary files after processing.
+
+        :attr:`tmpdir_fastq` is removed when the job exits, see
+        :func:`Pipeline.buildTempDirStatement`.
+        '''
         if self.save:
             statement = 'checkpoint;'
         else:
             statement = 'rm -rf %s;' % self.outdir
-        statement += '''rm -rf %s;''' % (self.tmpdir_fastq)
         return statement
 
     def build(self, infile, output_prefix, track):
@@ -228,18 +229,56 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
         # preprocess currently returns a list of lists
         current_files = current_files[0]
 
+        if self.fuse:
+            cmd_process = self.buildFused(current_files, output_prefix, track)
+        else:
+            cmd_process = self.buildSequential(
+                current_files, output_prefix, track)
+
+        cmd_clean = self.cleanup()
+
+        assert cmd_preprocess.strip().endswith(";")
+        assert cmd_process.strip().endswith(";")
+        assert cmd_clean.strip().endswith(";")
+
+        statement = " checkpoint; ".join((cmd_preprocess,
+                                          cmd_process,
+                                          cmd_clean))
+        return statement
+
+    def getSuffixes(self, processor, current_files, track):
+        '''return suffixes of output files of `processor`.'''
+        # number of output files created in this step
+        nfiles = processor.get_num_files(current_files)
+        if nfiles == 2:
+            return [track + ".fastq.1.gz",
+                    track + ".fastq.2.gz"]
+        else:
+            return [track + ".fastq.gz"]
+
+    def buildSummary(self, filename, summaryfile=None):
+        '''return statement to summarize :term:`fastq` file
+        `filename`. If `summaryfile` is not given, the summary is
+        written to `filename` with the suffix ``.summary``.'''
+        if summaryfile is None:
+            summaryfile = filename + ".summary"
+        return """zcat -f < %(filename)s
+        | python %%(scriptsdir)s/fastq2summary.py
+        --guess-format=illumina-1.8
+        > %(summaryfile)s;""" % locals()
+
+    def buildSequential(self, current_files, output_prefix, track):
+        '''build statement running processors one after the other.
+
+        Intermediate files are written to the temporary directory.
+        '''
+
         cmd_processors = []
 
         # build statements from processors
         for idx, processor in enumerate(self.processors):
 
-            # number of output files created in this step
-            nfiles = processor.get_num_files(current_files)
-            if nfiles == 2:
-                suffixes = [track + ".fastq.1.gz",
-                            track + ".fastq.2.gz"]
-            else:
-                suffixes = [track + ".fastq.gz"]
+            suffixes = self.getSuffixes(processor, current_files, track)
 
             if idx == len(self.processors)-1:
                 # last iteration, write to output files
@@ -264,23 +303,129 @@ class MasterProcessor(Mapping.SequenceCollectionProcessor):
 
             if self.summarize:
                 for fn in current_files:
-                    cmd_processors.append(
-                        """zcat %(fn)s
-                        | python %%(scriptsdir)s/fastq2summary.py
-                        --guess-format=illumina-1.8
-                        > %(fn)s.summary""")
+                    cmd_processors.append(self.buildSummary(fn))
 
-        cmd_process = " checkpoint; ".join(cmd_processors)
-        cmd_clean = self.cleanup()
+        return " checkpoint; ".join(cmd_processors)
 
-        assert cmd_preprocess.strip().endswith(";")
-        assert cmd_process.strip().endswith(";")
-        assert cmd_clean.strip().endswith(";")
+    def buildFused(self, current_files, output_prefix, track):
+        '''build statement connecting processors by named pipes.
 
-        statement = " checkpoint; ".join((cmd_preprocess,
-                                          cmd_process,
-                                          cmd_clean))
-        return statement
+        Consecutive processors that are able to stream are run
+        concurrently. The output of a streaming processor is written
+        to a named pipe in the temporary directory if it is followed
+        by another streaming processor. The final output is
+        compressed once. If summaries are requested, the data are
+        copied to the summary while passing from one processor to the
+        next.
+
+        Processors that are not able to stream are run on their own
+        and read and write compressed files as in
+        :meth:`buildSequential`.
+
+        Summaries of intermediate data are written to the output
+        directory.
+        '''
+        nprocessors = len(self.processors)
+        tmpdir = self.tmpdir_fastq
+        summary_prefix = os.path.join(os.path.dirname(output_prefix), "")
+
+        # groups of commands that run concurrently, fifos that need to
+        # be created for them and the current group
+        statement = []
+        fifos, group = [], []
+
+        for idx, processor in enumerate(self.processors):
+
+            suffixes = self.getSuffixes(processor, current_files, track)
+            is_last = idx == nprocessors - 1
+            names = [processor.prefix + "-" + track + s for s in suffixes]
+
+            stream_output = processor.streaming and (
+                is_last or self.processors[idx + 1].streaming)
+
+            if stream_output:
+                # uncompressed named pipes
+                processor_files = [os.path.join(tmpdir, P.snip(x, ".gz"))
+                                   for x in names]
+                fifos.extend(processor_files)
+            elif is_last:
+                processor_files = [output_prefix + s for s in suffixes]
+            else:
+                processor_files = [os.path.join(tmpdir, x) for x in names]
+
+            group.extend(processor.buildCommands(
+                current_files,
+                processor_files,
+                output_prefix + track + "-" + processor.prefix))
+
+            if not stream_output:
+                statement.append(self.buildGroup(group, fifos))
+                if self.summarize:
+                    statement.extend([self.buildSummary(x)
+                                      for x in processor_files])
+                fifos, group = [], []
+                current_files = processor_files
+                continue
+
+            # pass data from named pipes on to next processor,
+            # summary and/or final compression
+            next_files = []
+            for fn, name, suffix in zip(processor_files, names, suffixes):
+                if is_last:
+                    next_file = output_prefix + suffix
+                    compress_cmd = "| gzip"
+                    summary_file = next_file + ".summary"
+                else:
+                    next_file = fn + ".next"
+                    compress_cmd = ""
+                    summary_file = summary_prefix + name + ".summary"
+
+                if self.summarize:
+                    summary_fifo = fn + ".summary"
+                    fifos.append(summary_fifo)
+                    group.append(self.buildSummary(summary_fifo,
+                                                   summary_file))
+                    tee_cmd = "| tee %s" % summary_fifo
+                else:
+                    tee_cmd = ""
+
+                if is_last or self.summarize:
+                    if not is_last:
+                        fifos.append(next_file)
+                    group.append("cat %(fn)s %(tee_cmd)s %(compress_cmd)s "
+                                 "> %(next_file)s;" % locals())
+                else:
+                    next_file = fn
+                next_files.append(next_file)
+
+            current_files = next_files
+
+            if is_last:
+                statement.append(self.buildGroup(group, fifos))
+
+        return " checkpoint; ".join(statement)
+
+    def buildGroup(self, commands, fifos):
+        '''return statement that runs `commands` concurrently.
+
+        The named pipes in `fifos` are created before the commands
+        are started. The statement fails if any of the commands
+        fails.
+        '''
+        if not fifos and len(commands) == 1:
+            return commands[0]
+
+        statement = ["CGAT_PIDS=\"\""]
+        if fifos:
+            statement.append("mkfifo %s" % " ".join(fifos))
+        for command in commands:
+            statement.append(
+                "( %s ) & CGAT_PIDS=\"$CGAT_PIDS $!\"" % command)
+        statement.append(
+            "for pid in $CGAT_PIDS; do wait $pid || exit 1; done")
+        if fifos:
+            statement.append("rm -f %s" % " ".join(fifos))
+        return "; ".join(statement) + ";"
 
 
 class ProcessTool(object):
@@ -306,6 +451,11 @@ class ProcessTool(object):
         Number of threads to use.
     '''
 
+    # set to True if the tool can read from and write to named pipes.
+    # Compressed input is recognized by the content, compressed output
+    # is written if an output filename ends in ".gz".
+    streaming = False
+
     def __init__(self, options, threads=1, untrimmed=0):
         self.processing_options = options
         self.threads = threads
@@ -340,6 +490,22 @@ class ProcessTool(object):
         raise NotImplementedError(
             "build() method needs to be implemented in derived class")
 
+    def buildCommands(self, infiles, outfiles, output_prefix):
+        """build a list of command line statements executing the tool.
+
+        The statements can be executed concurrently. This method
+        should be overloaded by streaming tools that process each
+        input file independently.
+        """
+        return [self.build(infiles, outfiles, output_prefix)]
+
+    def getCompressCommand(self, outfile):
+        """return command to compress output piped into `outfile`."""
+        if outfile.endswith(".gz"):
+            return "| gzip"
+        else:
+            return ""
+
 
 class Trimgalore(ProcessTool):
     """Read processing - run trimgalore"""
@@ -389,12 +555,18 @@ class Sickle(ProcessTool):
 
     prefix = "sickle"
 
+    streaming = True
+
     def build(self, infiles, outfiles, output_prefix):
 
         assert len(infiles) == len(outfiles)
         assert len(infiles) in (1, 2)
 
         prefix = self.prefix
+        if outfiles[0].endswith(".gz"):
+            gzip_option = "-g"
+        else:
+            gzip_option = ""
         offset = Fastq.getOffset("sanger", raises=False)
         processing_options = self.processing_options
         r = {33: 'sanger', 64: 'illumina', 59: 'solexa'}
@@ -404,7 +576,7 @@ class Sickle(ProcessTool):
             infile = infiles[0]
             outfile = outfiles[0]
             cmd = '''sickle se
-            -g %(processing_options)s
+            %(gzip_option)s %(processing_options)s
             --qual-type %(quality)s
             --output-file %(outfile)s
             --fastq-file %(infile)s
@@ -415,7 +587,7 @@ class Sickle(ProcessTool):
             infile1, infile2 = infiles
             outfile1, outfile2 = outfiles
             cmd = '''sickle pe
-            -g -s %(processing_options)s
+            %(gzip_option)s -s %(processing_options)s
             --qual-type %(quality)s
             -f %(infile1)s -r %(infile2)s
             -o %(outfile1)s -p %(outfile2)s
@@ -430,6 +602,8 @@ class Trimmomatic(ProcessTool):
 
     prefix = 'trimmomatic'
 
+    streaming = True
+
     def build(self, infiles, outfiles, output_prefix):
 
         assert len(infiles) == len(outfiles)
@@ -474,7 +648,13 @@ class FastxTrimmer(ProcessTool):
 
     prefix = "fastxtrimmer"
 
+    streaming = True
+
     def build(self, infiles, outfiles, output_prefix):
+        return " checkpoint; ".join(
+            self.buildCommands(infiles, outfiles, output_prefix))
+
+    def buildCommands(self, infiles, outfiles, output_prefix):
 
         assert len(infiles) == len(outfiles)
         assert len(infiles) in (1, 2)
@@ -483,20 +663,18 @@ class FastxTrimmer(ProcessTool):
         offset = Fastq.getOffset("sanger", raises=False)
         processing_options = self.processing_options
 
-        assert len(infiles) == len(outfiles)
-
         cmds = []
         for infile, outfile in zip(infiles, outfiles):
-
-            cmds.append('''zcat %(infile)s
+            compress_cmd = self.getCompressCommand(outfile)
+            cmds.append('''zcat -f < %(infile)s
             | fastx_trimmer
             -Q%(offset)s
             %(processing_options)s
             2>> %(output_prefix)s.log
-            | gzip > %(outfile)s
+            %(compress_cmd)s > %(outfile)s
             ;''' % locals())
 
-        return " checkpoint; ".join(cmds)
+        return cmds
 
 
 class Cutadapt(ProcessTool):
@@ -504,11 +682,17 @@ class Cutadapt(ProcessTool):
 
     prefix = "cutadapt"
 
+    streaming = True
+
     def __init__(self, options, threads=1, process_paired=0, *args, **kwargs):
         self.process_paired = process_paired
         ProcessTool.__init__(self, options, threads, *args, **kwargs)
 
     def build(self, infiles, outfiles, output_prefix):
+        return " checkpoint; ".join(
+            self.buildCommands(infiles, outfiles, output_prefix))
+
+    def buildCommands(self, infiles, outfiles, output_prefix):
         prefix = self.prefix
         processing_options = self.processing_options
         untrimmed = self.untrimmed
@@ -536,14 +720,15 @@ class Cutadapt(ProcessTool):
                     "--untrimmed-output=%(untrimmed_output1)s" \
                     "--untrimmed-output-paired=%(untrimmed_output2)s" % locals()
 
-            cmds.append('''
+            cmd = '''
             cutadapt %(processing_options)s %(in1)s %(in2)s
                      -p %(out2)s -o %(out1)s %(format)s
-            2>> %(output_prefix)s.log; ''' % locals())
+            2>> %(output_prefix)s.log; ''' % locals()
 
             if untrimmed:
-                cmds.append("gzip %s;" % untrimmed_output1)
-                cmds.append("gzip %s;" % untrimmed_output2)
+                cmd += " checkpoint; gzip %s; checkpoint; gzip %s;" % (
+                    untrimmed_output1, untrimmed_output2)
+            cmds.append(cmd)
 
         else:
             for infile, outfile in zip(infiles, outfiles):
@@ -553,15 +738,17 @@ class Cutadapt(ProcessTool):
                     processing_options += " --untrimmed-output=%s" % \
                         outfile_untrimmed
 
-                cmds.append('''zcat %(infile)s
+                compress_cmd = self.getCompressCommand(outfile)
+                cmd = '''zcat -f < %(infile)s
                 | cutadapt %(processing_options)s -
                 2>> %(output_prefix)s.log
-                | gzip > %(outfile)s;''' % locals())
+                %(compress_cmd)s > %(outfile)s;''' % locals()
 
                 if untrimmed:
-                    cmds.append("gzip %s;" % outfile_untrimmed)
+                    cmd += " checkpoint; gzip %s;" % outfile_untrimmed
+                cmds.append(cmd)
 
-        return " checkpoint; ".join(cmds)
+        return cmds
 
 
 class Reconcile(ProcessTool):
@@ -660,20 +847,27 @@ class ReverseComplement(ProcessTool):
 
     prefix = "reversecomplement"
 
+    streaming = True
+
     def build(self, infiles, outfiles, output_prefix):
+        return " checkpoint; ".join(
+            self.buildCommands(infiles, outfiles, output_prefix))
+
+    def buildCommands(self, infiles, outfiles, output_prefix):
 
         assert len(infiles) == len(outfiles)
 
         cmds = []
         for infile, outfile in zip(infiles, outfiles):
-            cmds.append('''zcat %(infile)s
+            compress_cmd = self.getCompressCommand(outfile)
+            cmds.append('''zcat -f < %(infile)s
             | python %%(scriptsdir)s/fastq2fastq.py
             --method=reverse-complement
             --log=%(output_prefix)s.log
-            | gzip > %(outfile)s;
+            %(compress_cmd)s > %(outfile)s;
             ''' % locals())
 
-        return " checkpoint; ".join(cmds)
+        return cmds
 
 
 class Pandaseq(ProcessTool):
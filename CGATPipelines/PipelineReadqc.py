@@ -13,11 +13,9 @@ import os
 import re
 import glob
 import collections
-import cStringIO
 import pandas as pd
 import CGATPipelines.Pipeline as P
 import CGAT.IOTools as IOTools
-import CGAT.CSV2DB as CSV2DB
 
 
 def FastqcSectionIterator(infile):
@@ -50,7 +48,7 @@ def FastqcSectionIterator(infile):
             yield name, status, header, data
         elif line.startswith(">>"):
             name, status = line[2:-1].split("\t")
-            data = []
+            header, data = None, []
         elif line.startswith("#"):
             header = "\t".join([x for x in line[1:-1].split("\t") if x != ""])
         else:
@@ -58,6 +56,66 @@ def FastqcSectionIterator(infile):
                 "\t".join([x for x in line[:-1].split("\t") if x != ""]))
 
 
+# cache of parsed fastqc files, see readFastqcSections
+FASTQC_CACHE = {}
+
+
+def readFastqcSections(filename):
+    '''return all sections of a FASTQC output file.
+
+    Files are parsed only once and kept in a cache. A file is parsed
+    again if it has been modified.
+
+    Arguments
+    ---------
+    filename : string
+        Filename of FASTQC output (:file:`fastqc_data.txt`).
+
+    Returns
+    -------
+    sections : OrderedDict
+        Dictionary mapping section names to tuples of (status,
+        header, data), see :func:`FastqcSectionIterator`.
+    '''
+    mtime = os.path.getmtime(filename)
+    if filename in FASTQC_CACHE and FASTQC_CACHE[filename][0] == mtime:
+        return FASTQC_CACHE[filename][1]
+
+    sections = collections.OrderedDict()
+    with IOTools.openFile(filename) as inf:
+        for name, status, header, data in FastqcSectionIterator(inf):
+            sections[name] = (status, header, data)
+
+    FASTQC_CACHE[filename] = (mtime, sections)
+    return sections
+
+
+def iterateFastqcFiles(infiles, datadir):
+    '''iterate over FASTQC output files for `infiles`.
+
+    Arguments
+    ---------
+    infiles : list
+        List of filenames with fastqc output (logging information). The
+        track name is derived from that.
+    datadir : string
+        Location of actual Fastqc output to be parsed.
+
+    Yields
+    ------
+    track : string
+        Track name
+    filename : string
+        Filename of FASTQC output. There can be several files for
+        a track, for example for paired-end data.
+    '''
+    for infile in infiles:
+        track = P.snip(os.path.basename(infile), ".fastqc")
+        filename = os.path.join(datadir, track + "*_fastqc", "fastqc_data.txt")
+        for fn in sorted(glob.glob(filename)):
+            yield track, fn
+
+
 def collectFastQCSections(infiles, section, datadir):
     '''iterate over all fastqc files and extract a particular section.
 
@@ -79,78 +137,144 @@ def collectFastQCSections(infiles, section, datadir):
 
     '''
     results = []
-    for infile in infiles:
-        track = P.snip(os.path.basename(infile), ".fastqc")
-        filename = os.path.join(datadir, track + "*_fastqc", "fastqc_data.txt")
-        for fn in glob.glob(filename):
-            for name, status, header, data in FastqcSectionIterator(
-                    IOTools.openFile(fn)):
-                if name == section:
-                    results.append((track, status, header, data))
+    for track, fn in iterateFastqcFiles(infiles, datadir):
+        sections = readFastqcSections(fn)
+        if section in sections:
+            status, header, data = sections[section]
+            results.append((track, status, header, data))
     return results
 
 
-def loadFastqc(filename,
-               backend="sqlite",
-               database="csvdb",
-               host="",
-               username="",
-               password="",
-               port=3306):
-    '''load FASTQC statistics into database.
+def guessColumnType(values):
+    '''return SQL type for a column with `values`.'''
+    for sql_type, f in (("INTEGER", int), ("FLOAT", float)):
+        try:
+            [f(x) for x in values if x != ""]
+        except ValueError:
+            continue
+        return sql_type
+    return "TEXT"
 
-    Each section will be uploaded to its own table.
 
-    Arguments
-    ----------
-    filename : string
-        Filename with FASTQC data
-    backend : string
-        Database backend. Only this is required for an sqlite database.
-    host : string
-        Database host name
-    username : string
-        Database user name
-    password : string
-        Database password
-    port : int
-        Database server port.
-    '''
+def quoteColumnName(name):
+    '''return `name` without special characters so that it can be
+    used as a column name.'''
+    name = re.sub("[^a-zA-Z0-9_]", "_", name)
+    if name[0] in "0123456789":
+        name = "_" + name
+    return name
 
-    parser = CSV2DB.buildParser()
-    (options, args) = parser.parse_args([])
-
-    options.database_backend = backend
-    options.database_host = host
-    options.database_name = database
-    options.database_username = username
-    options.database_password = password
-    options.database_port = port
-    options.allow_empty = True
-
-    for fn in glob.glob(filename):
-        prefix = os.path.basename(os.path.dirname(fn))
-        results = []
-
-        for name, status, header, data in FastqcSectionIterator(
-                IOTools.openFile(fn)):
-            # do not collect basic stats, see loadFastQCSummary
-            if name == "Basic Statistics":
-                continue
 
-            options.tablename = prefix + "_" + re.sub(" ", "_", name)
+def buildFastqcTables(infiles, datadir):
+    '''collect sections from all FASTQC output files into tables.
+
+    Each FASTQC output file is parsed only once. The sections of all
+    files are combined into long-format tables with one table per
+    section. Each row has the track name and the name of the FASTQC
+    output directory (without the ``_fastqc`` suffix) prepended.
+
+    A table called ``fastqc_status`` contains the status of every
+    section of every file.
+
+    Arguments
+    ---------
+    infiles : list
+        List of filenames with fastqc output (logging information). The
+        track name is derived from that.
+    datadir : string
+        Location of actual Fastqc output to be parsed.
 
-            inf = cStringIO.StringIO("\n".join([header] + data) + "\n")
-            CSV2DB.run(inf, options)
-            results.append((name, status))
+    Returns
+    -------
+    tables : OrderedDict
+        Dictionary mapping table names to tuples of (columns, rows).
+    '''
+    tables = collections.OrderedDict()
+    status = []
+
+    for track, fn in iterateFastqcFiles(infiles, datadir):
+        fastqc = P.snip(os.path.basename(os.path.dirname(fn)), "_fastqc")
+        for name, (section_status, header, data) in \
+                readFastqcSections(fn).items():
+            status.append((track, fastqc, name, section_status))
+
+            # do not collect basic stats, see loadFastQCSummary.
+            # Sections that passed might not contain a table.
+            if name == "Basic Statistics" or header is None:
+                continue
 
-        # load status table
-        options.tablename = prefix + "_status"
+            tablename = "fastqc_" + re.sub(" ", "_", name)
+            columns = ["track", "fastqc"] + header.split("\t")
+            if tablename not in tables:
+                tables[tablename] = (columns, [])
+            elif tables[tablename][0] != columns:
+                raise ValueError(
+                    "columns of section '%s' in %s differ from "
+                    "previous files: %s != %s" %
+                    (name, fn, columns, tables[tablename][0]))
+
+            rows = tables[tablename][1]
+            for line in data:
+                row = [track, fastqc] + line.split("\t")
+                if len(row) != len(columns):
+                    raise ValueError(
+                        "malformed line in section '%s' in %s: %s" %
+                        (name, fn, line))
+                rows.append(row)
+
+    tables["fastqc_status"] = (["track", "fastqc", "name", "status"],
+                               status)
+    return tables
+
+
+def loadFastqcTables(infiles, datadir, dbhandle):
+    '''load FASTQC statistics of all samples into database.
+
+    All FASTQC output files are parsed once and loaded into
+    long-format tables (see :func:`buildFastqcTables`). All tables
+    are written within a single transaction. Existing tables are
+    replaced.
 
-        inf = cStringIO.StringIO(
-            "\n".join(["name\tstatus"] +
-                      ["\t".join(x) for x in results]) + "\n")
-        CSV2DB.run(inf, options)
+    Arguments
+    ---------
+    infiles : list
+        List of filenames with fastqc output (logging information). The
+        track name is derived from that.
+    datadir : string
+        Location of actual Fastqc output to be parsed.
+    dbhandle : object
+        Database handle of an sqlite database.
+    '''
+    tables = buildFastqcTables(infiles, datadir)
+
+    # manage transactions explicitly, as the sqlite3 module
+    # otherwise commits before each CREATE and DROP statement
+    isolation_level = dbhandle.isolation_level
+    dbhandle.isolation_level = None
+    cc = dbhandle.cursor()
+    cc.execute("BEGIN")
+    try:
+        for tablename, (columns, rows) in tables.items():
+            types = [guessColumnType(x) for x in zip(*rows)] or \
+                ["TEXT"] * len(columns)
+            cc.execute("DROP TABLE IF EXISTS %s" % tablename)
+            cc.execute("CREATE TABLE %s (%s)" % (
+                tablename,
+                ", ".join(["%s %s" % (quoteColumnName(x), y)
+                           for x, y in zip(columns, types)])))
+            cc.executemany(
+                "INSERT INTO %s VALUES (%s)" % (
+                    tablename, ",".join("?" * len(columns))),
+                [[None if x == "" else x for x in row] for row in rows])
+            cc.execute("CREATE INDEX %s_track ON %s (track)" %
+                       (tablename, tablename))
+        cc.execute("COMMIT")
+    except Exception:
+        cc.execute("ROLLBACK")
+        raise
+    finally:
+        cc.close()
+        dbhandle.isolation_level = isolation_level
 
 
 def buildFastQCSummaryStatus(infiles, outfile, datadir):
@@ -171,20 +295,14 @@ def buildFastQCSummaryStatus(infiles, outfile, datadir):
     outf = IOTools.openFile(outfile, "w")
     names = set()
     results = []
-    for infile in infiles:
-        track = P.snip(os.path.basename(infile), ".fastqc")
-        filename = os.path.join(datadir,
-                                track + "*_fastqc",
-                                "fastqc_data.txt")
+    for track, fn in iterateFastqcFiles(infiles, datadir):
         # there can be missing sections
-        for fn in glob.glob(filename):
-            stats = collections.defaultdict(str)
-            for name, status, header, data in FastqcSectionIterator(
-                    IOTools.openFile(fn)):
-                stats[name] = status
-
-            results.append((track, fn, stats))
-            names.update(stats.keys())
+        stats = collections.defaultdict(str)
+        for name, (status, header, data) in readFastqcSections(fn).items():
+            stats[name] = status
+
+        results.append((track, fn, stats))
+        names.update(stats.keys())
 
     names = list(names)
     outf.write("track\tfilename\t%s\n" % "\t".join(names))
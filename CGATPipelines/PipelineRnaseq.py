@@ -55,6 +55,7 @@ import CGAT.Expression as Expression
 import CGAT.GTF as GTF
 import CGAT.IOTools as IOTools
 import CGATPipelines.Pipeline as P
+import CGATPipelines.PipelineDEStats as PipelineDEStats
 
 # AH: commented as I thought we wanted to avoid to
 # enable this automatically due to unwanted side
@@ -471,40 +472,11 @@ def buildExpressionStats(
         counting_method = r.group("counting_method")
         geneset = r.group("geneset")
 
-        def toDict(vals, l=2):
-            return collections.defaultdict(
-                int,
-                [(tuple(x[:l]), x[l]) for x in vals])
+        counts, status = PipelineDEStats.getTestSummary(
+            PipelineDEStats.summarizeDETable(dbhandle, tablename))
 
-        tested = toDict(Database.executewait(
-            dbhandle,
-            "SELECT treatment_name, control_name, "
-            "COUNT(*) FROM %(tablename)s "
-            "GROUP BY treatment_name,control_name" % locals()
-            ).fetchall())
-        status = toDict(Database.executewait(
-            dbhandle,
-            "SELECT treatment_name, control_name, status, "
-            "COUNT(*) FROM %(tablename)s "
-            "GROUP BY treatment_name,control_name,status"
-            % locals()).fetchall(), 3)
-        signif = toDict(Database.executewait(
-            dbhandle,
-            "SELECT treatment_name, control_name, "
-            "COUNT(*) FROM %(tablename)s "
-            "WHERE significant "
-            "GROUP BY treatment_name,control_name" % locals()
-            ).fetchall())
-
-        fold2 = toDict(Database.executewait(
-            dbhandle,
-            "SELECT treatment_name, control_name, "
-            "COUNT(*) FROM %(tablename)s "
-            "WHERE (l2fold >= 1 or l2fold <= -1) AND significant "
-            "GROUP BY treatment_name,control_name,significant"
-            % locals()).fetchall())
-
-        for treatment_name, control_name in tested.keys():
+        for treatment_name, control_name in counts.index:
+            k = (treatment_name, control_name)
             outf.write("\t".join(map(str, (
                 design,
                 geneset,
@@ -512,12 +484,12 @@ def buildExpressionStats(
                 counting_method,
                 treatment_name,
                 control_name,
-                tested[(treatment_name, control_name)],
+                counts.loc[k, "tested"],
                 "\t".join(
-                    [str(status[(treatment_name, control_name, x)])
+                    [str(status.loc[k].get(x, 0))
                      for x in keys_status]),
-                signif[(treatment_name, control_name)],
-                fold2[(treatment_name, control_name)]))) + "\n")
+                counts.loc[k, "significant"],
+                counts.loc[k, "twofold"]))) + "\n")
 
         # plot length versus P-Value
         data = Database.executewait(
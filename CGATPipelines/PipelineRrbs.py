@@ -41,6 +41,10 @@ import sqlite3
 import collections
 import itertools
 import copy
+import heapq
+import shutil
+import subprocess
+import multiprocessing
 import CGATPipelines.Pipeline as P
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
@@ -168,33 +172,9 @@ def pandasMerge(infile1, infile2, outfile, merge_type, left, right,
     '''function to merge two tsv files using pandas
     left and right are the columns to merge on'''
 
-    def columnsPeak(infile):
-        '''peak at columns to identify data type'''
-        top = pd.read_csv(infile, sep=delim, comment=com, nrows=1)
-        columns = top.columns.tolist()
-
-        # strand, contig and cpgi are all strings, hence object
-        # all other columns encoded as floats
-        dtype_dict = {}
-
-        for column in columns:
-            if ((column.endswith("-unmeth") or
-                 column.endswith("-meth") or
-                 column.endswith("-perc") or
-                 column == "read_position")):
-                dtype_dict[column] = float
-            elif (column == "strand" or
-                  column == "contig" or
-                  column == "cpgi"):
-                dtype_dict[column] = object
-            elif column == "position":
-                dtype_dict[column] = float
-
-        return dtype_dict
-
     def pandasRead(infile, peak=False):
         if peak:
-            col_dtype = columnsPeak(infile)
+            col_dtype = getMethylationColumnTypes(infile, delim, com)
             print col_dtype
             return pd.read_csv(infile, sep=delim, comment=com,
                                dtype=col_dtype, na_values="NA")
@@ -211,133 +191,492 @@ def pandasMerge(infile1, infile2, outfile, merge_type, left, right,
     merged.to_csv(outfile, sep="\t", index=False, na_rep="NA")
 
 
+def getMethylationColumnTypes(infile, delim="\t", com="#"):
+    '''peak at columns of a table with methylation calls to identify
+    data types.
+
+    Read counts, percent methylation and positions are floats. Strand,
+    contig and cpgi are strings. Other columns are not included.
+    '''
+    top = pd.read_csv(infile, sep=delim, comment=com, nrows=1)
+    columns = top.columns.tolist()
+
+    # strand, contig and cpgi are all strings, hence object
+    # all other columns encoded as floats
+    dtype_dict = {}
+
+    for column in columns:
+        if ((column.endswith("-unmeth") or
+             column.endswith("-meth") or
+             column.endswith("-perc") or
+             column == "read_position")):
+            dtype_dict[column] = float
+        elif (column == "strand" or
+              column == "contig" or
+              column == "cpgi"):
+            dtype_dict[column] = object
+        elif column == "position":
+            dtype_dict[column] = float
+
+    return dtype_dict
+
+
+def iterateMethylationTable(infile, columns=None, chunk_size=1000000,
+                            delim="\t", com="#"):
+    '''iterate over a table with methylation calls in chunks.
+
+    Columns are read with the types from :func:`getMethylationColumnTypes`
+    so that they are the same in all chunks. Memory usage depends on
+    `chunk_size`, but not on the size of the table.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of table with methylation calls, for example the
+        output of :func:`mergeAndDrop`.
+    columns : list
+        Columns to read. If not given, all columns are read.
+    chunk_size : int
+        Number of rows to read at a time.
+
+    Returns
+    -------
+    chunks : iterator
+        Iterator over :class:`pandas.DataFrame` objects.
+    '''
+    dtype = getMethylationColumnTypes(infile, delim, com)
+    if columns is not None:
+        dtype = dict([(x, y) for x, y in dtype.items() if x in columns])
+
+    for chunk in pd.read_csv(infile, sep=delim, comment=com,
+                             dtype=dtype, na_values="NA",
+                             usecols=columns, chunksize=chunk_size):
+        yield chunk
+
+
+def getCoverageColumns(columns):
+    '''return pairs of columns with methylated and unmethylated
+    read counts for each sample in `columns`.'''
+    return [(x, x[:-len("meth")] + "unmeth") for x in columns
+            if x.endswith("-meth") and
+            x[:-len("meth")] + "unmeth" in columns]
+
+
+def getSampleCoverage(chunk, coverage_columns):
+    '''return read coverage of each sample in `chunk`.
+
+    Missing counts are treated as 0.
+
+    Arguments
+    ---------
+    chunk : pandas.DataFrame
+        Chunk of a table with methylation calls.
+    coverage_columns : list
+        Column pairs from :func:`getCoverageColumns`.
+
+    Returns
+    -------
+    coverage : numpy array
+        Array with one row per CpG and one column per sample.
+    '''
+    meth = chunk[[x for x, y in coverage_columns]].values
+    unmeth = chunk[[y for x, y in coverage_columns]].values
+    return np.nan_to_num(meth) + np.nan_to_num(unmeth)
+
+
+# lookup table to convert ASCII characters to upper case
+UPPER_CASE = np.arange(256, dtype=np.uint8)
+UPPER_CASE[ord("a"):ord("z") + 1] -= 32
+
+
+def findMotif(sequence, motif):
+    '''return 0-based start positions of `motif` in `sequence`.
+
+    `sequence` is an array of upper case ASCII values. Overlapping
+    matches are removed from left to right, as in
+    :func:`re.finditer`.
+    '''
+    k = len(motif)
+    n = len(sequence) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    hits = np.ones(n, dtype=np.bool_)
+    for offset, base in enumerate(motif.upper()):
+        hits &= sequence[offset:offset + n] == ord(base)
+    starts = np.nonzero(hits)[0]
+
+    # only possible for motifs that overlap with themselves
+    if len(starts) > 1 and (np.diff(starts) < k).any():
+        keep = []
+        last = -k
+        for start in starts:
+            if start >= last + k:
+                keep.append(start)
+                last = start
+        starts = np.array(keep, dtype=np.int64)
+
+    return starts
+
+
+def expandWindows(cpgs, starts, ends):
+    '''find CpGs in windows.
+
+    Arguments
+    ---------
+    cpgs : numpy array
+        Sorted 0-based positions of the C in CpGs.
+    starts : numpy array
+        0-based window starts.
+    ends : numpy array
+        0-based window ends, exclusive.
+
+    Returns
+    -------
+    index : numpy array
+        Index in `cpgs` of CpGs with both bases within a window.
+    window : numpy array
+        Index of the window for each CpG in `index`.
+    '''
+    lo = np.searchsorted(cpgs, starts)
+    hi = np.searchsorted(cpgs, ends - 1)
+    counts = np.maximum(hi - lo, 0)
+    window = np.repeat(np.arange(len(starts)), counts)
+    offsets = (np.arange(counts.sum()) -
+               np.repeat(np.cumsum(counts) - counts, counts))
+    return np.repeat(lo, counts) + offsets, window
+
+
+def setLast(values, index, new_values):
+    '''set `values` at `index` to `new_values`.
+
+    If an index appears several times, the last value is used.
+    '''
+    if len(index) == 0:
+        return
+    first = np.unique(index[::-1], return_index=True)[1]
+    take = len(index) - 1 - first
+    values[index[take]] = new_values[take]
+
+
+def digestContig(sequence, motif="CCGG", cut_position=1, read_length=51,
+                 paired=False, min_fragment_length=25,
+                 max_fragment_length=300):
+    '''perform in-silico digest of `sequence` and find the read
+    positions of CpGs.
+
+    Fragments between consecutive restriction sites with a length
+    between `min_fragment_length` and `max_fragment_length`
+    (exclusive) are sequenced from both strands. On the forward
+    strand the read starts at the cut site at the start of the
+    fragment, on the reverse strand at the cut site at the end of
+    the fragment. If `paired` is set, the second read covers the
+    other end of the fragment on the same strand. Read positions
+    are taken from the first read if a CpG is covered by both.
+
+    Arguments
+    ---------
+    sequence : string
+        Genomic sequence.
+    motif : string
+        Recognition site of the restriction enzyme. The site is
+        assumed to be palindromic.
+    cut_position : int
+        Position of the cut within `motif` on the forward strand.
+    read_length : int
+        Read length.
+    paired : bool
+        Paired-end reads.
+    min_fragment_length : int
+        Minimum fragment length.
+    max_fragment_length : int
+        Maximum fragment length.
+
+    Returns
+    -------
+    cpgs : numpy array
+        0-based positions of the C in all CpGs in `sequence`.
+    forward : numpy array
+        1-based read position of the C on the forward strand. 0 if
+        not covered by a read.
+    reverse : numpy array
+        1-based read position of the G on the reverse strand. 0 if
+        not covered by a read.
+    '''
+
+    seq = UPPER_CASE[np.frombuffer(sequence, dtype=np.uint8)]
+    cpgs = np.nonzero((seq[:-1] == ord("C")) & (seq[1:] == ord("G")))[0]
+    forward = np.zeros(len(cpgs), dtype=np.int64)
+    reverse = np.zeros(len(cpgs), dtype=np.int64)
+
+    sites = findMotif(seq, motif)
+    k, o = len(motif), cut_position
+    start, end = sites[:-1], sites[1:]
+    length = end - start
+    selected = ((length > min_fragment_length) &
+                (length < max_fragment_length))
+    start, end, length = start[selected], end[selected], length[selected]
+
+    # reads from fragments of at least read length include an extra
+    # base to detect a CpG at the last read position
+    is_long = length >= read_length
+
+    # read windows on forward and reverse strand
+    forward_start = start + o
+    forward_end = np.where(is_long, forward_start + read_length + 1, end + o)
+    reverse_end = end + k - o
+    reverse_start = np.where(is_long, reverse_end - read_length - 1,
+                             start + k - o)
+
+    if paired:
+        # second reads, overwritten by first reads below
+        index, window = expandWindows(
+            cpgs, np.maximum(forward_start, end + o - read_length), end + o)
+        setLast(forward, index, (end + o)[window] - cpgs[index])
+
+        index, window = expandWindows(
+            cpgs, start + k - o,
+            np.minimum(reverse_end, start + k - o + read_length))
+        setLast(reverse, index, cpgs[index] - (start + k - o)[window] + 2)
+
+    index, window = expandWindows(cpgs, forward_start, forward_end)
+    setLast(forward, index, cpgs[index] - forward_start[window] + 1)
+
+    index, window = expandWindows(cpgs, reverse_start, reverse_end)
+    setLast(reverse, index, reverse_end[window] - cpgs[index] - 1)
+
+    return cpgs, forward, reverse
+
+
+def _digestContigToText(args):
+    '''digest contig and return output as text.'''
+    contig, sequence, kwargs = args
+    cpgs, forward, reverse = digestContig(sequence, **kwargs)
+
+    ncpgs = len(cpgs)
+    if ncpgs == 0:
+        return ""
+
+    # two lines per CpG, one for each strand
+    positions = np.empty(2 * ncpgs, dtype=np.int64)
+    positions[0::2] = cpgs + 1
+    positions[1::2] = cpgs + 2
+    read_positions = np.empty(2 * ncpgs, dtype=np.int64)
+    read_positions[0::2] = forward
+    read_positions[1::2] = reverse
+
+    df = pd.DataFrame(collections.OrderedDict((
+        ("contig", np.repeat(contig, 2 * ncpgs)),
+        ("position", positions),
+        ("strand", np.tile(["+", "-"], ncpgs)),
+        ("read_position", np.where(read_positions > 0,
+                                   read_positions.astype(str), "NA")))))
+    return df.to_csv(sep="\t", header=False, index=False)
+
+
 @cluster_runnable
-def fasta2CpG(infile, outfile):
+def fasta2CpG(infile, outfile, motif="CCGG", cut_position=1,
+              read_length=51, paired=False, min_fragment_length=25,
+              max_fragment_length=300, threads=1):
     '''perform an in-silico digest at MspI sites and return all CpGs
-    thorughout the genome, whether they are in a MspI fragment
-    and if so, what their read position is'''
-    # to do: paramterise (digestion site, read length, PE/SE)
-
-    # AH: Use FastaIterator
-    fasta = FastaIterator.FastaIterator(IOTools.openFile(infile, "r"))
-    temp_contig = fasta.next()
-
-    outfile = IOTools.openFile(outfile, "w")
-    outfile.write("contig\tposition\tstrand\tread_position\n")
-
-    while len(temp_contig.seq) > 1:
-        contig, contig_seq = temp_contig.title, temp_contig.sequence
-        # find MspI sites
-        iter_pos = re.finditer("[cC][cC][gG][gG]", contig_seq)
-        pos_start = [x.start(0) for x in iter_pos]
-        # loop through pairs of MspI sites and add positions to dictionary
-        MspI_cpg_dict = {}
-        for n in range(0, len(pos_start)-1):
-            frag_length = pos_start[n+1] - pos_start[n]
-            if frag_length > 25 and frag_length < 300:
-                if frag_length >= 51:
-                    # need to include additional base at the end of the read
-                    # to check for final CG
-                    read_f = contig_seq[pos_start[n]+1:pos_start[n]+53]
-                    read_r = contig_seq[pos_start[n+1]-49:pos_start[n+1]+3]
-                else:
-                    read_f = contig_seq[pos_start[n]+1:pos_start[n+1]+1]
-                    read_r = contig_seq[pos_start[n]+3:pos_start[n+1]+3]
-                # find positions of CGs in in silico reads
-                f_cgs = re.finditer("[cC][gG]", read_f)
-                r_cgs = re.finditer("[cC][gG]", read_r)
-                for x in f_cgs:
-                    # 1-based read position
-                    read_pos = x.start(0) + 1
-                    # contig position 1-based
-                    contig_position = pos_start[n] + 1 + read_pos
-                    MspI_cpg_dict[contig_position] = read_pos
-                for x in r_cgs:
-                    # 1-based read position
-                    read_pos = len(read_r)-(x.start(0)+1)
-                    # contig position 1-based
-                    contig_position = pos_start[n+1] + 4 - read_pos
-                    MspI_cpg_dict[contig_position] = read_pos
-
-        # find location of ALL cpgs
-        all_cpgs = re.finditer("[cC][gG]", temp_contig[1])
-        for cpg in all_cpgs:
-            # 2 Cs for each CpG (one on each strand)
-            c_pos, g_pos = (cpg.start(0) + 1, cpg.start(0) + 2)
-            read_pos = "NA"
-            # check if position of C is in the dictionary of MspI CpGs
-            if c_pos in MspI_cpg_dict:
-                read_pos = MspI_cpg_dict[c_pos]
-            outfile.write("%s\t%s\t%s\t%s\n" % (contig, c_pos,
-                                                "+", read_pos))
-            read_pos = "NA"
-            if g_pos in MspI_cpg_dict:
-                read_pos = MspI_cpg_dict[g_pos]
-            outfile.write("%s\t%s\t%s\t%s\n" % (contig, g_pos,
-                                                "-", read_pos))
-        temp_contig = fasta.next()
-    outfile.close()
+    throughout the genome, whether they are in a MspI fragment
+    and if so, what their read position is.
+
+    Contigs are processed with `threads` processes. See
+    :func:`digestContig` for the other arguments.
+    '''
+
+    kwargs = {"motif": motif,
+              "cut_position": cut_position,
+              "read_length": read_length,
+              "paired": paired,
+              "min_fragment_length": min_fragment_length,
+              "max_fragment_length": max_fragment_length}
+
+    records = ((record.title, record.sequence, kwargs)
+               for record in FastaIterator.iterate(
+                   IOTools.openFile(infile, "r")))
+
+    outf = IOTools.openFile(outfile, "w")
+    outf.write("contig\tposition\tstrand\tread_position\n")
+
+    if threads > 1:
+        # limit number of contigs kept in memory
+        pool = multiprocessing.Pool(threads)
+        pending = collections.deque()
+        for record in records:
+            pending.append(pool.apply_async(_digestContigToText, (record,)))
+            if len(pending) >= 2 * threads:
+                outf.write(pending.popleft().get())
+        while pending:
+            outf.write(pending.popleft().get())
+        pool.close()
+        pool.join()
+    else:
+        for record in records:
+            outf.write(_digestContigToText(record))
+
+    outf.close()
+
+
+def sortByCoordinate(infile, outfile, tmpdir, header=False,
+                     buffer_size="1G"):
+    '''sort tab-separated `infile` by contig and position.
+
+    Contig and position are expected in the first two columns.
+    Comment lines starting with ``#`` are removed. Sorting is done
+    with unix sort and is thus not limited by memory.
+
+    Arguments
+    ---------
+    infile : string
+        Input filename, can be compressed.
+    outfile : string
+        Output filename.
+    tmpdir : string
+        Directory for temporary files of sort.
+    header : bool
+        If True, remove the first (non-comment) line.
+    buffer_size : string
+        Memory used by sort.
+    '''
+
+    start = 2 if header else 1
+    statement = (
+        "zcat -f < %(infile)s | grep -v '^#' | tail -n +%(start)i | "
+        "LC_ALL=C sort -k1,1 -k2,2n -S %(buffer_size)s -T %(tmpdir)s "
+        "> %(outfile)s" % locals())
+    subprocess.check_call(statement, shell=True)
+
+
+def iterateCoordinates(infile, index):
+    '''iterate over lines in `infile` sorted by contig and position.
+
+    Yields
+    ------
+    entry : tuple
+        Tuple of (contig, position, index, fields) with integer
+        position.
+    '''
+    for line in infile:
+        fields = line[:-1].split("\t")
+        yield fields[0], int(fields[1]), index, fields
 
 
 @cluster_runnable
-def mergeAndDrop(cpgs, infiles, outfile):
+def mergeAndDrop(cpgs, infiles, outfile, buffer_size="1G",
+                 chunk_size=100000):
     '''merge bismark files with flat file of all cpgs
-    into a single dataframe and drop unwanted columns'''
-    # very memory intensive!
+    into a single table and drop unwanted columns.
+
+    All files are sorted by coordinate and then merged in a single
+    pass, so that memory usage depends on the number of files but
+    not on the number of CpGs. The output is sorted by contig and
+    position.
+
+    The output contains percent methylation and counts of methylated
+    and unmethylated reads of each sample, with the samples in
+    reverse order of `infiles`, followed by the columns in `cpgs`.
+    Sites not in `cpgs` are output with missing values in the
+    columns from `cpgs` except for contig and position.
+
+    Arguments
+    ---------
+    cpgs : string
+        Filename with all CpGs, with contig and position
+        as first two columns and a header.
+    infiles : list
+        Bismark coverage files.
+    outfile : string
+        Output filename.
+    buffer_size : string
+        Memory used for sorting input files.
+    chunk_size : int
+        Number of lines to output at a time.
+    '''
 
-    # prepare dataframe with cpg locations
-    all_cpgs = pd.io.parsers.read_csv(cpgs, sep='\t', comment='#')
-    all_cpgs['location'] = (all_cpgs['contig'] + ":" +
-                            all_cpgs['position'].apply(str))
+    with IOTools.openFile(cpgs) as inf:
+        for line in inf:
+            if not line.startswith("#"):
+                cpg_columns = line[:-1].split("\t")
+                break
 
-    # for loop through files and merge each time with previous merged df
-    for infile in infiles:
+    nsamples = len(infiles)
+    sample_columns = []
+    for infile in reversed(infiles):
         sample_name = re.sub("_.*bismark.*", "", os.path.basename(infile))
+        sample_columns.extend([hjoin([sample_name, "perc"]),
+                               hjoin([sample_name, "meth"]),
+                               hjoin([sample_name, "unmeth"])])
+
+    ncolumns = len(sample_columns) + len(cpg_columns)
+    cpg_offset = len(sample_columns)
+
+    tmpdir = P.getTempDir()
+    try:
+        # the cpg file is the last input
+        sorted_files = []
+        headers = [False] * nsamples + [True]
+        for index, infile in enumerate(infiles + [cpgs]):
+            sorted_file = os.path.join(tmpdir, "%i.tsv" % index)
+            sortByCoordinate(infile, sorted_file, tmpdir,
+                             header=headers[index],
+                             buffer_size=buffer_size)
+            sorted_files.append(sorted_file)
+
+        inputs = [open(x) for x in sorted_files]
+        merged = heapq.merge(*[iterateCoordinates(handle, index)
+                               for index, handle in enumerate(inputs)])
+
+        outf = IOTools.openFile(outfile, "w")
+        outf.write("\t".join(sample_columns + cpg_columns) + "\n")
+
+        lines = []
+        for key, entries in itertools.groupby(merged, lambda x: x[:2]):
+            row = ["NA"] * ncolumns
+            row[cpg_offset] = key[0]
+            row[cpg_offset + 1] = str(key[1])
+            for contig, position, index, fields in entries:
+                if index == nsamples:
+                    row[cpg_offset:] = fields
+                else:
+                    # samples are output in reverse order
+                    offset = 3 * (nsamples - index - 1)
+                    row[offset:offset + 3] = fields[3:6]
+            lines.append("\t".join(row) + "\n")
 
-        # prepare temporary dataframe
-        column_names = ["contig", "start", "stop", "perc",
-                        "meth", "unmeth"]
-        temp_meth_df = pd.io.parsers.read_csv(infile, sep='\t',
-                                              comment='#', header=None,
-                                              names=column_names)
-        temp_meth_df['location'] = (temp_meth_df['contig'] + ":" +
-                                    temp_meth_df['start'].apply(str))
-        temp_meth_df.drop(['contig', 'start', 'stop'], axis=1, inplace=True)
-        temp_meth_df.columns = [hjoin([sample_name, "perc"]),
-                                hjoin([sample_name, "meth"]),
-                                hjoin([sample_name, "unmeth"]),
-                                'location']
-
-        # merge into temp dataframe
-        merged = temp_meth_df.merge(all_cpgs, how="outer", left_on='location',
-                                    right_on='location', sort=False)
-        all_cpgs = merged.copy(deep=True)
-
-    merged.drop('location', axis=1, inplace=True)
-    merged.to_csv(outfile, sep="\t", index=False, na_rep="NA")
+            if len(lines) >= chunk_size:
+                outf.write("".join(lines))
+                lines = []
 
+        outf.write("".join(lines))
+        outf.close()
 
-@cluster_runnable
-def subsetToCovered(infile, outfile, cov_threshold=10):
-    '''take a flat file containing methylation calls for all cpgs
-    and output a flat file containing only sites above coverage threshold'''
-    # to do: generalise function. Currently expects infile to contain meth
-    # column followed by unmeth column for each sample
+        for inf in inputs:
+            inf.close()
+    finally:
+        shutil.rmtree(tmpdir)
 
-    raw = pd.io.parsers.read_csv(infile, sep='\t',  comment='#')
-    meth_cols = [x for x in raw.columns.tolist()
-                 if re.match(".*meth|.*unmeth]", x)]
-    meth_df = raw.ix[:, meth_cols]
 
-    def minCov(row):
-        # take every meth count column and add next column
-        # (e.g unmeth count) and find min for row
-        return min([np.nansum([i, k]) for i, k in zip(row[0::2], row[1::2])])
+@cluster_runnable
+def subsetToCovered(infile, outfile, cov_threshold=10, chunk_size=1000000):
+    '''take a flat file containing methylation calls for all cpgs
+    and output a flat file containing only sites above coverage threshold
 
-    meth_df['min_cov'] = meth_df.apply(minCov, axis=1)
-    high_cov = raw[meth_df['min_cov'] >= cov_threshold]
-    high_cov['cpgi'].fillna('Non-CpGIsland', inplace=True)
-    high_cov.to_csv(outfile, sep="\t", index=False, na_rep="NA")
+    A site is output if the coverage is at least `cov_threshold` in
+    all samples. The file is processed in chunks of `chunk_size` rows.
+    '''
+    header = True
+    with IOTools.openFile(outfile, "w") as outf:
+        for chunk in iterateMethylationTable(infile, chunk_size=chunk_size):
+            if header:
+                coverage_columns = getCoverageColumns(chunk.columns.tolist())
+            min_cov = getSampleCoverage(chunk, coverage_columns).min(axis=1)
+            high_cov = chunk[min_cov >= cov_threshold].copy()
+            high_cov['cpgi'] = high_cov['cpgi'].fillna('Non-CpGIsland')
+            high_cov.to_csv(outf, sep="\t", index=False, na_rep="NA",
+                            header=header)
+            header = False
 
 
 @cluster_runnable
@@ -676,17 +1015,26 @@ def addTreatmentMean(infile, outfile):
 # this should be transferred into farm.py
 @cluster_runnable
 def splitDataframeClusters(infile, prefix, suffix):
+    '''split a table with methylation calls into files of clusters
+    of CpGs for analysis with M3D.
+
+    A cluster is a run of more than 10 CpGs within 100 bp of the
+    first CpG. Clusters are combined into files of at least 10000
+    CpGs, so that clusters are never split between files.
+    '''
     df = pd.read_csv(infile, comment='#', sep="\t")
     df.sort(columns=["contig", "position"], inplace=True)
     df.drop(["strand", "read_position"], inplace=True, axis=1)
     positions = df['position'].astype('int').tolist()
     contigs = df['contig'].tolist()
-    # df.set_index('position', inplace=True)
-    current_pos, count, splits, n, first_pos = (0,)*5
+    current_pos, count, first_pos = (0,)*3
     current_contig = ""
     size = 10
     distance = 100
     split_at = 10000
+
+    # collect clusters as slices of the sorted table
+    clusters = []
     for ix in range(0, len(positions)):
         next_pos = positions[ix]
         next_contig = contigs[ix]
@@ -695,99 +1043,127 @@ def splitDataframeClusters(infile, prefix, suffix):
             count += 1
         else:
             if count >= size:
-                temp_cluster_df = df[first_pos:ix+1]
-                if n >= split_at:
-                    identifier = splits*split_at
-                    filename = "%(prefix)s%(identifier)i%(suffix)s" % locals()
-                    cluster_df.to_csv(
-                        filename, index=False, header=True, sep="\t",
-                        dtype={'position': int})
-                    n = 0
-                    splits += 1
-                if n == 0:
-                    cluster_df = temp_cluster_df
-                    n = count
-                else:
-                    cluster_df = cluster_df.append(temp_cluster_df)
-                    n += count
+                clusters.append((first_pos, ix+1, count))
             current_pos = next_pos
             current_contig = next_contig
             first_pos = ix+1
             count = 0
 
+    def writeClusters(clusters, identifier):
+        filename = "%s%i%s" % (prefix, identifier, suffix)
+        cluster_df = pd.concat([df[start:end] for start, end, n in clusters])
+        cluster_df.to_csv(filename, index=False, header=True, sep="\t")
+
+    # combine clusters into files, each file is written
+    # in a single operation
+    splits, n, batch = 0, 0, []
+    for cluster in clusters:
+        if n >= split_at:
+            writeClusters(batch, splits * split_at)
+            splits += 1
+            n, batch = 0, []
+        batch.append(cluster)
+        n += cluster[2]
+
     # make sure final clusters are written out into smaller final file
-    if n < split_at:
-        identifier = splits*split_at
-        filename = "%(prefix)s%(identifier)i%(suffix)s" % locals()
-        cluster_df.to_csv(
-            filename, index=False, header=True, sep="\t",
-            dtype={'position': int})
+    if batch:
+        writeClusters(batch, splits * split_at)
+
+    E.info("wrote %i clusters to %i files" % (len(clusters), splits + 1))
 
 
 @cluster_runnable
-def calculateCoverage(infile, outfile):
+def calculateCoverage(infile, outfile, chunk_size=1000000):
     ''' calculate the coverage at CpG islands
-    and non-CpG Islands '''
+    and non-CpG Islands
 
-    with IOTools.openFile(outfile, "w") as outf:
-        outf.write("\t".join(("coverage", "cpgi")) + "\n")
-
-        with IOTools.openFile(infile) as inf:
-
-            header = inf.next().strip().split("\t")
-            coverage_cols = ["meth" in x for x in header]
-            n_samples = sum(coverage_cols)/2
-            cpgi_col = header.index('cpgi')
-
-            line_n = 0
-            for line in inf:
-                if line_n % 1000000 == 0:
-                    E.info("parsed %i lines" % line_n)
-
-                line_n += 1
-                line = line.strip().split("\t")
+    The coverage is the average number of reads over all samples.
+    The file is processed in chunks of `chunk_size` rows.'''
 
-                cov_values = [line[x] for x in range(0, len(line))
-                              if coverage_cols[x]]
+    header = getMethylationColumnTypes(infile).keys()
+    coverage_columns = getCoverageColumns(header)
+    columns = [x for pair in coverage_columns for x in pair] + ["cpgi"]
 
-                cov = np.nansum(np.genfromtxt(
-                    np.array(cov_values))) / n_samples
+    nrows = 0
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("\t".join(("coverage", "cpgi")) + "\n")
 
-                if line[cpgi_col] == "CpGIsland":
-                    cpgi = "CpGIsland"
-                else:
-                    cpgi = "Non-CpGIsland"
+        for chunk in iterateMethylationTable(infile, columns=columns,
+                                             chunk_size=chunk_size):
+            coverage = getSampleCoverage(chunk, coverage_columns)
+            out = pd.DataFrame(collections.OrderedDict((
+                ("coverage", coverage.sum(axis=1) / len(coverage_columns)),
+                ("cpgi", np.where(chunk["cpgi"] == "CpGIsland",
+                                  "CpGIsland", "Non-CpGIsland")))))
+            out.to_csv(outf, sep="\t", index=False, header=False)
+
+            nrows += len(chunk)
+            E.info("parsed %i lines" % nrows)
+
+
+# bins for coverage plots, lower bounds are exclusive except
+# for the first bin
+COVERAGE_BINS = (0, 1, 5, 10, 20, 1000000)
+COVERAGE_LABELS = ("< 1", "[ >1 - 5 ]", "[ >5 - 10 ]",
+                   "[ >10 - 20 ]", "> 20")
+
+
+def binCoverage(infile, outfile, chunk_size=1000000):
+    '''count CpGs in coverage bins at CpG islands and non-CpG islands.
+
+    Arguments
+    ---------
+    infile : string
+        Output of :func:`calculateCoverage`.
+    outfile : string
+        Output filename. The output has the columns cpgi, binned
+        and count.
+    chunk_size : int
+        Number of rows to read at a time.
+    '''
+    nbins = len(COVERAGE_LABELS)
+    counts = collections.OrderedDict()
+    for chunk in pd.read_csv(infile, sep="\t", chunksize=chunk_size):
+        # sites with coverage above the last bin are not counted
+        bins = np.maximum(np.searchsorted(
+            COVERAGE_BINS, chunk["coverage"].values, side="left"), 1) - 1
+        cpgi = chunk["cpgi"].values
+        for key in np.unique(cpgi):
+            if key not in counts:
+                counts[key] = np.zeros(nbins + 1, dtype=np.int64)
+            counts[key] += np.bincount(bins[cpgi == key],
+                                       minlength=nbins + 1)[:nbins + 1]
 
-                outf.write("\t".join(map(str, (cov, cpgi))) + "\n")
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write("\t".join(("cpgi", "binned", "count")) + "\n")
+        for key, values in counts.items():
+            for label, count in zip(COVERAGE_LABELS, values):
+                outf.write("\t".join((key, label, str(count))) + "\n")
 
 
 @cluster_runnable
 def plotCoverage(infile, outfiles):
     ''' plot the coverage at CpG islands
-    and non-CpG Islands '''
+    and non-CpG Islands
+
+    CpGs are counted in coverage bins with :func:`binCoverage` and
+    only the counts are passed to R.'''
 
     bar_plot, pie_plot = outfiles
     binned_out = P.snip(bar_plot, "_bar.png") + "_binned.tsv"
 
+    binCoverage(infile, binned_out)
+    levels = '","'.join(COVERAGE_LABELS)
+
     plotCoverage = r('''
     library(ggplot2)
-    library(plyr)
     library(RColorBrewer)
 
-    function(infile, binned_out, bar_plot, pie_plot){
-
-    df = read.table(infile, sep="\t", header=TRUE)
+    function(binned_out, bar_plot, pie_plot){
 
-    df$binned = .bincode(
-        df$coverage, breaks = c(0,1,5,10,20,1000000), include.lowest=TRUE)
+    df = read.table(binned_out, sep="\t", header=TRUE)
 
-    df$binned = factor(df$binned)
-
-    df$binned = revalue(df$binned,
-        c("1"="< 1", "2"="[ >1 - 5 ]", "3"="[ >5 - 10 ]",
-          "4"="[ >10 - 20 ]", "5"="> 20"))
-
-    write.table(df, binned_out, quote=FALSE, sep="\t", row.names=FALSE)
+    df$binned = factor(df$binned, levels=c("%(levels)s"))
 
     s_f = scale_fill_manual(name="Coverage", values=brewer.pal(5, "YlOrRd"))
 
@@ -811,22 +1187,76 @@ def plotCoverage(infile, outfiles):
         strip.text=l_txt,
         aspect.ratio=1)
 
-    p = ggplot(df, aes(x=cpgi, fill=as.factor(binned))) +
-        geom_bar(position="fill", stat="bin") +
+    p = ggplot(df, aes(x=cpgi, y=count, fill=binned)) +
+        geom_bar(position="fill", stat="identity") +
         theme_bw() + s_f + x + t2 + y
 
     ggsave(bar_plot, height=4, width=5)
 
-    p = ggplot(df, aes(factor(0), fill=as.factor(binned))) +
-        geom_bar(position="fill", stat="bin", width=1) +
+    p = ggplot(df, aes(factor(0), y=count, fill=binned)) +
+        geom_bar(position="fill", stat="identity", width=1) +
         coord_polar(theta = "y") +
         facet_wrap(~cpgi) +
         theme_bw() + s_f + x + t + y
 
     ggsave(pie_plot, height=3, width=6)
-    }''')
+    }''' % locals())
+
+    plotCoverage(binned_out, bar_plot, pie_plot)
+
 
-    plotCoverage(infile, binned_out, bar_plot, pie_plot)
+@cluster_runnable
+def calculateMethFrequency(infile, outfile, chunk_size=1000000):
+    '''count CpGs in bins of percent methylation for each sample
+    at CpG islands and non-CpG islands.
+
+    Percent methylation is binned in steps of 10%. The file is
+    processed in chunks of `chunk_size` rows.
+
+    Arguments
+    ---------
+    infile : string
+        Table with methylation calls and a ``cpgi`` column.
+    outfile : string
+        Output filename. The output has one row per sample, CpG
+        island status and bin with the number of CpGs.
+    chunk_size : int
+        Number of rows to read at a time.
+    '''
+    header = pd.read_csv(infile, sep="\t", comment="#", nrows=0)
+    perc_columns = [x for x in header.columns if "perc" in x]
+    bins = np.arange(0, 100, 10)
+    nbins = len(bins) + 1
+
+    counts = collections.defaultdict(lambda: np.zeros(nbins, dtype=np.int64))
+    for chunk in iterateMethylationTable(
+            infile, columns=perc_columns + ["cpgi"], chunk_size=chunk_size):
+        cpgi = chunk["cpgi"].values
+        # sites without CpG island status are not counted
+        has_cpgi = chunk["cpgi"].notnull().values
+        for column in perc_columns:
+            binned = np.digitize(chunk[column].values, bins)
+            for key in np.unique(cpgi[has_cpgi]):
+                counts[(column, key)] += np.bincount(
+                    binned[cpgi == key], minlength=nbins)
+
+    rows = []
+    for (column, key), values in counts.items():
+        # sample names as in database tables
+        variable = re.sub("[,;.:\-\+/ ()%?]", "_", column)
+        rows.extend([(variable, key, value, count)
+                     for value, count in enumerate(values) if count > 0])
+    rows.sort()
+
+    df = pd.DataFrame.from_records(
+        rows, columns=["variable", "cpgi", "value", "0"])
+    df['tissue'] = [x.split("_")[0] for x in df['variable']]
+    df['treatment_replicate'] = ["-".join(x.split("_")[1:3])
+                                 for x in df['variable']]
+    df['value'] = ["[ %i - %i ]" % ((x - 1) * 10, x * 10)
+                   for x in df['value']]
+
+    df.to_csv(outfile, sep="\t", index=False)
 
 
 @cluster_runnable
@@ -885,12 +1315,38 @@ def plotMethFrequency(infile, outfile):
     plotMethFrequency(infile, outfile)
 
 
+def writeMethylationCounts(df, samples, outf):
+    '''write read counts of `samples` for reading into R.
+
+    The output has no header and the columns contig and position,
+    followed by the number of methylated reads of each sample and the
+    number of unmethylated reads of each sample. Counts are integers
+    and missing counts are output as ``NA``.
+
+    Arguments
+    ---------
+    df : pandas.DataFrame
+        Table with methylation calls.
+    samples : list
+        Samples to output.
+    outf : file
+        Output file.
+    '''
+    columns = ["contig", "position"]
+    columns.extend([x + "-meth" for x in samples])
+    columns.extend([x + "-unmeth" for x in samples])
+    df.to_csv(outf, sep="\t", columns=columns, header=False, index=False,
+              na_rep="NA", float_format="%.0f")
+
+
 @cluster_runnable
 def calculateM3DStat(infile, outfile, design,
                      pair=None, groups=None):
-    '''calculate M3D stats from dataframe'''
+    '''calculate M3D stats from dataframe
+
+    Read counts are passed to R as integer matrices through a
+    temporary file, see :func:`writeMethylationCounts`.'''
     # assumes meth columns will be named *-*-*-meth
-    df = pd.read_csv(infile, sep="\t")
     design_df = pd.read_csv(design, sep="\t")
 
     design_df = design_df.ix[design_df['include'] == 1, ]
@@ -912,39 +1368,36 @@ def calculateM3DStat(infile, outfile, design,
         design_df_subset = design_df[design_df['pair'] == pair]
         conditions = design_df_subset['group']
 
-    samples = design_df_subset['track']
+    samples = design_df_subset['track'].tolist()
     keep_columns = ["contig", "position"]
-    keep_columns.extend([x + "-perc" for x in samples])
-    keep_columns.extend([x + y for x in design_df_subset['track']
+    keep_columns.extend([x + y for x in samples
                          for y in ["-unmeth", "-meth"]])
 
-    df = df.ix[:, keep_columns]
+    tmpfile = P.getTempFilename(shared=True)
+    nrows = 0
+    with IOTools.openFile(tmpfile, "w") as outf:
+        for chunk in iterateMethylationTable(infile, columns=keep_columns):
+            writeMethylationCounts(chunk, samples, outf)
+            nrows += len(chunk)
+    E.info("passing %i CpGs in %i samples to M3D" % (nrows, len(samples)))
+
     ncols = len(samples)
     samples = '","'.join(samples)
     conditions = '","'.join(conditions)
-    r_df = com.convert_to_r_dataframe(df)
-
-    out = open(outfile, "w")
-    out.write("ncols: %s\n" % ncols)
-    out.write("conditions: %s\n" % conditions)
-    out.write("samples: %s\n" % samples)
-    out.write("pair: %s\n" % pair)
-    out.write("groups: %s\n" % groups)
-    out.write("%i, %i" % df.shape)
-    out.close()
 
     func = r('''
-    function(df){
+    function(infile){
     library(M3D)
     library(BiSeq)
-rowRanges <- GRanges(seqnames = Rle(as.character(df$contig)),
-    ranges = IRanges(start = df$position, end= df$position))
+    df <- read.table(infile, sep="\t", header=FALSE,
+    colClasses=c("character", "integer", rep("integer", 2 * %(ncols)i)))
+    rowRanges <- GRanges(seqnames = Rle(df[,1]),
+    ranges = IRanges(start = df[,2], end= df[,2]))
     colData <- DataFrame(group = c("%(conditions)s"),
     row.names = c("%(samples)s"))
-    methReads <- matrix(as.integer(unlist(df[,grep("*[.]meth", colnames(df),
-    value=FALSE)])),ncol=%(ncols)i)
-    unmethReads <- matrix(as.integer(unlist(df[,grep("*[.]unmeth",colnames(df),
-    value=FALSE)])),ncol=%(ncols)i)
+    methReads <- unname(as.matrix(df[, 3:(2 + %(ncols)i)]))
+    unmethReads <- unname(as.matrix(
+    df[, (3 + %(ncols)i):(2 + 2 * %(ncols)i)]))
     totalReads <- methReads + unmethReads
     rawData=BSraw(rowRanges = rowRanges, colData = colData,
     totalReads = totalReads, methReads = methReads)
@@ -957,20 +1410,78 @@ rowRanges <- GRanges(seqnames = Rle(as.character(df$contig)),
     adjusted_colnames <- gsub(" ", "_", colnames(M3Dstat))
     M3Dstat_df <- as.data.frame(M3Dstat)
     colnames(M3Dstat_df) <- adjusted_colnames
-    ranges_df <- data.frame(seqnames=seqnames(clust.unlim_GR,
+    ranges_df <- data.frame(seqnames=seqnames(clust.unlim_GR),
     start=start(clust.unlim_GR)-1,end=end(clust.unlim_GR))
     complete_df <- cbind(ranges_df, M3Dstat_df)
     write.table(complete_df,file="%(outfile)s",sep="\t",quote=F,row.names=F)
     return(M3Dstat)
     }''' % locals())
 
-    df.to_csv(outfile+".pd", sep="\t")
-    # out.close()
-    M3Dstat = func(r_df)
+    func(tmpfile)
+    os.unlink(tmpfile)
+
+
+def getEmpiricalPvalues(values, null, samples=None, seed=None,
+                        is_sorted=False):
+    '''compute empirical p-values of `values` against a null distribution.
+
+    The p-value of a value is the fraction of the null distribution
+    that is larger than the value. The null is sorted once and all
+    values are looked up with a single binary search.
+
+    If `samples` is given, a Monte Carlo estimate is returned instead,
+    as if `samples` values had been drawn with replacement from the
+    null for each value. The number of larger values among the draws
+    follows a binomial distribution with the exact p-value, so the
+    counts are drawn directly instead of the samples.
+
+    Arguments
+    ---------
+    values : numpy array
+        Statistics to compute p-values for.
+    null : numpy array
+        Statistics under the null hypothesis. NaN values are never
+        larger than a value, but count towards the size of the null.
+    samples : int
+        Number of draws per value for the Monte Carlo estimate.
+    seed : int
+        Seed for the random number generator.
+    is_sorted : bool
+        If True, `null` is already sorted with :func:`numpy.sort`.
+
+    Returns
+    -------
+    pvalues : numpy array
+        Empirical p-values in the same order as `values`.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if not is_sorted:
+        null = np.sort(np.asarray(null, dtype=np.float64))
+
+    if len(null) == 0:
+        raise ValueError("empty null distribution")
+
+    # NaN are sorted last, they count towards the size of the null
+    # but are never larger than a value
+    nvalid = len(null) - int(np.isnan(null).sum())
+
+    # values that are NaN have no larger values
+    larger = nvalid - np.searchsorted(null[:nvalid], values, side="right")
+    pvalues = larger / float(len(null))
+
+    if samples:
+        rng = np.random.RandomState(seed)
+        pvalues = rng.binomial(int(samples), pvalues) / float(samples)
 
+    return pvalues
 
-def M3Dstat2pvalue(df, columns, pair):
 
+def M3Dstat2pvalue(df, columns, pair, samples=None, seed=None):
+    '''compute p-values of M3D statistics between groups and within
+    groups against the distribution of statistics within groups.
+
+    See :func:`getEmpiricalPvalues` for `samples` and `seed`.
+    '''
     stats = importr('stats')
 
     def meltAndPivot(df, columns):
@@ -980,13 +1491,10 @@ def M3Dstat2pvalue(df, columns, pair):
             index=columns, values="value", aggfunc=np.mean))
         return pivot
 
-    def sampler(M3Dstat, vector, n):
-        rand = np.random.choice(vector, size=n, replace=True, )
-        return len(rand[rand > M3Dstat])/n
-
-    def addPvalues(df, within_df, repeat):
-        df['p_value'] = df['value'].apply(
-            sampler, args=(within_df['value'], repeat))
+    def addPvalues(df, null):
+        df['p_value'] = getEmpiricalPvalues(
+            df['value'].values, null,
+            samples=samples, seed=seed, is_sorted=True)
         df['p_value_adj'] = stats.p_adjust(FloatVector(
             df['p_value']), method='BH')
 
@@ -1013,8 +1521,10 @@ def M3Dstat2pvalue(df, columns, pair):
     between_pivot = meltAndPivot(df.ix[:, between], columns)
     within_pivot = meltAndPivot(df.ix[:, within], columns)
 
-    addPvalues(between_pivot, within_pivot, 100000.0)
-    addPvalues(within_pivot, within_pivot, 100000.0)
+    null = np.sort(within_pivot['value'].values)
+
+    addPvalues(between_pivot, null)
+    addPvalues(within_pivot, null)
 
     between_pivot.reset_index(inplace=True)
     within_pivot.reset_index(inplace=True)
@@ -1023,9 +1533,13 @@ def M3Dstat2pvalue(df, columns, pair):
 
 
 @cluster_runnable
-def calculateM3DSpikepvalue(infiles, outfile, design):
+def calculateM3DSpikepvalue(infiles, outfile, design,
+                            samples=None, seed=None):
     '''takes a list of M3D stats files and a design dataframe and outputs
-    p-values for each cluster for the pairwise comparison'''
+    p-values for each cluster for the pairwise comparison
+
+    p-values are exact unless `samples` is given, see
+    :func:`getEmpiricalPvalues`.'''
 
     outfile_within = P.snip(outfile, "_between.tsv") + "_within.tsv"
 
@@ -1062,7 +1576,7 @@ def calculateM3DSpikepvalue(infiles, outfile, design):
     concat_df.to_csv(outfile, index=False, header=True, sep="\t")
 
     between, within = M3Dstat2pvalue(concat_df, cluster_characteristics,
-                                     pair)
+                                     pair, samples=samples, seed=seed)
 
     between.to_csv(outfile, index=False, header=True, sep="\t")
     within.to_csv(outfile_within, index=False, header=True, sep="\t")
@@ -1156,9 +1670,12 @@ def calculateM3DSpikepvalue(infiles, outfile, design):
 
 
 @cluster_runnable
-def calculateM3Dpvalue(infiles, outfile, pair):
+def calculateM3Dpvalue(infiles, outfile, pair, samples=None, seed=None):
     '''takes a list of M3D stats files and a design dataframe and outputs
-    p-values for each cluster for the pairwise comparison'''
+    p-values for each cluster for the pairwise comparison
+
+    p-values are exact unless `samples` is given, see
+    :func:`getEmpiricalPvalues`.'''
     # to do: use design dataframe to identify groups
     # currently hardcoded in pipeline
 
@@ -1172,7 +1689,7 @@ def calculateM3Dpvalue(infiles, outfile, pair):
             df = df.append(temp_df)
     df.set_index(df['seqnames'], inplace=True)
     between, within = M3Dstat2pvalue(
-        df, ["seqnames", "start", "end"], pair)
+        df, ["seqnames", "start", "end"], pair, samples=samples, seed=seed)
 
     between.to_csv(outfile, index=False, header=True, sep="\t")
     within.to_csv(outfile_within, index=False, header=True, sep="\t")
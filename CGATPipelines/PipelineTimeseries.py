@@ -15,7 +15,6 @@ import numpy as np
 import pandas as pd
 import pandas.rpy.common as com
 from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
 from rpy2.robjects import r as R
 import rpy2.robjects as ro
 import CGAT.Experiment as E
@@ -827,49 +826,210 @@ def crossCorrelate(t, s, lag=0):
 
 def adaptiveTune(value, k):
     '''
-    Calculate the adaptive tuning function from Chouakira & Nagabhushan
+    Calculate the adaptive tuning function from Chouakira & Nagabhushan.
+    `value` can be a number or an array of temporal correlations.
     '''
 
     if k == 0:
         return 1.0
     else:
-        return (2/(1 + math.exp(k*abs(value))))
+        return (2/(1 + np.exp(k*np.abs(value))))
 
 
-def dtwWrapper(data, rows, columns, k):
+def normaliseSeries(values):
     '''
-    wrapper function for dynamic time warping.
-    includes use of exponential adaptive tuning function
-    with temporal correlation if k > 0
+    Centre each timeseries (row) of `values` on its mean and scale
+    it by its (population) standard deviation.
+
+    :param values: timeseries, one per row
+    :type values: numpy.ndarray
     '''
 
-    # not explicitly called, but needs to be in R environment
-    DTW = importr("dtw")
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ((values - values.mean(axis=1)[:, np.newaxis]) /
+                values.std(axis=1)[:, np.newaxis])
 
-    # create a data frame of zeros of size number of ids x number of ids
-    # fill it with the calculated distance metric for each pair wise comparison
 
-    df_ = pd.DataFrame(index=rows,
-                       columns=columns)
-    df_ = df_.fillna(0.0).astype(np.float64)
+def crossCorrelateMatrix(series1, series2, lag=0):
+    '''
+    Calculate the normalised cross-correlation at `lag` between
+    all timeseries (rows) in `series1` and all timeseries in
+    `series2`. Entry [i, j] equals ``crossCorrelate(series1[i],
+    series2[j], lag)``.
 
-    # fill the array with dtw-distance values
-    pandas2ri.activate()
+    The series are normalised once and the correlations are computed
+    with a single matrix product of the overlapping time points.
+
+    :param series1: timeseries, one per row
+    :type series1: numpy.ndarray
+    :param series2: timeseries, one per row, of the same length
+    :type series2: numpy.ndarray
+    :param lag: lag of `series1` relative to `series2`
+    :type lag: int
+    '''
+
+    norm1 = normaliseSeries(series1)
+    norm2 = normaliseSeries(series2)
+    len_t = norm1.shape[1]
+    norm1 /= len_t
+
+    if lag >= 0:
+        return np.dot(norm1[:, lag:], norm2[:, :len_t - lag].T)
+    else:
+        return np.dot(norm1[:, :len_t + lag], norm2[:, -lag:].T)
+
+
+def temporalCorrelateMatrix(series1, series2):
+    '''
+    Calculate the temporal correlation between all timeseries (rows)
+    in `series1` and all timeseries in `series2`. Entry [i, j] equals
+    ``temporalCorrelate(series1[i], series2[j])``.
+
+    :param series1: timeseries, one per row
+    :type series1: numpy.ndarray
+    :param series2: timeseries, one per row, of the same length
+    :type series2: numpy.ndarray
+    '''
+
+    diff1 = np.diff(np.asarray(series1, dtype=np.float64), axis=1)
+    diff2 = np.diff(np.asarray(series2, dtype=np.float64), axis=1)
+
+    nume = np.dot(diff1, diff2.T)
+    denom = np.outer(np.sqrt((diff1 ** 2).sum(axis=1)),
+                     np.sqrt((diff2 ** 2).sum(axis=1)))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denom != 0, nume / denom, 0.0)
+
+
+def dtwMatrix(series1, series2):
+    '''
+    Calculate the dynamic time warping distance between all
+    timeseries (rows) in `series1` and all timeseries in `series2`.
+
+    The distance is the same as the ``distance`` returned by the R
+    function ``dtw`` with its defaults, i.e. the absolute difference
+    as local cost and the ``symmetric2`` step pattern without
+    normalisation. The recursion runs over the time points once for
+    all pairs of series at the same time.
+
+    :param series1: timeseries, one per row
+    :type series1: numpy.ndarray
+    :param series2: timeseries, one per row
+    :type series2: numpy.ndarray
+    '''
+
+    series1 = np.asarray(series1, dtype=np.float64)
+    series2 = np.asarray(series2, dtype=np.float64)
+
+    # cumulative cost of the previous time point in series1 for
+    # each time point in series2, each an array over all pairs
+    previous = None
+    for x in range(series1.shape[1]):
+        current = []
+        for y in range(series2.shape[1]):
+            cost = np.abs(series1[:, x, np.newaxis] -
+                          series2[np.newaxis, :, y])
+            if x == 0 and y == 0:
+                total = cost
+            elif x == 0:
+                total = current[y - 1] + cost
+            elif y == 0:
+                total = previous[y] + cost
+            else:
+                total = np.minimum(
+                    np.minimum(previous[y] + cost, current[y - 1] + cost),
+                    previous[y - 1] + 2 * cost)
+            current.append(total)
+        previous = current
+
+    return previous[-1]
+
+
+def distanceMatrix(series1, series2, method, lag=0, k=0):
+    '''
+    Calculate the distances between all timeseries (rows) in `series1`
+    and all timeseries in `series2`.
+
+    :param method: one of ``cross-correlate``, ``temporal-correlate``
+    or ``dtw``. Correlations are converted to distances as 1 - |corr|,
+    dynamic time warping distances are scaled by the adaptive tuning
+    function of the temporal correlation if k > 0.
+    :type method: str
+    :param lag: lag for ``cross-correlate``
+    :type lag: int
+    :param k: adaptive tuning parameter for ``dtw``
+    :type k: float
+    '''
+
+    if method == "cross-correlate":
+        return 1.0 - np.abs(crossCorrelateMatrix(series1, series2, lag=lag))
+    elif method == "temporal-correlate":
+        return 1.0 - np.abs(temporalCorrelateMatrix(series1, series2))
+    elif method == "dtw":
+        distances = dtwMatrix(series1, series2)
+        if k != 0:
+            distances *= adaptiveTune(
+                temporalCorrelateMatrix(series1, series2), k)
+        return distances
+    else:
+        raise ValueError("unknown distance method '%s'" % method)
+
+
+def getBlockSize(ncolumns, max_elements=2 ** 22):
+    '''
+    Return the number of rows to compute at a time against `ncolumns`
+    timeseries so that intermediate arrays have at most `max_elements`
+    elements. :func:`dtwMatrix` keeps two such arrays per time point.
+    '''
 
-    for i in rows:
-        E.info("DTW %s" % i)
-        for j in columns:
-            series1 = data.loc[i].values.tolist()
-            series2 = data.loc[j].values.tolist()
-            DTW_value = (R.dtw(series1,
-                               series2)).rx('distance')[0][0]
-            cort_value = temporalCorrelate(series1, series2)
-            tuned_value = adaptiveTune(cort_value, k)
-            time_dist = DTW_value * tuned_value
-            df_.loc[i][j] = float(time_dist)
-            df_[j][i] = float(time_dist)
+    return max(1, max_elements // max(1, ncolumns))
 
-    return df_
+
+def iterateDistanceBlocks(series1, series2, method, lag=0, k=0,
+                          block_size=None):
+    '''
+    Calculate the distances between `series1` and `series2` (see
+    :func:`distanceMatrix`) in blocks of `block_size` rows of
+    `series1`, so that memory usage does not grow with the number of
+    rows. Yields tuples of (start, end, distances).
+    '''
+
+    if block_size is None:
+        block_size = getBlockSize(len(series2))
+
+    for start in range(0, len(series1), block_size):
+        end = min(start + block_size, len(series1))
+        yield start, end, distanceMatrix(series1[start:end], series2,
+                                         method=method, lag=lag, k=k)
+
+
+def _buildDistanceFrame(data, rows, columns, method, lag=0, k=0):
+    '''
+    Return the distances of `rows` against `columns` as a dataframe,
+    computed in blocks of rows.
+    '''
+
+    distances = np.empty((len(rows), len(columns)), dtype=np.float64)
+    for start, end, block in iterateDistanceBlocks(
+            data.loc[rows].values, data.loc[columns].values,
+            method=method, lag=lag, k=k):
+        distances[start:end] = block
+
+    return pd.DataFrame(distances, index=rows, columns=columns)
+
+
+def dtwWrapper(data, rows, columns, k):
+    '''
+    wrapper function for dynamic time warping.
+    includes use of exponential adaptive tuning function
+    with temporal correlation if k > 0
+    '''
+
+    E.info("DTW %i x %i timeseries" % (len(rows), len(columns)))
+
+    return _buildDistanceFrame(data, rows, columns, method="dtw", k=k)
 
 
 def correlateDistanceMetric(data, rows, columns, method, lag=0):
@@ -880,33 +1040,12 @@ def correlateDistanceMetric(data, rows, columns, method, lag=0):
     or normalised cross correlation.
     '''
 
-    # create blank (all 0's) dataframe to fill with correlation values
-
-    df_ = pd.DataFrame(index=rows,
-                       columns=columns)
-    df_ = df_.fillna(0.0)
+    if method not in ("cross-correlate", "temporal-correlate"):
+        raise ValueError("unknown correlation method '%s'" % method)
 
-    if method == "cross-correlate":
-        for i in rows:
-            E.info("cross-correlation %s" % i)
-            for j in columns:
-                series1 = data.loc[i].values.tolist()
-                series2 = data.loc[j].values.tolist()
-                corr = crossCorrelate(series1, series2, lag=lag)
-                df_.loc[i][j] = 1.0 - abs(corr)
-                df_[j][i] = 1.0 - abs(corr)
+    E.info("%s %i x %i timeseries" % (method, len(rows), len(columns)))
 
-    elif method == "temporal-correlate":
-        for i in rows:
-            E.info("temporal correlation %s" % i)
-            for j in columns:
-                series1 = data.loc[i].tolist()
-                series2 = data.loc[j].tolist()
-                corr = temporalCorrelate(series1, series2)
-                df_.loc[i][j] = 1.0 - abs(corr)
-                df_[j][i] = 1.0 - abs(corr)
-
-    return df_
+    return _buildDistanceFrame(data, rows, columns, method=method, lag=lag)
 
 
 def splitFiles(infile, nchunks, out_dir):
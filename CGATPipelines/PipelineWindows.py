@@ -26,7 +26,7 @@ import CGATPipelines.Pipeline as P
 import CGAT.BamTools as BamTools
 import CGAT.IOTools as IOTools
 import CGAT.Expression as Expression
-import CGAT.Bed as Bed
+import CGATPipelines.PipelineDEStats as PipelineDEStats
 
 
 def convertReadsToIntervals(bamfile,
@@ -173,23 +173,78 @@ def countTags(infile, outfile):
     P.run()
 
 
+def readWindows(windowfile):
+    '''read windows from a :term:`bed` formatted file.
+
+    Windows are sorted by contig, start and end. Windows with the
+    same coordinates are only reported once.
+
+    Arguments
+    ---------
+    windowfile : string
+        Filename with windows in :term:`bed` format.
+
+    Returns
+    -------
+    windows : collections.OrderedDict
+        Dictionary mapping contigs to tuples of numpy arrays
+        with window starts and ends.
+    '''
+    df = pandas.read_csv(IOTools.openFile(windowfile),
+                         sep="\t",
+                         header=None,
+                         usecols=[0, 1, 2],
+                         dtype={0: str},
+                         comment="#")
+
+    windows = collections.OrderedDict()
+    for contig, group in df.groupby(0):
+        starts, ends = group[1].values, group[2].values
+        order = numpy.lexsort((ends, starts))
+        starts, ends = starts[order], ends[order]
+        keep = numpy.ones(len(starts), dtype=numpy.bool_)
+        keep[1:] = (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])
+        windows[contig] = (starts[keep], ends[keep])
+
+    return windows
+
+
+def _hasData(filename):
+    '''return True if `filename` contains lines that are not empty
+    or comments.'''
+    with IOTools.openFile(filename) as inf:
+        for line in inf:
+            if line.strip() and not line.startswith("#"):
+                return True
+    return False
+
+
+@P.cluster_runnable
 def countTagsWithinWindows(tagfile,
                            windowfile,
                            outfile,
                            counting_method="midpoint",
-                           job_memory="4G"):
+                           chunk_size=1000000):
     '''count tags within windows.
 
-    Counting is done using bedtools.
+    Tags are read in chunks and counted into all windows of a contig
+    at once using sorted arrays of tag coordinates. Each tag file is
+    read once and memory usage depends on the number of windows, but
+    not on the number of tags. Windows can be of arbitrary size and
+    overlap.
 
     Arguments
     ---------
     tagfile : string
         Filename with tags to be counted in :term:`bed` format.
+        Blocks of bed12 formatted tags are ignored.
     windowfile : string
         Filename with windows in :term:`bed` format.
     outfile : outfile
-        Output filename in :term:`bed` format.
+        Output filename in :term:`tsv` format. The output contains
+        the window coordinates as ``contig:start-end`` and the count
+        for each window, see :func:`readWindows` for the order of
+        windows.
     counting_method : string
         Counting method to use. Possible values are ``nucleotide``
         and ``midpoint``.
@@ -197,60 +252,85 @@ def countTagsWithinWindows(tagfile,
         window by at least one base
         nucleotide counts the number of reads overlapping the window by at
         least one base.
-    job_memory : string
-        Amount of memory to allocate.
+    chunk_size : int
+        Number of tags to read at a time.
     '''
 
-    if counting_method == "midpoint":
-        f = '''| awk '{a = $2+($3-$2)/2;
-        printf("%s\\t%i\\t%i\\n", $1, a, a+1)}' '''
-    elif counting_method == "nucleotide":
-        f = ""
-    else:
+    if counting_method not in ("midpoint", "nucleotide"):
         raise ValueError("unknown counting method: %s" % counting_method)
 
-    statement = '''
-    zcat %(tagfile)s
-    %(f)s
-    | coverageBed -a stdin -b %(windowfile)s -split
-    | sort -k1,1 -k2,2n -k3,3n -k4,4
-    | gzip
-    > %(outfile)s
-    '''
+    windows = readWindows(windowfile)
+    counts = dict([(contig, numpy.zeros(len(starts), dtype=numpy.int64))
+                   for contig, (starts, ends) in windows.items()])
 
-    P.run()
+    c = E.Counter()
+    # pandas can not parse a file without tags, all counts are then 0
+    if _hasData(tagfile):
+        reader = pandas.read_csv(IOTools.openFile(tagfile),
+                                 sep="\t",
+                                 header=None,
+                                 usecols=[0, 1, 2],
+                                 dtype={0: str},
+                                 comment="#",
+                                 chunksize=chunk_size)
+    else:
+        E.warn("no tags in %s" % tagfile)
+        reader = []
+
+    for chunk in reader:
+        for contig, tags in chunk.groupby(0, sort=False):
+            c.tags += len(tags)
+            if contig not in windows:
+                c.skipped_contig += len(tags)
+                continue
 
+            starts, ends = windows[contig]
+            tag_starts, tag_ends = tags[1].values, tags[2].values
+            if counting_method == "midpoint":
+                # midpoints in [start, end)
+                midpoints = numpy.sort(
+                    tag_starts + (tag_ends - tag_starts) // 2)
+                counts[contig] += (numpy.searchsorted(midpoints, ends) -
+                                   numpy.searchsorted(midpoints, starts))
+            else:
+                # tags starting before the end minus tags ending
+                # before the start of a window
+                counts[contig] += (
+                    numpy.searchsorted(numpy.sort(tag_starts), ends) -
+                    numpy.searchsorted(numpy.sort(tag_ends), starts,
+                                       side="right"))
 
-def aggregateWindowsTagCounts(infiles,
-                              outfile,
-                              regex="(.*)\..*"):
-    '''aggregate output from several ``bedtools coverage`` results.
+    outf = IOTools.openFile(outfile, "w")
+    outf.write("interval_id\tcount\n")
+    for contig, (starts, ends) in windows.items():
+        contig_counts = counts[contig]
+        for x in range(0, len(starts), chunk_size):
+            rows = zip(starts[x:x + chunk_size],
+                       ends[x:x + chunk_size],
+                       contig_counts[x:x + chunk_size])
+            outf.write("".join(["%s:%i-%i\t%i\n" % ((contig,) + row)
+                                for row in rows]))
+        c.windows += len(starts)
+    outf.close()
 
-    ``bedtools coverage`` outputs the following columns for a bed4
-    file::
+    E.info("countTagsWithinWindows: %s" % c)
 
-    1 Contig
-    2 Start
-    3 Stop
-    4 Name
-    5 The number of features in A that overlapped (by at least one
-      base pair) the B interval.
-    6 The number of bases in B that had non-zero coverage from features in A.
-    7 The length of the entry in B.
-    8 The fraction of bases in B that had non-zero coverage from
-      features in A.
 
-    This method autodetects the number of columns in the :term:`infiles`
-    and selects:
+def aggregateWindowsTagCounts(infiles,
+                              outfile,
+                              regex="(.*)\..*"):
+    '''aggregate output from several :func:`countTagsWithinWindows`
+    results.
 
-    * bed4: use column 5
-    * bed6: use column 7
-    * bed12: use column 13
+    All files are read line by line in parallel, so that memory
+    usage does not depend on the number of windows.
 
     Arguments
     ---------
     infiles : list
-        Input filenames with the output from ``bedtools coverage``
+        Input filenames with the output from
+        :func:`countTagsWithinWindows`. All files need to contain
+        the same windows.
     outfile : string
         Output filename in :term:`tsv` format.
     regex : string
@@ -259,47 +339,38 @@ def aggregateWindowsTagCounts(infiles,
 
     '''
 
-    # get bed format
-    bed_columns = Bed.getNumColumns(infiles[0])
-    # +1 as awk is 1-based
-    column = bed_columns - 4 + 1
-
-    src = " ".join(["""<( zcat %s |
-              awk '{printf("%%s:%%i-%%i\\t%%i\\n", $1,$2,$3,$%s );}')""" %
-                    (x, column) for x in infiles])
-    tmpfile = P.getTempFilename(".")
-    statement = '''paste %(src)s > %(tmpfile)s'''
-    P.run()
-
     # build track names
     tracks = [re.search(regex, os.path.basename(x)).groups()[0]
               for x in infiles]
 
+    inputs = [IOTools.openFile(x) for x in infiles]
+
     outf = IOTools.openFile(outfile, "w")
-    outf.write("interval_id\t%s\n" % "\t".join(tracks))
 
-    # filter for uniqueness - keys with the same value as the
-    # previous line will be ignored.
-    last_gene = None
     c = E.Counter()
-    for line in open(tmpfile, "r"):
+    for lines in itertools.izip_longest(*inputs):
+        if None in lines:
+            raise ValueError(
+                "files contain different numbers of windows")
+        data = [x[:-1].split("\t") for x in lines]
+        interval_ids = set([x[0] for x in data])
+        if len(interval_ids) != 1:
+            raise ValueError(
+                "files contain different windows: %s" %
+                ",".join(sorted(interval_ids)))
+
+        if c.input == 0:
+            outf.write("interval_id\t%s\n" % "\t".join(tracks))
+        else:
+            outf.write("%s\t%s\n" % (data[0][0],
+                                     "\t".join([x[1] for x in data])))
+            c.output += 1
         c.input += 1
-        data = line[:-1].split("\t")
-        genes = list(set([data[x] for x in range(0, len(data), 2)]))
-        values = [int(data[x]) for x in range(1, len(data), 2)]
-
-        assert len(genes) == 1, \
-            "paste command failed, wrong number of genes per line: '%s'" % line
-        if genes[0] == last_gene:
-            c.duplicates += 1
-            continue
-        c.output += 1
-        outf.write("%s\t%s\n" % (genes[0], "\t".join(map(str, values))))
-        last_gene = genes[0]
 
     outf.close()
 
-    os.unlink(tmpfile)
+    for infile in inputs:
+        infile.close()
 
     E.info("aggregateWindowsTagCounts: %s" % c)
 
@@ -358,101 +429,28 @@ def buildDMRStats(infiles, outfile, method, fdr_threshold=None):
     fdr_threshold : float
         FDR threshold to apply. Currently unused.
     '''
-    results = collections.defaultdict(lambda: collections.defaultdict(int))
-    status = collections.defaultdict(lambda: collections.defaultdict(int))
-
-    # deseq/edger
-    def f_significant(x):
-        return x.significant == "1"
-
-    def f_up(x):
-        return float(x.l2fold) > 0
-
-    def f_down(x):
-        return float(x.l2fold) < 0
-
-    def f_fold2up(x):
-        return float(x.l2fold) > 1
+    summary = PipelineDEStats.summarizeDEFiles(infiles)
 
-    def f_fold2down(x):
-        return float(x.l2fold) < -1
-
-    def f_key(x):
-        return (x.treatment_name, x.control_name)
-
-    def f_status(x):
-        return x.status
+    # fold change counts are restricted to tests with status OK
+    counts, status = PipelineDEStats.getTestSummary(summary, status="OK")
+    counts["fold2"] = counts["significant_l2fold_up"] + \
+        counts["significant_l2fold_down"]
+    counts = counts[sorted(
+        [x for x in counts.columns if x != "twofold"])]
+    status = status[sorted(status.columns)]
 
     outf = IOTools.openFile(outfile, "w")
+    outf.write("\t".join(
+        ["method", "treatment", "control"] +
+        list(counts.columns) + list(status.columns)) + "\n")
 
-    is_first = True
-    for infile in infiles:
-
-        xx = 0
-        for line in IOTools.iterate(IOTools.openFile(infile)):
-            key = f_key(line)
-
-            r, s = results[key], status[key]
-            r["tested"] += 1
-            ss = f_status(line)
-            s[ss] += 1
+    for (treatment, control), r in counts.iterrows():
+        s = status.loc[(treatment, control)]
+        outf.write("%s\t%s\t%s\t" % (method, treatment, control))
+        outf.write("\t".join(map(str, r.values)) + "\t")
+        outf.write("\t".join(map(str, s.values)) + "\n")
 
-            if ss != "OK":
-                continue
-
-            is_significant = f_significant(line)
-            up = f_up(line)
-            down = f_down(line)
-            fold2up = f_fold2up(line)
-            fold2down = f_fold2down(line)
-            fold2 = fold2up or fold2down
-
-            if up:
-                r["up"] += 1
-            if down:
-                r["down"] += 1
-            if fold2up:
-                r["l2fold_up"] += 1
-            if fold2down:
-                r["l2fold_down"] += 1
-
-            if is_significant:
-                r["significant"] += 1
-                if up:
-                    r["significant_up"] += 1
-                if down:
-                    r["significant_down"] += 1
-                if fold2:
-                    r["fold2"] += 1
-                if fold2up:
-                    r["significant_l2fold_up"] += 1
-                if fold2down:
-                    r["significant_l2fold_down"] += 1
-
-            if xx > 10000:
-                break
-
-        if is_first:
-            is_first = False
-            header1, header2 = set(), set()
-            for r in results.values():
-                header1.update(r.keys())
-            for s in status.values():
-                header2.update(s.keys())
-
-            header = ["method", "treatment", "control"]
-            header1 = list(sorted(header1))
-            header2 = list(sorted(header2))
-
-            outf.write("\t".join(header + header1 + header2) + "\n")
-
-        for treatment, control in results.keys():
-            key = (treatment, control)
-            r = results[key]
-            s = status[key]
-            outf.write("%s\t%s\t%s\t" % (method, treatment, control))
-            outf.write("\t".join([str(r[x]) for x in header1]) + "\t")
-            outf.write("\t".join([str(s[x]) for x in header2]) + "\n")
+    outf.close()
 
 
 def buildFDRStats(infile, outfile, method):
@@ -884,6 +882,171 @@ def runMEDIPSDMR(design_file, outfile):
     P.run()
 
 
+def readSpikeData(infile, spiked=None, use_means=True,
+                  chunk_size=1000000):
+    """read expression level, fold change and q-value of tests.
+
+    Only the required columns are read and the file is read in
+    chunks of `chunk_size` rows.
+
+    Arguments
+    ---------
+    infile : string
+        Input filename in :term:`tsv` format. Usually the output of
+        :mod:`scripts/runExpression`.
+    spiked : bool
+        If True, only read spike-ins, i.e. tests with an identifier
+        starting with ``spike``. If False, only read other tests.
+        If None, read all tests.
+    use_means : bool
+        If True, compute expression level and fold change from
+        ``treatment_mean`` and ``control_mean`` with a pseudocount
+        of 1. Otherwise use ``treatment_mean`` and ``fold`` directly
+        (edger).
+
+    Returns
+    -------
+    l10average : numpy.array
+        Log expression level.
+    l2fold : numpy.array
+        Log2 fold change.
+    qvalue : numpy.array
+        Q-value.
+    """
+    if use_means:
+        columns = ["test_id", "treatment_mean", "control_mean", "qvalue"]
+    else:
+        columns = ["test_id", "treatment_mean", "fold", "qvalue"]
+
+    dtype = dict([(x, numpy.float64) for x in columns[1:]])
+    dtype["test_id"] = str
+
+    chunks = []
+    for chunk in pandas.read_csv(IOTools.openFile(infile),
+                                 sep="\t",
+                                 usecols=columns,
+                                 dtype=dtype,
+                                 chunksize=chunk_size):
+        if spiked is not None:
+            is_spike = chunk["test_id"].str.startswith("spike").values
+            chunk = chunk[is_spike == spiked]
+        chunks.append(chunk[columns[1:]].values)
+
+    data = numpy.concatenate(
+        chunks + [numpy.zeros((0, 3), dtype=numpy.float64)])
+    E.debug("read %i rows of data" % len(data))
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if use_means:
+            # use pseudocounts to compute fold changes
+            treatment_mean = data[:, 0] + 1
+            control_mean = data[:, 1] + 1
+            # build log2 average values
+            l10average = numpy.log((treatment_mean + control_mean) / 2)
+            l2fold = numpy.log2(treatment_mean / control_mean)
+        else:
+            # edger: treatment_mean and control_mean do not exist
+            # use supplied values directly.
+            l10average = numpy.log(data[:, 0])
+            l2fold = numpy.log2(data[:, 1])
+
+    return l10average, l2fold, data[:, 2]
+
+
+def getSpikeBins(l10average, l2fold,
+                 expression_nbins=None,
+                 fold_nbins=None,
+                 expression_bins=None,
+                 fold_bins=None):
+    """return bin edges for expression level and fold change.
+
+    If `expression_nbins` or `fold_nbins` are given, the bins
+    are computed from the data, otherwise `expression_bins`
+    and `fold_bins` are returned.
+    """
+    if expression_nbins is not None:
+        mm = math.ceil(max(l10average))
+        expression_bins = numpy.arange(0, mm, mm / expression_nbins)
+
+    if fold_nbins is not None:
+        mm = math.ceil(max(abs(min(l2fold)), abs(max(l2fold))))
+        # ensure that range is centered on exact 0
+        n = math.ceil(fold_nbins / 2.0)
+        fold_bins = numpy.concatenate(
+            (-numpy.arange(0, mm, mm / n)[:0:-1],
+             numpy.arange(0, mm, mm / n)))
+
+    return numpy.asarray(expression_bins), numpy.asarray(fold_bins)
+
+
+def _getBinIndex(values, edges):
+    """return bin index of values as in :func:`numpy.histogram`.
+
+    Values outside the bins are assigned to -1.
+    """
+    index = numpy.searchsorted(edges, values, side="right") - 1
+    # the last bin includes its right edge
+    index[values == edges[-1]] = len(edges) - 2
+    index[(index < 0) | (index >= len(edges) - 1)] = -1
+    return index
+
+
+def computeSpikeHistograms(l10average, l2fold, qvalue,
+                           xedges, yedges, fdr_thresholds=()):
+    """compute 2-D histograms of tests by expression level and fold
+    change in a single pass.
+
+    Arguments
+    ---------
+    l10average, l2fold, qvalue : numpy.array
+        Data as returned by :func:`readSpikeData`.
+    xedges, yedges : numpy.array
+        Bin edges for expression level and fold change.
+    fdr_thresholds : list
+        Sorted list of FDR thresholds.
+
+    Returns
+    -------
+    counts : numpy.array
+        2-D histogram of all tests.
+    fdr_counts : numpy.array
+        3-D array with a 2-D histogram of tests with a q-value
+        below each FDR threshold.
+    """
+    nx, ny = len(xedges) - 1, len(yedges) - 1
+    x = _getBinIndex(l10average, xedges)
+    y = _getBinIndex(l2fold, yedges)
+    take = (x >= 0) & (y >= 0)
+    cells = x[take] * ny + y[take]
+
+    counts = numpy.bincount(cells, minlength=nx * ny).reshape((nx, ny))
+
+    # index of first threshold a test passes, tests without
+    # q-value never pass
+    nfdr = len(fdr_thresholds)
+    if nfdr:
+        first = numpy.searchsorted(fdr_thresholds, qvalue[take],
+                                   side="right")
+        passed = first < nfdr
+        fdr_counts = numpy.bincount(
+            first[passed] * nx * ny + cells[passed],
+            minlength=nfdr * nx * ny).reshape((nfdr, nx, ny))
+        fdr_counts = numpy.cumsum(fdr_counts, axis=0)
+    else:
+        fdr_counts = numpy.zeros((0, nx, ny))
+
+    return counts.astype(numpy.float64), fdr_counts.astype(numpy.float64)
+
+
+def writeSpikeCounts(outfile, counts, xedges, yedges):
+    """write 2-D histogram of expression level and fold change."""
+    dd = pandas.DataFrame(counts)
+    dd.index = list(xedges[:-1])
+    dd.columns = list(yedges[:-1])
+    dd.to_csv(IOTools.openFile(outfile, "w"),
+              sep="\t")
+
+
 @P.cluster_runnable
 def outputSpikeCounts(outfile, infile_name,
                       expression_nbins=None,
@@ -913,51 +1076,22 @@ def outputSpikeCounts(outfile, infile_name,
     fold_bins : list
         List of bins to use for fold-change histogram.
     """
+    l10average, l2fold, qvalue = readSpikeData(
+        infile_name, use_means="edger" not in outfile.lower())
 
-    df = pandas.read_csv(infile_name,
-                         sep="\t",
-                         index_col=0)
-
-    E.debug("read %i rows and %i columns of data" % df.shape)
-
-    if "edger" in outfile.lower():
-        # edger: treatment_mean and control_mean do not exist
-        # use supplied values directly.
-        l10average = numpy.log(df['treatment_mean'])
-        l2fold = numpy.log2(df['fold'])
-    else:
-        # use pseudocounts to compute fold changes
-        treatment_mean = df['treatment_mean'] + 1
-        control_mean = df['control_mean'] + 1
-        # build log2 average values
-        l10average = numpy.log((treatment_mean + control_mean) / 2)
-        l2fold = numpy.log2(treatment_mean / control_mean)
-
-    if expression_nbins is not None:
-        mm = math.ceil(max(l10average))
-        expression_bins = numpy.arange(0, mm, mm / expression_nbins)
-
-    if fold_nbins is not None:
-        mm = math.ceil(max(abs(min(l2fold)), abs(max(l2fold))))
-        # ensure that range is centered on exact 0
-        n = math.ceil(fold_nbins / 2.0)
-        fold_bins = numpy.concatenate(
-            (-numpy.arange(0, mm, mm / n)[:0:-1],
-             numpy.arange(0, mm, mm / n)))
-
-    # compute expression bins
-    d2hist_counts, xedges, yedges = numpy.histogram2d(
+    xedges, yedges = getSpikeBins(
         l10average, l2fold,
-        bins=(expression_bins,
-              fold_bins))
+        expression_nbins=expression_nbins,
+        fold_nbins=fold_nbins,
+        expression_bins=expression_bins,
+        fold_bins=fold_bins)
 
-    dd = pandas.DataFrame(d2hist_counts)
-    dd.index = list(xedges[:-1])
-    dd.columns = list(yedges[:-1])
-    dd.to_csv(IOTools.openFile(outfile, "w"),
-              sep="\t")
+    counts, fdr_counts = computeSpikeHistograms(
+        l10average, l2fold, qvalue, xedges, yedges)
+
+    writeSpikeCounts(outfile, counts, xedges, yedges)
 
-    return df, d2hist_counts, xedges, yedges, l10average, l2fold
+    return counts, xedges, yedges
 
 
 @P.cluster_runnable
@@ -1032,46 +1166,36 @@ def buildSpikeResults(infile, outfile):
         P.touch(outfile)
         return
 
-    ########################################
-    # output and load spiked results
-    tmpfile_name = P.getTempFilename(shared=True)
-
-    statement = '''zcat %(spikefile)s
-    | grep -e "^spike" -e "^test_id"
-    > %(tmpfile_name)s
-    '''
-    P.run()
+    fdr_thresholds = [0.01, 0.05] + list(numpy.arange(0.1, 1.0, 0.1))
+    power_thresholds = numpy.arange(0.1, 1.1, 0.1)
 
-    E.debug("outputting spiked counts")
-    (spiked, spiked_d2hist_counts, xedges, yedges,
-     spiked_l10average, spiked_l2fold) = \
-        outputSpikeCounts(
-            outfile=P.snip(outfile, ".power.gz") + ".spiked.gz",
-            infile_name=tmpfile_name,
-            expression_nbins=expression_nbins,
-            fold_nbins=fold_nbins)
+    use_means = "edger" not in outfile.lower()
 
     ########################################
-    # output and load unspiked results
-    statement = '''zcat %(infile)s
-    | grep -v -e "^spike"
-    > %(tmpfile_name)s
-    '''
-    P.run()
-    E.debug("outputting unspiked counts")
-
-    (unspiked, unspiked_d2hist_counts, unspiked_xedges,
-     unspiked_yedges, unspiked_l10average, unspiked_l2fold) = \
-        outputSpikeCounts(
-            outfile=P.snip(outfile, ".power.gz") + ".unspiked.gz",
-            infile_name=tmpfile_name,
-            expression_bins=xedges,
-            fold_bins=yedges)
+    # read and bin spiked and unspiked results once
+    E.debug("binning spiked and unspiked results")
+    spiked = readSpikeData(spikefile, spiked=True, use_means=use_means)
+    xedges, yedges = getSpikeBins(spiked[0], spiked[1],
+                                  expression_nbins=expression_nbins,
+                                  fold_nbins=fold_nbins)
+    spiked_d2hist_counts, spiked_d2hist_fdrs = computeSpikeHistograms(
+        *spiked, xedges=xedges, yedges=yedges,
+        fdr_thresholds=fdr_thresholds)
+    del spiked
+
+    unspiked = readSpikeData(infile, spiked=False, use_means=use_means)
+    unspiked_d2hist_counts, _ = computeSpikeHistograms(
+        *unspiked, xedges=xedges, yedges=yedges)
+    del unspiked
+
+    writeSpikeCounts(P.snip(outfile, ".power.gz") + ".spiked.gz",
+                     spiked_d2hist_counts, xedges, yedges)
+    writeSpikeCounts(P.snip(outfile, ".power.gz") + ".unspiked.gz",
+                     unspiked_d2hist_counts, xedges, yedges)
 
     E.debug("computing power")
 
-    assert xedges.all() == unspiked_xedges.all()
-
+    tmpfile_name = P.getTempFilename(shared=True)
     tmpfile = IOTools.openFile(tmpfile_name, "w")
     tmpfile.write("\t".join(
         ("expression",
@@ -1080,27 +1204,18 @@ def buildSpikeResults(infile, outfile):
          "counts",
          "percent")) + "\n")
 
-    fdr_thresholds = [0.01, 0.05] + list(numpy.arange(0.1, 1.0, 0.1))
-    power_thresholds = numpy.arange(0.1, 1.1, 0.1)
-
-    spiked_total = float(spiked_d2hist_counts.sum().sum())
     unspiked_total = float(unspiked_d2hist_counts.sum().sum())
 
     outf = IOTools.openFile(outfile, "w")
     outf.write("fdr\tpower\tintervals\tintervals_percent\n")
 
     # significant results
-    for fdr in fdr_thresholds:
-        take = spiked['qvalue'] < fdr
-
-        # compute 2D histogram in spiked data below fdr threshold
-        spiked_d2hist_fdr, xedges, yedges = \
-            numpy.histogram2d(spiked_l10average[take],
-                              spiked_l2fold[take],
-                              bins=(xedges, yedges))
+    for fdr, spiked_d2hist_fdr in zip(fdr_thresholds, spiked_d2hist_fdrs):
 
         # convert to percentage of spike-ins per bin
-        spiked_d2hist_fdr_normed = spiked_d2hist_fdr / spiked_d2hist_counts
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            spiked_d2hist_fdr_normed = \
+                spiked_d2hist_fdr / spiked_d2hist_counts
         spiked_d2hist_fdr_normed = numpy.nan_to_num(spiked_d2hist_fdr_normed)
 
         # set values without data to -1
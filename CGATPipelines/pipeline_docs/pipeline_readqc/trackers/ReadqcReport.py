@@ -135,11 +135,15 @@ class FastqcSummary(ReadqcTracker, SingleTableTrackerRows):
 
 
 class OverRepresentedSequences(ReadqcTracker):
-    pattern = "(.*)_Overrepresented_sequences"
-    
+    table = "fastqc_Overrepresented_sequences"
+
+    def getTracks(self):
+        return self.getValues(
+            "SELECT DISTINCT fastqc FROM %(table)s ORDER BY fastqc")
+
     def __call__(self, track):
         return self.getAll(
-            "SELECT * FROM %(track)s_Overrepresented_sequences")
+            "SELECT * FROM %(table)s WHERE fastqc = '%(track)s'")
 
 
 class ProcessingComparison(ReadqcTracker):
@@ -171,7 +171,6 @@ import re
 import glob
 import os
 import sqlite3
-import pysam
 import numpy
 import xml.etree.ElementTree
 
@@ -433,13 +432,19 @@ def loadIntervals(infile, outfile):
     else:
         E.info("%s: no bamfiles associated" % (track))
 
-    # open all bamfiles
-    samfiles = [pysam.Samfile(fn, "rb") for fn in bamfiles]
-
     c = E.Counter()
 
-    # count tags
-    for bed in Bed.iterator(IOTools.openFile(infile, "r")):
+    beds = list(Bed.iterator(IOTools.openFile(infile, "r")))
+
+    # count tags for all intervals, one contig at a time
+    if bamfiles:
+        peaks = PipelinePeakcalling.countPeaksInIntervals(
+            [(bed.contig, bed.start, bed.end) for bed in beds],
+            bamfiles,
+            offsets,
+            threads=PARAMS.get("counting_threads", 1))
+
+    for bed in beds:
 
         c.input += 1
 
@@ -460,14 +465,9 @@ def loadIntervals(infile, outfile):
         else:
             score = 1
 
-        if samfiles:
+        if bamfiles:
             npeaks, peakcenter, length, avgval, peakval, nprobes = \
-                PipelinePeakcalling.countPeaks(
-                    bed.contig,
-                    bed.start,
-                    bed.end,
-                    samfiles,
-                    offsets)
+                peaks[c.input - 1]
             if nprobes == 0:
                 c.skipped_reads += 1
 
@@ -90,6 +90,12 @@ fastq.1.gz, fastq2.2.gz
    Quality scores need to be of the same scale for all input
    files. Thus it might be difficult to mix different formats.
 
+If the configuration variable ``staging_dir`` is set, reads in
+:term:`sra` files and reads fetched from remote repositories
+(``.remote`` files) are downloaded and extracted into this directory
+before mapping. The directory is a cache keyed by accession and can
+be shared between pipelines.
+
 Optional inputs
 +++++++++++++++
 
@@ -247,6 +253,11 @@ PARAMS.update(P.peekParameters(
 PipelineGeneset.PARAMS = PARAMS
 PipelineMappingQC.PARAMS = PARAMS
 
+# use reads staged by stageReads in mapping jobs
+if PARAMS.get("staging_dir"):
+    PipelineMapping.SequenceCollectionProcessor.staging_dir = \
+        os.path.abspath(PARAMS["staging_dir"])
+
 # Helper functions mapping tracks to conditions, etc
 # determine the location of the input files (reads).
 try:
@@ -729,6 +740,37 @@ SEQUENCEFILES = tuple([os.path.join(DATADIR, suffix_name)
 SEQUENCEFILES_REGEX = regex(
     r".*/(\S+).(fastq.1.gz|fastq.gz|fa.gz|sra|csfasta.gz|csfasta.F3.gz|export.txt.gz|remote)")
 
+###################################################################
+###################################################################
+###################################################################
+# stage remote and sra input
+###################################################################
+
+
+@active_if(PARAMS.get("staging_dir"))
+@jobs_limit(PARAMS.get("staging_jobs_limit", 4), "staging")
+@follows(mkdir("staging.dir"))
+@transform(SEQUENCEFILES,
+           regex(r".*/(\S+).(sra|remote)"),
+           r"staging.dir/\1.staged")
+def stageReads(infile, outfile):
+    '''download and extract remote and :term:`sra` input.
+
+    Reads are staged in the shared cache ``staging_dir`` in jobs
+    that only require few resources, so that the mapping jobs do
+    not download or extract reads. Each accession is fetched in a
+    separate job and only once. See
+    :func:`PipelineMapping.stageReads`.
+    '''
+    job_threads = 1
+    job_memory = PARAMS["staging_memory"]
+
+    PipelineMapping.stageReads(
+        infile, outfile,
+        PARAMS["staging_dir"],
+        locals(),
+        store=PARAMS.get("staging_store") or None)
+
 ###################################################################
 ###################################################################
 ###################################################################
@@ -736,7 +778,7 @@ SEQUENCEFILES_REGEX = regex(
 ###################################################################
 
 
-@follows(mkdir("nreads.dir"))
+@follows(mkdir("nreads.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"nreads.dir/\1.nreads")
@@ -754,7 +796,7 @@ def countReads(infile, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("tophat.dir"))
+@follows(mkdir("tophat.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(buildJunctions, buildReferenceTranscriptome),
@@ -865,7 +907,7 @@ def mapReadsWithTophat(infiles, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("tophat2.dir"))
+@follows(mkdir("tophat2.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(buildJunctions, buildReferenceTranscriptome),
@@ -984,7 +1026,7 @@ def mapReadsWithTophat2(infiles, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("hisat.dir"))
+@follows(mkdir("hisat.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(buildJunctions),
@@ -1057,6 +1099,11 @@ def mapReadsWithHisat(infiles, outfile):
 
     infile, junctions = infiles
 
+    if PARAMS.get("mapping_shards", 0) > 1:
+        PipelineMapping.runShards(m, (infile,), outfile,
+                                  PARAMS["mapping_shards"], locals())
+        return
+
     statement = m.build((infile,), outfile)
 
     P.run()
@@ -1188,7 +1235,7 @@ def loadTophatStats(infile, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("gsnap.dir"))
+@follows(mkdir("gsnap.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(buildGSNAPSpliceSites),
@@ -1259,7 +1306,7 @@ def mapReadsWithGSNAP(infiles, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("star.dir"))
+@follows(mkdir("star.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"star.dir/\1.star.bam")
@@ -1315,6 +1362,11 @@ def mapReadsWithSTAR(infile, outfile):
         executable=P.substituteParameters(**locals())["star_executable"],
         strip_sequence=PARAMS["strip_sequence"])
 
+    if PARAMS.get("mapping_shards", 0) > 1:
+        PipelineMapping.runShards(m, (infile,), outfile,
+                                  PARAMS["mapping_shards"], locals())
+        return
+
     statement = m.build((infile,), outfile)
     P.run()
 
@@ -1375,7 +1427,7 @@ def loadSTARStats(infile, outfile):
 
 
 @active_if(SPLICED_MAPPING)
-@follows(mkdir("transcriptome.dir"))
+@follows(mkdir("transcriptome.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(buildReferenceTranscriptome),
@@ -1443,7 +1495,7 @@ def mapReadsWithBowtieAgainstTranscriptome(infiles, outfile):
     P.run()
 
 
-@follows(mkdir("bowtie.dir"))
+@follows(mkdir("bowtie.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(
@@ -1506,7 +1558,7 @@ def mapReadsWithBowtie(infiles, outfile):
     P.run()
 
 
-@follows(mkdir("bowtie2.dir"))
+@follows(mkdir("bowtie2.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            add_inputs(
@@ -1561,11 +1613,17 @@ def mapReadsWithBowtie2(infiles, outfile):
         tool_options=P.substituteParameters(**locals())["bowtie2_options"],
         strip_sequence=PARAMS["strip_sequence"])
     infile, reffile = infiles
+
+    if PARAMS.get("mapping_shards", 0) > 1:
+        PipelineMapping.runShards(m, (infile,), outfile,
+                                  PARAMS["mapping_shards"], locals())
+        return
+
     statement = m.build((infile,), outfile)
     P.run()
 
 
-@follows(mkdir("bwa.dir"))
+@follows(mkdir("bwa.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"bwa.dir/\1.bwa.bam")
@@ -1638,20 +1696,27 @@ def mapReadsWithBWA(infile, outfile):
         m = PipelineMapping.BWA(
             remove_non_unique=PARAMS["remove_non_unique"],
             strip_sequence=PARAMS["strip_sequence"],
-            set_nh=PARAMS["bwa_set_nh"])
+            set_nh=PARAMS["bwa_set_nh"],
+            sort_threads=job_threads)
     elif PARAMS["bwa_algorithm"] == "mem":
         m = PipelineMapping.BWAMEM(
             remove_non_unique=PARAMS["remove_non_unique"],
             strip_sequence=PARAMS["strip_sequence"],
-            set_nh=PARAMS["bwa_set_nh"])
+            set_nh=PARAMS["bwa_set_nh"],
+            sort_threads=job_threads)
     else:
         raise ValueError("bwa algorithm '%s' not known" % algorithm)
 
+    if PARAMS.get("mapping_shards", 0) > 1:
+        PipelineMapping.runShards(m, (infile,), outfile,
+                                  PARAMS["mapping_shards"], locals())
+        return
+
     statement = m.build((infile,), outfile)
     P.run()
 
 
-@follows(mkdir("stampy.dir"))
+@follows(mkdir("stampy.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"stampy.dir/\1.stampy.bam")
@@ -1696,7 +1761,8 @@ def mapReadsWithStampy(infile, outfile):
     job_threads = PARAMS["stampy_threads"]
     job_memory = PARAMS["stampy_memory"]
 
-    m = PipelineMapping.Stampy(strip_sequence=PARAMS["strip_sequence"])
+    m = PipelineMapping.Stampy(strip_sequence=PARAMS["strip_sequence"],
+                               sort_threads=job_threads)
     statement = m.build((infile,), outfile)
     P.run()
 
@@ -1707,7 +1773,7 @@ def mapReadsWithStampy(infile, outfile):
 ###################################################################
 
 
-@follows(mkdir("butter.dir"))
+@follows(mkdir("butter.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"butter.dir/\1.butter.bam")
@@ -1768,7 +1834,8 @@ def mapReadsWithButter(infile, outfile):
 
     m = PipelineMapping.Butter(
         strip_sequence=PARAMS["strip_sequence"],
-        set_nh=PARAMS["butter_set_nh"])
+        set_nh=PARAMS["butter_set_nh"],
+        sort_threads=job_threads)
     statement = m.build((infile,), outfile)
 
     P.run()
@@ -1780,7 +1847,7 @@ def mapReadsWithButter(infile, outfile):
 ###################################################################
 
 
-@follows(mkdir("shortstack.dir"))
+@follows(mkdir("shortstack.dir"), stageReads)
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
            r"shortstack.dir/\1.shortstack.bam")
@@ -1970,7 +2037,102 @@ else:
 ###################################################################
 
 
+def getBAMStatsOptions(readsfile):
+    '''return options for bam2stats.py for a track.
+
+    Parameters
+    ----------
+    readsfile : str
+       Input filename with number of reads per sample
+
+    annotations_interface_rna_gtf : str
+        :term:`PARMS`. :term:`gtf` format file with repetitive rna
+
+    Returns
+    -------
+    options : str
+       Command line options for bam2stats.py
+    '''
+    rna_file = PARAMS["annotations_interface_rna_gff"]
+
+    nreads = PipelineMappingQC.getNumReadsFromReadsFile(readsfile)
+    track = P.snip(os.path.basename(readsfile),
+                   ".nreads")
+
+    # if a fastq file exists, submit for counting
+    if os.path.exists(track + ".fastq.gz"):
+        fastqfile = track + ".fastq.gz"
+    elif os.path.exists(track + ".fastq.1.gz"):
+        fastqfile = track + ".fastq.1.gz"
+    else:
+        fastqfile = None
+
+    options = ["--mask-bed-file=%s" % rna_file,
+               "--ignore-masked-reads",
+               "--num-reads=%i" % nreads]
+
+    if fastqfile is not None:
+        options.append("--fastq-file=%s" % fastqfile)
+
+    return " ".join(options)
+
+
+@active_if(PARAMS.get("qc_single_pass", False))
+@follows(countReads, mergeReadCounts, buildCodingExons)
+@transform(MAPPINGTARGETS,
+           regex("(.*)/(.*)\.(.*).bam"),
+           add_inputs(r"nreads.dir/\2.nreads",
+                      os.path.join(PARAMS["genome_dir"],
+                                   PARAMS["genome"] + ".fa")),
+           r"\1/\2.\3.qc")
+def buildSinglePassQC(infiles, outfile):
+    '''compute several QC metrics in a single pass through a
+    :term:`bam` file.
+
+    The output files are the same as those of :func:`buildPicardStats`,
+    :func:`buildBAMStats` and :func:`buildExonValidation`, which
+    will thus be up-to-date once this task has completed. This task
+    is only active if ``qc_single_pass`` is set.
+
+    Parameters
+    ----------
+    infiles : list
+    infiles[0] : str
+       Input filename in :term:`bam` format
+    infiles[1] : str
+       Input filename with number of reads per sample
+    infiles[2] : str
+       Filename with genomic sequence
+
+    outfile : str
+       Output filename with list of files created
+    '''
+    bamfile, readsfile, reffile = infiles
+
+    # patch for mapping against transcriptome - switch genomic reference
+    # to transcriptomic sequences
+    if "transcriptome.dir" in bamfile:
+        reffile = "refcoding.fa"
+
+    prefix = P.snip(bamfile, ".bam")
+    metrics = [
+        PipelineMappingQC.PicardAlignmentMetric(
+            prefix + ".picard_stats", reffile),
+        PipelineMappingQC.BAMStatsMetric(
+            prefix + ".readstats",
+            options=getBAMStatsOptions(readsfile),
+            job_memory="32G")]
+
+    if SPLICED_MAPPING:
+        metrics.append(PipelineMappingQC.ExonValidationMetric(
+            prefix + ".exon.validation.tsv.gz",
+            "geneset.dir/coding_exons.gtf.gz"))
+
+    PipelineMappingQC.buildSinglePassBAMQC(bamfile, metrics, outfile)
+
+
 @P.add_doc(PipelineMappingQC.buildPicardAlignmentStats)
+@follows(buildSinglePassQC)
 @transform(MAPPINGTARGETS,
            suffix(".bam"),
            add_inputs(os.path.join(PARAMS["genome_dir"],
@@ -2017,7 +2179,7 @@ def loadPicardDuplicationStats(infiles, outfiles):
     PipelineMappingQC.loadPicardDuplicationStats(infiles, outfiles)
 
 
-@follows(countReads, mergeReadCounts)
+@follows(countReads, mergeReadCounts, buildSinglePassQC)
 @transform(MAPPINGTARGETS,
            regex("(.*)/(.*)\.(.*).bam"),
            add_inputs(r"nreads.dir/\2.nreads"),
@@ -2042,36 +2204,16 @@ def buildBAMStats(infiles, outfile):
         :term:`PARMS`. :term:`gtf` format file with repetitive rna
     '''
 
-    rna_file = PARAMS["annotations_interface_rna_gff"]
-
     job_memory = "32G"
 
     bamfile, readsfile = infiles
 
-    nreads = PipelineMappingQC.getNumReadsFromReadsFile(readsfile)
-    track = P.snip(os.path.basename(readsfile),
-                   ".nreads")
-
-    # if a fastq file exists, submit for counting
-    if os.path.exists(track + ".fastq.gz"):
-        fastqfile = track + ".fastq.gz"
-    elif os.path.exists(track + ".fastq.1.gz"):
-        fastqfile = track + ".fastq.1.gz"
-    else:
-        fastqfile = None
-
-    if fastqfile is not None:
-        fastq_option = "--fastq-file=%s" % fastqfile
-    else:
-        fastq_option = ""
+    bam2stats_options = getBAMStatsOptions(readsfile)
 
     statement = '''python
     %(scriptsdir)s/bam2stats.py
-         %(fastq_option)s
+         %(bam2stats_options)s
          --force-output
-         --mask-bed-file=%(rna_file)s
-         --ignore-masked-reads
-         --num-reads=%(nreads)i
          --output-filename-pattern=%(outfile)s.%%s
     < %(bamfile)s
     > %(outfile)s
@@ -2116,6 +2258,7 @@ def loadContextStats(infiles, outfile):
 
 
 @active_if(SPLICED_MAPPING)
+@follows(buildSinglePassQC)
 @transform(MAPPINGTARGETS,
            suffix(".bam"),
            add_inputs(buildCodingExons),
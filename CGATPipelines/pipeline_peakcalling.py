@@ -848,6 +848,40 @@ def getTagSize(track):
         return None
 
 
+@follows(buildFragmentSizeTable)
+@transform(normalizeBAM,
+           suffix(".bam"),
+           ".coverage.tsv")
+def buildTagCoverage(infile, outfile):
+    '''build tag coverage for each :term:`bam` file.
+
+    The tag coverage is used by all peak callers to compute
+    peak parameters when loading peaks.
+
+    Tags are shifted by the fragment size, which is set by
+    ``coverage_offset``, or the predicted fragment size of a track.
+    Control tracks use the median fragment size of all tracks.
+    '''
+    track = P.snip(infile, ".call.bam")
+    if PARAMS.get("coverage_offset"):
+        offset = int(PARAMS["coverage_offset"])
+    else:
+        offset = getFragmentSize(track)
+        if offset is None:
+            sizes = sorted([getFragmentSize(x)
+                            for x in getFragmentSizeTable().keys()])
+            offset = sizes[len(sizes) // 2]
+
+    E.info("%s: building tag coverage with offset %i" % (track, offset))
+
+    PipelinePeakcalling.buildTagCoverage(
+        bamfile=infile,
+        outfile=outfile,
+        offset=offset,
+        submit=True,
+        job_memory=PARAMS.get("coverage_memory", "4G"))
+
+
 @follows(mkdir("macs.dir"), normalizeBAM, buildFragmentSizeTable)
 @files([("%s.call.bam" % (x.asFile()),
          "macs.dir/%s.macs" % x.asFile()) for x in TRACKS])
@@ -872,6 +906,7 @@ def callPeaksWithMACS(infile, outfile):
         tagsize=getTagSize(track))
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithMACS,
            regex(r"(.*).macs"),
            r"\1_macs.load")
@@ -979,6 +1014,7 @@ def callPeaksWithMACS2(infile, outfile):
 ############################################################
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithMACS2,
            regex(r"(.*).macs2"),
            r"\1_macs2.load")
@@ -1068,6 +1104,7 @@ def callPeaksWithZinba(infile, outfile):
 ############################################################
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithZinba,
            suffix(".zinba"),
            "_zinba.load")
@@ -1128,6 +1165,7 @@ def callBroaderPeaksWithSICER(infile, outfile):
 #                  SICER Narrower + Broader                        #
 #                                                                  #
 ####################################################################
+@follows(buildTagCoverage)
 @transform([callNarrowerPeaksWithSICER, callBroaderPeaksWithSICER],
            regex(r"(sicer.)(.*)(.dir/)([^.]*).([^.]*).sicer"),
            r"\1\2\3\4_\5Sicer.load")
@@ -1186,6 +1224,7 @@ def callPeaksWithPeakRanger(infile, outfile):
     PipelinePeakcalling.runPeakRanger(infile, outfile, controlfile)
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithPeakRanger,
            regex(r"(.*).peakranger"),
            r"\1_peakranger.load")
@@ -1227,6 +1266,7 @@ def callPeaksWithPeakRangerCCAT(infile, outfile):
     PipelinePeakcalling.runPeakRangerCCAT(infile, outfile, controlfile)
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithPeakRangerCCAT,
            regex(r"(.*).ccat"),
            r"\1_ccat.load")
@@ -1259,48 +1299,37 @@ def loadPeakRangerSummaryCCAT(infile, outfile):
 #                                                                  ##
 ######################################################################
 @follows(mkdir("broadpeak.dir"), normalizeBAM)
-@files(os.path.join(PARAMS["genome_dir"], PARAMS["genome"] + ".fasta"),
-       "broadpeak.dir/genome_windows.bed.gz")
-def buildBroadPeakGenomeWindows(infile, outfile):
-    windows = PARAMS["broadpeak_genome_windows"]
-    PipelinePeakcalling.createGenomeWindows(infile, outfile, windows)
-
-
-@transform(["%s.call.bam" % x.asFile() for x in TRACKS],
-           regex("(.+)/(.+).call.bam"),
-           add_inputs(buildBroadPeakGenomeWindows),
-           r"./broadpeak.dir/\2.bedgraph")
-def buildBroadPeakBedgraphFiles(infiles, outfile):
-    logfile = outfile + ".log"
-    overlap = str(float(PARAMS["broadpeak_read_length"]) /
-                  float(2 * PARAMS["broadpeak_genome_windows"]))
+@files([("%s.call.bam" % (x.asFile()),
+         "broadpeak.dir/%s.bedgraph" % x.asFile()) for x in TRACKS])
+def buildBroadPeakBedgraphFiles(infile, outfile):
+    '''count reads in fixed-width bins for BroadPeak.
+
+    Reads must overlap a bin by half the read length to be counted.
+    If requested, reads in the input are subtracted after
+    downsampling the larger file.
+    '''
+    window_size = PARAMS["broadpeak_genome_windows"]
+    overlap = (float(PARAMS["broadpeak_read_length"]) /
+               float(2 * window_size))
+
+    controlfile = None
     if PARAMS["broadpeak_remove_background"]:
-        remove_background = "true"
         track = P.snip(infile, ".call.bam")
         controls = getControl(Sample(track))
         controlfile = getControlFile(Sample(track), controls, "%s.call.bam")
-        infiles.append(controlfile)
-    else:
-        remove_background = "false"
-
-    params = [overlap, remove_background]
 
     P.info("Creating BroadPeak bedgraph with the following options:\n"
            " subtract INPUT from SAMPLE = %s\n"
            " create .bdg file with window size of %s\n"
-           " reads must overlap window by %s bases to be counted"
-           % (params[1],
-              PARAMS["broadpeak_genome_windows"],
-              params[0]))
+           " reads must overlap window by %s of its length to be counted"
+           % (controlfile is not None, window_size, overlap))
 
-    P.submit("/ifs/devel/projects/proj010/PipelineProj010",
-             "createBroadPeakBedgraphFile",
-             params,
-             infiles,
-             outfile,
-             to_cluster=True,
-             logfile=logfile,
-             jobOptions="-l mem_free=20G")
+    PipelinePeakcalling.buildBroadPeakBedgraph(
+        infile, outfile, window_size, overlap,
+        controlfile=controlfile,
+        seed=PARAMS["broadpeak_seed"],
+        submit=True,
+        job_memory=PARAMS.get("broadpeak_memory", "4G"))
 
 
 @transform(buildBroadPeakBedgraphFiles,
@@ -1357,6 +1386,7 @@ def callPeaksWithSPP(infile, outfile):
     PipelinePeakcalling.runSPP(infile, outfile, controlfile)
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithSPP,
            regex(r"(.*).spp"),
            r"\1_spp.load")
@@ -1524,6 +1554,7 @@ def callPeaksWithScripture(infile, outfile):
                                      contig_sizes)
 
 
+@follows(buildTagCoverage)
 @transform(callPeaksWithScripture, suffix(".scripture"), ".load")
 def loadScripture(infile, outfile):
     '''load scripture data.'''
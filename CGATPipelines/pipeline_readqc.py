@@ -285,7 +285,8 @@ if PARAMS.get("preprocessors", None):
         m = PipelinePreprocess.MasterProcessor(
             save=PARAMS["save"],
             summarize=PARAMS["summarize"],
-            threads=PARAMS["threads"])
+            threads=PARAMS["threads"],
+            fuse=PARAMS.get("fuse", False))
 
         for tool in P.asList(PARAMS["preprocessors"]):
 
@@ -371,16 +372,31 @@ def runFastqc(infiles, outfile):
     convert sra files to fastq and check mapping qualities are in
     solexa format.  Perform quality control checks on reads from
     .fastq files.
+
+    If ``readqc_engine`` is ``native``, statistics are computed
+    with :file:`cgat_fastq_stats.py` instead of FastQC. The output
+    is in the same format, but no html report or plots are created.
     '''
     # MM: only pass the contaminants file list if requested by user,
     # do not make this the default behaviour
     if PARAMS['add_contaminants']:
+        contaminants = PARAMS['contaminants']
+    else:
+        contaminants = None
+
+    engine = PARAMS.get("readqc_engine", "fastqc")
+    if engine == "fastqc":
         m = PipelineMapping.FastQc(nogroup=PARAMS["readqc_no_group"],
                                    outdir=PARAMS["exportdir"] + "/fastqc",
-                                   contaminants=PARAMS['contaminants'])
+                                   contaminants=contaminants)
+    elif engine == "native":
+        job_threads = PARAMS.get("readqc_threads", 1)
+        m = PipelineMapping.FastqStats(threads=job_threads,
+                                       nogroup=PARAMS["readqc_no_group"],
+                                       outdir=PARAMS["exportdir"] + "/fastqc",
+                                       contaminants=contaminants)
     else:
-        m = PipelineMapping.FastQc(nogroup=PARAMS["readqc_no_group"],
-                                   outdir=PARAMS["exportdir"] + "/fastqc")
+        raise ValueError("unknown readqc engine '%s'" % engine)
     if PARAMS["general_reconcile"] == 1:
         infiles = infiles.replace("processed.dir/trimmed",
                                   "reconciled.dir/trimmed")
@@ -390,20 +406,15 @@ def runFastqc(infiles, outfile):
 
 
 @jobs_limit(PARAMS.get("jobs_limit_db", 1), "db")
-@transform(runFastqc, suffix(".fastqc"), "_fastqc.load")
-def loadFastqc(infile, outfile):
-    '''load FASTQC stats into database.'''
-    track = P.snip(infile, ".fastqc")
-    filename = os.path.join(
-        PARAMS["exportdir"], "fastqc", track + "*_fastqc", "fastqc_data.txt")
-
-    PipelineReadqc.loadFastqc(filename,
-                              backend=PARAMS["database_backend"],
-                              database=PARAMS["database_name"],
-                              host=PARAMS["database_host"],
-                              username=PARAMS["database_username"],
-                              password=PARAMS["database_password"],
-                              port=PARAMS["database_port"])
+@merge(runFastqc, "fastqc.load")
+def loadFastqc(infiles, outfile):
+    '''load FASTQC stats of all samples into database.
+
+    Each section is loaded into a table called ``fastqc_<section>``
+    with the track as first column.
+    '''
+    exportdir = os.path.join(PARAMS["exportdir"], "fastqc")
+    PipelineReadqc.loadFastqcTables(infiles, exportdir, connect())
     P.touch(outfile)
 
 
@@ -561,6 +561,14 @@ def buildTranscriptGeneMap(infile, outfile):
 ###################################################################
 
 
+def getSampleSeed():
+    '''return the seed for sampling reads or None if it is not set.'''
+    seed = PARAMS.get("sample_seed", "")
+    if seed is None or seed == "":
+        return None
+    return int(seed)
+
+
 @follows(mkdir("fastq.dir"))
 @transform(SEQUENCEFILES,
            SEQUENCEFILES_REGEX,
@@ -569,7 +577,12 @@ def subsetSequenceData(infile, outfile):
     """subset fastq files"""
     ignore_pipe_erors = True
     ignore_errors = True
-    m = PipelineMapping.SubsetHead(limit=PARAMS["sample_size"])
+    if PARAMS.get("sample_method", "head") == "random":
+        m = PipelineMapping.SubsetRandom(
+            limit=PARAMS["sample_size"],
+            seed=getSampleSeed())
+    else:
+        m = PipelineMapping.SubsetHead(limit=PARAMS["sample_size"])
     statement = m.build((infile,), outfile)
     P.run()
     P.touch(outfile)
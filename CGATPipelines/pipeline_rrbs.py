@@ -167,7 +167,6 @@ import pandas as pd
 import CGATPipelines.PipelineTracks as PipelineTracks
 
 from rpy2.robjects import R
-import numpy as np
 import pandas.rpy.common as com
 ###################################################
 ###################################################
@@ -584,10 +583,21 @@ def bed2BigWig(infiles, outfile):
 @originate("methylation.dir/cpg-locations-1.cov")
 def findCpGs(outfile):
     genome_infile = PARAMS["methylation_summary_genome_fasta"]
-    job_options = "-l mem_free=2G"
-
-    RRBS.fasta2CpG(genome_infile, outfile,
-                   submit=True, job_options=job_options)
+    job_threads = PARAMS.get("methylation_summary_threads", 1)
+    job_memory = "2G"
+
+    RRBS.fasta2CpG(
+        genome_infile, outfile,
+        motif=PARAMS.get("methylation_summary_motif", "CCGG"),
+        cut_position=PARAMS.get("methylation_summary_cut_position", 1),
+        read_length=PARAMS.get("methylation_summary_read_length", 51),
+        paired=PARAMS.get("methylation_summary_paired", 0) == 1,
+        min_fragment_length=PARAMS.get(
+            "methylation_summary_min_fragment_length", 25),
+        max_fragment_length=PARAMS.get(
+            "methylation_summary_max_fragment_length", 300),
+        threads=job_threads,
+        submit=True, job_memory=job_memory, job_threads=job_threads)
 
 
 @follows(findCpGs)
@@ -597,13 +607,12 @@ def findCpGs(outfile):
 def mergeCoverage(infiles, outfile):
     cpgs_infile = infiles[-1]
     coverage_infiles = infiles[:-1]
-    # this should be replaced with a non-pandas based solution
-    # very memory intensive! - find out why and re-code
-    job_options = "-l mem_free=48G"
-    job_threads = 2
+    # memory is mostly used by sort
+    job_memory = "2G"
 
     RRBS.mergeAndDrop(cpgs_infile, coverage_infiles, outfile,
-                      submit=True, job_options=job_options)
+                      buffer_size="1G",
+                      submit=True, job_memory=job_memory)
 
 
 @transform(mergeCoverage,
@@ -847,10 +856,8 @@ def makeGeneProfiles(infiles, outfile):
            r"methylation.dir/\1_covered_meth_cpgi.tsv")
 def subsetCpGsToCovered(infile, outfile):
 
-    job_options = "-l mem_free=48G"
-
     RRBS.subsetToCovered(infile, outfile, cov_threshold=10,
-                         submit=True, job_options=job_options)
+                         submit=True, job_memory="2G")
 
 
 @originate("methylation.dir/promoter_cpgs.tsv")
@@ -944,52 +951,13 @@ def loadCoveredCpGs(infile, outfile):
     P.run()
 
 
-@follows(loadCoveredCpGs)
+@P.add_doc(RRBS.calculateMethFrequency)
 @transform(addTreatmentMeans,
            suffix(".tsv"),
            "_frequency.tsv")
 def calculateMethylationFrequency(infile, outfile):
-    ''' bin methylation and plot frequency '''
-
-    select_cmd = """
-    PRAGMA table_info(cpgs_covered_with_means)
-    """ % locals()
-
-    dbh = connect()
-
-    df = pd.read_sql_query(select_cmd, dbh)
-    select_columns = [x for x in df['name'] if "perc" in x]
-    select_columns.append("cpgi")
-    select_columns = ",".join(select_columns)
-
-    select_cmd2 = """
-        SELECT %(select_columns)s from cpgs_covered_with_means
-        """ % locals()
-
-    df2 = pd.read_sql_query(select_cmd2, dbh)
-
-    def my_digitise(array):
-        return np.digitize(array, range(0, 100, 10))
-
-    df_binned = df2[[x for x in df2.columns if "perc" in x]].apply(
-        my_digitise, axis=1)
-
-    df_binned['cpgi'] = df2['cpgi']
-    df_binned_melted = pd.melt(df_binned, "cpgi")
-
-    agg = df_binned_melted.groupby(
-        ["variable", "cpgi", "value"]).size().reset_index()
-
-    agg['tissue'] = [x.split("_")[0] for x in agg['variable']]
-
-    agg['treatment_replicate'] = ["-".join((x.split("_")[1],
-                                            x.split("_")[2]))
-                                  for x in agg['variable']]
-
-    agg['value'] = ["[ %s - %s ]" % (str((x-1)*10), str(x*10))
-                    for x in agg['value']]
-
-    agg.to_csv(outfile, sep="\t", index=False)
+    RRBS.calculateMethFrequency(infile, outfile,
+                                submit=True, job_memory="2G")
 
 
 @transform(calculateMethylationFrequency,
@@ -1099,6 +1067,14 @@ def runM3DSpikeClusters(infiles, outfile):
                           submit=True, job_options=job_options)
 
 
+def getM3DSeed():
+    '''return the seed for M3D p-values or None if it is not set.'''
+    seed = PARAMS.get("m3d_seed", "")
+    if seed is None or seed == "":
+        return None
+    return int(seed)
+
+
 @merge([runM3DSpikeClusters, "design.tsv"],
        "power.dir/spike_in_M3D_stat_merged_between.tsv")
 def calculateM3DSpikeClustersPvalue(infiles, outfile):
@@ -1106,6 +1082,8 @@ def calculateM3DSpikeClustersPvalue(infiles, outfile):
     design = infiles[-1]
     infiles = infiles[:-1]
     RRBS.calculateM3DSpikepvalue(infiles, outfile, design,
+                                 samples=PARAMS.get("m3d_samples") or None,
+                                 seed=getM3DSeed(),
                                  submit=True, job_options=job_options)
     P.touch(outfile)
 
@@ -1212,6 +1190,8 @@ def calculateM3DClustersPvalue(infiles, outfile, pair1, pair2):
 
     print infiles, outfile, pair
     RRBS.calculateM3Dpvalue(infiles, outfile, pair,
+                            samples=PARAMS.get("m3d_samples") or None,
+                            seed=getM3DSeed(),
                             submit=True, job_options=job_options)
 
 
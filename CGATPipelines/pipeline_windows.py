@@ -843,7 +843,7 @@ def buildBigBed(infile, outfile):
 @transform(prepareTags,
            regex(".*/(.*).bed.gz"),
            add_inputs(buildWindows),
-           r"counts.dir/\1.counts.bed.gz")
+           r"counts.dir/\1.counts.tsv.gz")
 def countTagsWithinWindows(infiles, outfile):
     '''
     Count the number of reads mapped to each window
@@ -869,7 +869,7 @@ def countTagsWithinWindows(infiles, outfile):
         least one base.
 
     outfile: str
-        filename for :term:`bed` formatted file of read counts per window
+        filename for :term:`tsv` formatted file of read counts per window
     '''
     bedfile, windowfile = infiles
     PipelineWindows.countTagsWithinWindows(
@@ -877,6 +877,7 @@ def countTagsWithinWindows(infiles, outfile):
         windowfile,
         outfile,
         counting_method=PARAMS['tiling_counting_method'],
+        submit=True,
         job_memory=PARAMS['tiling_counting_memory'])
 
 
@@ -890,7 +891,7 @@ def aggregateWindowsTagCounts(infiles, outfile):
     Parameters
     ----------
     infiles: list
-        filenames of all :term:`bed` formatted window read count files
+        filenames of all :term:`tsv` formatted window read count files
 
     outfile: str
         output filename for compiled window read counts
@@ -898,7 +899,7 @@ def aggregateWindowsTagCounts(infiles, outfile):
 
     PipelineWindows.aggregateWindowsTagCounts(infiles,
                                               outfile,
-                                              regex="(.*).counts.bed.gz")
+                                              regex="(.*).counts.tsv.gz")
 
 
 # @P.add_doc(PipelineWindows.countTagsWithinWindows)
@@ -908,7 +909,7 @@ def aggregateWindowsTagCounts(infiles, outfile):
            add_inputs(os.path.join(
                PARAMS["annotations_dir"],
                PARAMS["annotations_interface_genomic_context_bed"])),
-           r"contextstats.dir/\1.counts.bed.gz")
+           r"contextstats.dir/\1.counts.tsv.gz")
 def countTagsWithinContext(infiles, outfile):
     '''collect context stats of BED files.
 
@@ -930,7 +931,7 @@ def countTagsWithinContext(infiles, outfile):
         filename of :term:`bed` file containing genomic context
 
     outfile: str
-        filename for :term:`bed` formatted file of genomic context of tags
+        filename for :term:`tsv` formatted file of genomic context of tags
 
     '''
     tagfile, windowfile = infiles
@@ -938,6 +939,7 @@ def countTagsWithinContext(infiles, outfile):
                                            windowfile,
                                            outfile,
                                            counting_method="midpoint",
+                                           submit=True,
                                            job_memory="4G")
 
 
@@ -950,7 +952,7 @@ def aggregateContextTagCounts(infiles, outfile):
     Parameters
     ----------
     infiles: list
-        list of filenames of :term:`bed` files containing tag counts for
+        list of filenames of :term:`tsv` files containing tag counts for
         genomic contexts
     outfile: str
         filename for :term:`tsv` formatted file showing tag counts for
@@ -959,7 +961,7 @@ def aggregateContextTagCounts(infiles, outfile):
     '''
     PipelineWindows.aggregateWindowsTagCounts(infiles,
                                               outfile,
-                                              regex="(.*).counts.bed.gz")
+                                              regex="(.*).counts.tsv.gz")
 
 
 @transform((aggregateWindowsTagCounts, aggregateContextTagCounts),
@@ -0,0 +1,173 @@
+'''cgat_bam_postprocess.py - post-process reads from a mapper
+==========================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script reads a :term:`bam` formatted file as output by a short
+read mapper, applies one or more post-processing steps and outputs
+an uncompressed :term:`bam` formatted file on stdout.
+
+All steps are applied in a single pass over the input. The output is
+meant to be piped directly into ``samtools sort``. This avoids
+compressing and decompressing the data between steps, as happens
+when several ``bam2bam.py`` commands are chained.
+
+The following steps are available with the ``--method`` option. They
+are applied in this order:
+
+``remove-non-unique``
+   remove unmapped reads and reads that map to several locations. A
+   read is non-unique if its NH tag is larger than 1. If there is no
+   NH tag, the X0 tag (number of best hits as set by BWA) is used.
+
+``strip-sequence``
+   remove the sequence and quality scores from all reads.
+
+``set-nh``
+   set the NH tag of mapped reads to the number of alignments of a
+   read. For paired-end data, the alignments of each mate are
+   counted separately. The input needs to be grouped by read name,
+   which is the case for the output of most mappers.
+
+The first two steps correspond to ``bam2bam.py --method=filter
+--filter-method=unique,mapped`` and ``bam2bam.py
+--method=strip-sequence``.
+
+Usage
+-----
+
+For example::
+
+   python cgat_bam_postprocess.py
+      --method=remove-non-unique --method=set-nh --log=out.log
+   < in.bam
+   | samtools sort -@ 4 -o out.bam -
+
+Type::
+
+   python cgat_bam_postprocess.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import itertools
+import pysam
+
+import CGAT.Experiment as E
+
+
+def removeNonUnique(reads, counter):
+    '''remove unmapped and non-unique reads from `reads`.'''
+    for read in reads:
+        counter.input += 1
+        if read.is_unmapped:
+            counter.removed_unmapped += 1
+            continue
+        if read.has_tag("NH"):
+            nh = read.get_tag("NH")
+        elif read.has_tag("X0"):
+            nh = read.get_tag("X0")
+        else:
+            nh = 1
+        if nh > 1:
+            counter.removed_nonunique += 1
+            continue
+        yield read
+
+
+def stripSequence(reads):
+    '''remove sequence and quality scores from `reads`.'''
+    for read in reads:
+        read.query_sequence = None
+        yield read
+
+
+def setNH(reads):
+    '''set NH tag of `reads` to the number of alignments of a read.
+
+    Reads need to be grouped by read name.
+    '''
+    for key, group in itertools.groupby(reads, lambda x: x.query_name):
+        group = list(group)
+        # count alignments separately for each mate
+        mapped = [x.is_read2 for x in group if not x.is_unmapped]
+        nh2 = sum(mapped)
+        nh1 = len(mapped) - nh2
+        for read in group:
+            if not read.is_unmapped:
+                if read.is_read2:
+                    read.set_tag("NH", nh2)
+                else:
+                    read.set_tag("NH", nh1)
+            yield read
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "-m", "--method", dest="methods", type="choice", action="append",
+        choices=("remove-non-unique", "strip-sequence", "set-nh"),
+        help="post-processing steps to apply. Steps are applied in "
+        "a fixed order, see above [%default].")
+
+    parser.add_option(
+        "-i", "--input-bam", dest="input_bam", type="string",
+        help="input file. Use '-' for stdin [%default].")
+
+    parser.set_defaults(
+        methods=[],
+        input_bam="-",
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    pysam_in = pysam.AlignmentFile(options.input_bam, "rb")
+    # uncompressed output for piping
+    pysam_out = pysam.AlignmentFile("-", "wbu", template=pysam_in)
+
+    counter = E.Counter()
+    reads = pysam_in.fetch(until_eof=True)
+
+    if "remove-non-unique" in options.methods:
+        reads = removeNonUnique(reads, counter)
+
+    if "strip-sequence" in options.methods:
+        reads = stripSequence(reads)
+
+    if "set-nh" in options.methods:
+        reads = setNH(reads)
+
+    for read in reads:
+        counter.output += 1
+        pysam_out.write(read)
+
+    pysam_out.close()
+    pysam_in.close()
+
+    E.info("%s" % str(counter))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,189 @@
+'''cgat_bed2peaks.py - compute peak parameters from tag coverage
+===========================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script reads :term:`bed` formatted intervals from stdin and
+computes peak parameters within each interval from a tag coverage
+file built by :func:`PipelinePeakcalling.buildTagCoverage`. It does
+not read the :term:`bam` file again, so several sets of intervals
+can be annotated from the same tag coverage.
+
+The output has the same columns as ``bed2table.py --counter=peaks
+--output-all-fields``. All fields of the input intervals are output
+followed by these columns:
+
+length
+   length of interval
+nreads
+   number of tags overlapping the interval
+avgval
+   average tag coverage in the interval
+peakval
+   maximum tag coverage in the interval
+npeaks
+   number of bases with maximum tag coverage
+peakcenter
+   median position of bases with maximum tag coverage
+
+If ``--control-coverage-file`` is given, the same columns are
+added for the control with the prefix ``control_``.
+
+The peak shift is the one used to build the tag coverage. Apart from
+``nreads``, the values are the same as for ``bed2table.py``.
+``nreads`` has a different meaning: here it counts the shifted and
+extended tags that overlap the interval. bed2table.py instead counts
+every read fetched from the interval widened by half the peak shift
+on each side, including reads that are flagged as unmapped.
+
+All intervals are read into memory and processed one contig at
+a time.
+
+Usage
+-----
+
+For example::
+
+   python cgat_bed2peaks.py
+      --coverage-file=sample.call.coverage.tsv
+      --control-coverage-file=input.call.coverage.tsv
+      --output-bed-headers=contig,start,end,interval_id
+   < peaks.bed > peaks.tsv
+
+Type::
+
+   python cgat_bed2peaks.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import collections
+
+import CGAT.Experiment as E
+import CGAT.Bed as Bed
+import CGATPipelines.PipelinePeakcalling as PipelinePeakcalling
+
+HEADERS = ("length", "nreads", "avgval", "peakval", "npeaks", "peakcenter")
+
+
+def countPeaks(coverage, beds):
+    '''compute peak parameters for intervals.
+
+    Arguments
+    ---------
+    coverage : TagCoverage
+        Tag coverage to compute peak parameters from.
+    beds : list
+        List of intervals.
+
+    Returns
+    -------
+    results : list
+        List of tuples with peak parameters in the same order as
+        :data:`HEADERS` and `beds`.
+    '''
+    by_contig = collections.OrderedDict()
+    for index, bed in enumerate(beds):
+        by_contig.setdefault(bed.contig, []).append(index)
+
+    results = [None] * len(beds)
+    for contig, indices in by_contig.items():
+        (npeaks, peakcenter, length,
+         avgval, peakval, nreads) = coverage.countPeaks(
+             contig,
+             [beds[x].start for x in indices],
+             [beds[x].end for x in indices])
+        for index, result in zip(indices, zip(
+                length, nreads, avgval, peakval, npeaks, peakcenter)):
+            results[index] = result
+
+    return results
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "-c", "--coverage-file", dest="coverage_file", type="string",
+        help="tag coverage file [%default].")
+
+    parser.add_option(
+        "--control-coverage-file", dest="control_coverage_file",
+        type="string",
+        help="tag coverage file of control [%default].")
+
+    parser.add_option(
+        "--output-bed-headers", dest="bed_headers", type="string",
+        help="supply ',' separated list of headers for bed component "
+        "[%default].")
+
+    parser.set_defaults(
+        coverage_file=None,
+        control_coverage_file=None,
+        bed_headers=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.coverage_file:
+        raise ValueError("please supply a tag coverage file")
+
+    beds = list(Bed.iterator(options.stdin))
+    if len(beds) == 0:
+        E.warn("no intervals in input")
+        E.Stop()
+        return
+
+    if options.bed_headers is not None:
+        bed_headers = [x.strip() for x in options.bed_headers.split(",")]
+        if len(bed_headers) < 3:
+            raise ValueError("a bed file needs at least three columns")
+        if len(bed_headers) > beds[0].columns:
+            raise ValueError(
+                "insufficient columns (%i, expected %i) in %s" %
+                (beds[0].columns, len(bed_headers), str(beds[0])))
+    else:
+        bed_headers = Bed.Headers[:beds[0].columns]
+
+    headers = list(HEADERS)
+    results = countPeaks(
+        PipelinePeakcalling.TagCoverage(options.coverage_file), beds)
+
+    if options.control_coverage_file:
+        headers.extend(["control_%s" % x for x in HEADERS])
+        control_results = countPeaks(
+            PipelinePeakcalling.TagCoverage(options.control_coverage_file),
+            beds)
+        results = [x + y for x, y in zip(results, control_results)]
+
+    options.stdout.write("\t".join(bed_headers + headers) + "\n")
+    for bed, result in zip(beds, results):
+        options.stdout.write(
+            "%s\t%s\n" % (str(bed), "\t".join(map(str, result))))
+
+    E.info("computed peak parameters for %i intervals" % len(beds))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
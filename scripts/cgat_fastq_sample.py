@@ -0,0 +1,265 @@
+'''cgat_fastq_sample.py - sample reads from fastq files
+=====================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script takes one or more samples of reads from a :term:`fastq`
+formatted file or a pair of files with paired-end data. Paired files
+are read in sync so that both mates of a pair are always selected
+together. The script fails if paired files contain different numbers
+of reads.
+
+The following methods are available:
+
+random
+   take a random sample of reads. The reads are sampled in a single
+   pass without sorting the input. Each read is assigned a random key
+   and the reads with the smallest keys are kept (bottom-k reservoir
+   sampling). Memory usage is thus proportional to the sample size
+   and not to the size of the input. If several sample sizes are
+   given, the smaller samples are subsets of the larger samples.
+   The random number generator can be seeded with ``--seed`` to
+   obtain reproducible samples.
+
+head
+   take the first reads of the input. Reads are written to all
+   samples as they are read, so memory usage is constant. Reading
+   stops once the largest sample has been taken.
+
+Within each sample, reads are output in the same order as in the
+input.
+
+Usage
+-----
+
+To take a random sample of 1 million read pairs, type::
+
+   python cgat_fastq_sample.py
+      --sample-size=1000000
+      --seed=1
+      --output-filename-pattern=sample.fastq.%(mate)i.gz
+      in.fastq.1.gz in.fastq.2.gz
+
+The output filename pattern can contain the following fields:
+
+``%(mate)i``
+    1 or 2 for first and second read in pair, respectively.
+    Required for paired-end data.
+``%(sample)i``
+    index of the sample size in the sorted list of sample sizes,
+    starting from 0. Required if several sample sizes are given.
+
+Type::
+
+   python cgat_fastq_sample.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import heapq
+import random
+import itertools
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+def iterateRecords(infile):
+    '''iterate over :term:`fastq` records in `infile`.
+
+    Records are returned as strings of four lines without any
+    parsing.
+    '''
+    while True:
+        lines = list(itertools.islice(infile, 4))
+        if not lines:
+            break
+        if len(lines) != 4:
+            raise ValueError("incomplete fastq record at end of file")
+        yield "".join(lines)
+
+
+def iterateMates(infiles):
+    '''iterate over records in one or more :term:`fastq` files in
+    parallel.
+
+    Returns tuples of records, one for each file.
+
+    Raises
+    ------
+    ValueError
+        If the files contain different numbers of records.
+    '''
+    for records in itertools.izip_longest(
+            *[iterateRecords(x) for x in infiles]):
+        if None in records:
+            raise ValueError(
+                "fastq files contain different numbers of records")
+        yield records
+
+
+def sampleHead(records, sample_sizes, outfiles):
+    '''write the first reads from `records` to `outfiles`.
+
+    Records are streamed and each record is written to all samples
+    that have not reached their size. Reading stops after the largest
+    sample size.
+
+    Arguments
+    ---------
+    records : iterator
+        Tuples of records, one for each mate.
+    sample_sizes : list
+        Sample sizes.
+    outfiles : list
+        List of lists of output files, one list of mates for each
+        sample size.
+
+    Returns
+    -------
+    counts : list
+        Number of records written for each sample size.
+    '''
+    counts = [0] * len(sample_sizes)
+    for index, record in enumerate(
+            itertools.islice(records, max(sample_sizes))):
+        for sample_index, size in enumerate(sample_sizes):
+            if index < size:
+                for outf, mate in zip(outfiles[sample_index], record):
+                    outf.write(mate)
+                counts[sample_index] += 1
+    return counts
+
+
+def sampleRandom(records, sample_sizes, rng=random):
+    '''take a random sample of reads from `records`.
+
+    The sampling is done in a single pass with memory proportional to
+    the largest sample size. Smaller samples are subsets of larger
+    samples.
+
+    Returns
+    -------
+    samples : list
+        List of lists of records, one list for each sample size.
+        Records are in input order.
+    '''
+    largest = max(sample_sizes)
+    # heap of (-key, index, record) keeping records with smallest keys
+    heap = []
+    for index, record in enumerate(records):
+        key = rng.random()
+        if len(heap) < largest:
+            heapq.heappush(heap, (-key, index, record))
+        elif -key > heap[0][0]:
+            heapq.heapreplace(heap, (-key, index, record))
+
+    # sort by key to build nested samples
+    by_key = sorted(heap, reverse=True)
+    samples = []
+    for size in sample_sizes:
+        sample = sorted(by_key[:size], key=lambda x: x[1])
+        samples.append([x[2] for x in sample])
+    return samples
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "-m", "--method", dest="method", type="choice",
+        choices=("random", "head"),
+        help="sampling method [%default].")
+
+    parser.add_option(
+        "-n", "--sample-size", dest="sample_sizes", type="string",
+        help="number of reads or read pairs to sample. Several sample "
+        "sizes can be given as a comma-separated list [%default].")
+
+    parser.add_option(
+        "--seed", dest="seed", type="int",
+        help="seed for random number generator [%default].")
+
+    parser.add_option(
+        "-p", "--output-filename-pattern", dest="output_filename_pattern",
+        type="string",
+        help="pattern for output files [%default].")
+
+    parser.set_defaults(
+        method="random",
+        sample_sizes="1000000",
+        seed=None,
+        output_filename_pattern=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if len(args) not in (1, 2):
+        raise ValueError("please supply one or two fastq files")
+
+    if options.output_filename_pattern is None:
+        raise ValueError("please specify --output-filename-pattern")
+
+    sample_sizes = sorted(map(int, options.sample_sizes.split(",")))
+    if len(args) == 2 and "%(mate)" not in options.output_filename_pattern:
+        raise ValueError("output filename pattern requires %(mate)i "
+                         "for paired-end data")
+    if len(sample_sizes) > 1 and \
+       "%(sample)" not in options.output_filename_pattern:
+        raise ValueError("output filename pattern requires %(sample)i "
+                         "for several sample sizes")
+
+    infiles = [IOTools.openFile(x) for x in args]
+    records = iterateMates(infiles)
+
+    outfiles = [[IOTools.openFile(options.output_filename_pattern % {
+        "sample": sample_index, "mate": mate + 1}, "w")
+        for mate in range(len(infiles))]
+        for sample_index in range(len(sample_sizes))]
+
+    if options.method == "random":
+        rng = random.Random(options.seed)
+        samples = sampleRandom(records, sample_sizes, rng)
+        counts = []
+        for sample, mates in zip(samples, outfiles):
+            for record in sample:
+                for outf, mate in zip(mates, record):
+                    outf.write(mate)
+            counts.append(len(sample))
+    elif options.method == "head":
+        counts = sampleHead(records, sample_sizes, outfiles)
+
+    for sample_index, mates in enumerate(outfiles):
+        for outf in mates:
+            outf.close()
+        E.info("sample %i: wrote %i reads out of %i requested" %
+               (sample_index, counts[sample_index],
+                sample_sizes[sample_index]))
+
+    for infile in infiles:
+        infile.close()
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
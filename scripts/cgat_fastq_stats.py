@@ -0,0 +1,901 @@
+'''cgat_fastq_stats.py - compute read statistics from fastq files
+=============================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script computes quality control statistics for one or more
+:term:`fastq` formatted files. It is a faster replacement of the
+statistics collected by FastQC_ and writes its output in the same
+format, so that it can be loaded and reported by the readqc pipeline
+without changes.
+
+Reads are processed in chunks. Each chunk is converted into a matrix
+of bases and quality scores and the statistics are accumulated with
+numpy. With ``--threads`` larger than 1, chunks are processed in
+parallel by several worker processes while the main process reads
+the input. Compressed input is decompressed by a separate ``gzip``
+process.
+
+The following sections are output:
+
+Basic Statistics
+    Number of sequences, quality score encoding, length range and
+    GC content.
+Per base sequence quality
+    Mean, median, quartiles and 10th/90th percentiles of quality
+    scores at each position.
+Per sequence quality scores
+    Distribution of the mean quality score of reads.
+Per base sequence content
+    Percentage of each base at each position.
+Per sequence GC content
+    Distribution of GC content of reads.
+Per base N content
+    Percentage of N at each position.
+Sequence Length Distribution
+    Distribution of read lengths.
+Sequence Duplication Levels
+    Estimate of read duplication. Duplication is estimated from the
+    first 100,000 distinct sequences in a file. As in FastQC, reads
+    longer than 75 bases are truncated to 50 bases.
+Overrepresented sequences
+    Sequences that make up more than 0.1% of all reads. Sequences
+    are compared to a list of contaminants given by ``--contaminants``.
+Kmer Content
+    Kmers that are enriched at particular positions in reads.
+
+Positions are grouped as in FastQC unless ``--nogroup`` is set. Each
+section receives a pass/warn/fail status using the thresholds of
+FastQC.
+
+Output for an input file :file:`sample.fastq.1.gz` is written to
+:file:`sample.fastq.1_fastqc/fastqc_data.txt` in the directory given
+by ``--outdir``. A file :file:`summary.txt` with the status of each
+section is written alongside.
+
+Usage
+-----
+
+For example::
+
+   python cgat_fastq_stats.py
+      --outdir=export/fastqc
+      --threads=4
+      sample.fastq.1.gz sample.fastq.2.gz
+
+Type::
+
+   python cgat_fastq_stats.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import difflib
+import itertools
+import collections
+import subprocess
+import multiprocessing
+import numpy
+import scipy.stats
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+# number of distinct sequences tracked for duplication and
+# over-representation, as in FastQC
+MAX_TRACKED = 100000
+
+# upper bounds of duplication levels and their labels
+DUPLICATION_BINS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 49, 99, 499, 999, 4999,
+                    9999]
+DUPLICATION_LABELS = ["1", "2", "3", "4", "5", "6", "7", "8", "9",
+                      ">10", ">50", ">100", ">500", ">1k", ">5k", ">10k+"]
+
+# map ASCII characters to base codes A=0, C=1, G=2, T=3, other=4
+BASE_CODES = numpy.empty(256, dtype=numpy.int8)
+BASE_CODES.fill(4)
+for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+COMPLEMENT = {"A": "T", "C": "G", "G": "C", "T": "A", "N": "N"}
+
+
+def getGroupStarts(length, nogroup=False):
+    '''return 0-based start positions of position groups covering
+    reads of up to `length` bases.
+
+    Without `nogroup`, the first 9 positions are reported
+    individually and later positions are grouped into increasingly
+    larger groups.
+    '''
+    if nogroup:
+        return list(range(length))
+
+    starts = []
+    position = 0
+    while position < length:
+        starts.append(position)
+        if position < 9:
+            position += 1
+        elif position < 49:
+            position += 5
+        elif position < 99:
+            position += 10
+        elif position < 999:
+            position += 50
+        else:
+            position += 100
+    return starts
+
+
+def getGroupLabels(starts, length):
+    '''return 1-based labels of position groups.'''
+    labels = []
+    for start, end in zip(starts, starts[1:] + [length]):
+        if end - start == 1:
+            labels.append(str(start + 1))
+        else:
+            labels.append("%i-%i" % (start + 1, end))
+    return labels
+
+
+def getGroupIndex(length, nogroup=False):
+    '''return array mapping positions to their group.'''
+    starts = getGroupStarts(length, nogroup)
+    index = numpy.zeros(length, dtype=numpy.int64)
+    index[starts[1:]] = 1
+    return numpy.cumsum(index)
+
+
+def padRows(array, nrows):
+    '''return `array` extended to `nrows` rows with zeros.'''
+    if array.shape[0] >= nrows:
+        return array
+    result = numpy.zeros((nrows,) + array.shape[1:], dtype=array.dtype)
+    result[:array.shape[0]] = array
+    return result
+
+
+def addPadded(a, b):
+    '''add arrays `a` and `b` that differ in the number of rows.'''
+    nrows = max(a.shape[0], b.shape[0])
+    return padRows(a, nrows) + padRows(b, nrows)
+
+
+def truncateSequence(sequence):
+    '''return sequence used for duplication and over-representation.'''
+    if len(sequence) > 75:
+        return sequence[:50]
+    return sequence
+
+
+class FastqStatistics(object):
+    '''accumulator for statistics of :term:`fastq` formatted reads.
+
+    Statistics of chunks are collected with :meth:`add` and chunks
+    are combined with :meth:`merge`. Quality scores are accumulated
+    as raw ASCII values, the encoding is resolved on output.
+
+    Arguments
+    ---------
+    kmer_size : int
+        Size of kmers to count.
+    nogroup : bool
+        If True, do not group positions.
+    '''
+
+    def __init__(self, kmer_size=7, nogroup=False):
+        self.kmer_size = kmer_size
+        self.nogroup = nogroup
+        self.nreads = 0
+        # position x ASCII value
+        self.quality_counts = numpy.zeros((0, 128), dtype=numpy.int64)
+        # position x (A, C, G, T, N)
+        self.base_counts = numpy.zeros((0, 5), dtype=numpy.int64)
+        # mean ASCII value of reads
+        self.mean_quality_counts = numpy.zeros(128, dtype=numpy.int64)
+        self.gc_counts = numpy.zeros(101, dtype=numpy.int64)
+        self.length_counts = numpy.zeros(0, dtype=numpy.int64)
+        # position group x kmer
+        self.kmer_counts = numpy.zeros((0, 4 ** kmer_size),
+                                       dtype=numpy.int64)
+        self.sequence_counts = collections.Counter()
+        self.min_quality = 255
+
+    def add(self, sequences, qualities):
+        '''add reads in lists `sequences` and `qualities`.'''
+
+        nreads = len(sequences)
+        if nreads == 0:
+            return
+
+        lengths = numpy.array([len(x) for x in sequences],
+                              dtype=numpy.int64)
+        if numpy.any(lengths != [len(x) for x in qualities]):
+            raise ValueError(
+                "sequence and quality lengths differ in chunk")
+
+        maxlen = lengths.max()
+        mask = numpy.arange(maxlen) < lengths[:, None]
+
+        bases = numpy.zeros((nreads, maxlen), dtype=numpy.uint8)
+        bases[mask] = numpy.frombuffer("".join(sequences),
+                                       dtype=numpy.uint8)
+        codes = BASE_CODES[bases]
+        codes[~mask] = 5
+
+        quals = numpy.zeros((nreads, maxlen), dtype=numpy.int64)
+        quals[mask] = numpy.frombuffer("".join(qualities),
+                                       dtype=numpy.uint8)
+
+        self.nreads += nreads
+        if lengths.min() > 0:
+            self.min_quality = min(self.min_quality, quals[mask].min())
+
+        # per position counts
+        positions = numpy.nonzero(mask)[1]
+        self.quality_counts = addPadded(
+            self.quality_counts,
+            numpy.bincount(
+                positions * 128 + quals[mask],
+                minlength=maxlen * 128).reshape(maxlen, 128))
+
+        self.base_counts = addPadded(
+            self.base_counts,
+            numpy.bincount(
+                positions * 5 + codes[mask],
+                minlength=maxlen * 5).reshape(maxlen, 5))
+
+        self.length_counts = addPadded(
+            self.length_counts,
+            numpy.bincount(lengths, minlength=maxlen + 1))
+
+        # per read statistics
+        nonempty = lengths > 0
+        mean_quality = quals.sum(axis=1)[nonempty] // lengths[nonempty]
+        self.mean_quality_counts += numpy.bincount(mean_quality,
+                                                   minlength=128)[:128]
+
+        acgt = ((codes < 4).sum(axis=1)).astype(numpy.float64)
+        gc = ((codes == 1) | (codes == 2)).sum(axis=1)
+        has_acgt = acgt > 0
+        gc_percent = numpy.round(
+            100.0 * gc[has_acgt] / acgt[has_acgt]).astype(numpy.int64)
+        self.gc_counts += numpy.bincount(gc_percent, minlength=101)
+
+        self.addKmers(codes, lengths)
+
+        self.sequence_counts.update(truncateSequence(x) for x in sequences)
+
+    def addKmers(self, codes, lengths):
+        '''count kmers in matrix of base `codes`.'''
+        k = self.kmer_size
+        maxlen = codes.shape[1]
+        npositions = maxlen - k + 1
+        if npositions <= 0:
+            return
+
+        # kmers with N or beyond the end of a read are invalid
+        invalid = numpy.zeros((codes.shape[0], maxlen + 1),
+                              dtype=numpy.int64)
+        invalid[:, 1:] = numpy.cumsum(codes >= 4, axis=1)
+        valid = (invalid[:, k:] - invalid[:, :npositions]) == 0
+
+        kmers = numpy.zeros((codes.shape[0], npositions),
+                            dtype=numpy.int64)
+        for offset in range(k):
+            kmers = kmers * 4 + (
+                codes[:, offset:offset + npositions] & 3)
+
+        group_index = getGroupIndex(maxlen, self.nogroup)[:npositions]
+        ngroups = group_index[-1] + 1
+        nkmers = 4 ** k
+        groups = numpy.broadcast_to(group_index, kmers.shape)
+        counts = numpy.bincount(
+            groups[valid] * nkmers + kmers[valid],
+            minlength=ngroups * nkmers).reshape(ngroups, nkmers)
+        self.kmer_counts = addPadded(self.kmer_counts, counts)
+
+    def merge(self, other):
+        '''add statistics in `other` to this object.'''
+        self.nreads += other.nreads
+        self.min_quality = min(self.min_quality, other.min_quality)
+        self.quality_counts = addPadded(self.quality_counts,
+                                        other.quality_counts)
+        self.base_counts = addPadded(self.base_counts, other.base_counts)
+        self.length_counts = addPadded(self.length_counts,
+                                       other.length_counts)
+        self.kmer_counts = addPadded(self.kmer_counts, other.kmer_counts)
+        self.mean_quality_counts += other.mean_quality_counts
+        self.gc_counts += other.gc_counts
+
+
+class SequenceTracker(object):
+    '''count sequences for duplication and over-representation.
+
+    Only the first :data:`MAX_TRACKED` distinct sequences are
+    counted. Duplication levels are computed from the counts at
+    the time this limit was reached.
+    '''
+
+    def __init__(self, max_tracked=MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self.counts = {}
+        self.counts_at_limit = None
+
+    def update(self, counts):
+        '''add sequence `counts` of a chunk.'''
+        tracked = self.counts
+        for sequence, count in counts.items():
+            if sequence in tracked:
+                tracked[sequence] += count
+            elif len(tracked) < self.max_tracked:
+                tracked[sequence] = count
+            elif self.counts_at_limit is None:
+                self.counts_at_limit = numpy.array(tracked.values(),
+                                                   dtype=numpy.int64)
+
+    def getDuplicationCounts(self):
+        '''return counts of distinct sequences.'''
+        if self.counts_at_limit is not None:
+            return self.counts_at_limit
+        return numpy.array(self.counts.values(), dtype=numpy.int64)
+
+
+def iterateChunks(infile, chunk_size):
+    '''iterate over chunks of reads in `infile`.
+
+    Yields
+    ------
+    sequences : list
+        Read sequences
+    qualities : list
+        Read quality strings
+    '''
+    while True:
+        lines = list(itertools.islice(infile, chunk_size * 4))
+        if not lines:
+            break
+        if len(lines) % 4 != 0:
+            raise ValueError("incomplete fastq record at end of file")
+        if not all(x.startswith("@") for x in lines[::4]):
+            raise ValueError("malformed fastq record in chunk")
+        yield ([x.rstrip("\r\n") for x in lines[1::4]],
+               [x.rstrip("\r\n") for x in lines[3::4]])
+
+
+def openFastq(filename):
+    '''open `filename`, decompressing with a separate process
+    if it is compressed.
+
+    Returns
+    -------
+    infile : file
+        Open file.
+    process : object
+        Decompression process or None.
+    '''
+    if filename.endswith(".gz"):
+        process = subprocess.Popen(["gzip", "-dc", filename],
+                                   stdout=subprocess.PIPE,
+                                   bufsize=-1)
+        return process.stdout, process
+    return IOTools.openFile(filename), None
+
+
+def _collectChunk(args):
+    '''compute statistics for a chunk in a worker process.'''
+    chunk, kmer_size, nogroup = args
+    stats = FastqStatistics(kmer_size, nogroup)
+    stats.add(*chunk)
+    counts = stats.sequence_counts
+    stats.sequence_counts = None
+    return stats, counts
+
+
+def _iterateResults(pool, tasks, max_pending):
+    '''iterate over results of `tasks` computed by `pool`.
+
+    Unlike :meth:`multiprocessing.Pool.imap`, at most `max_pending`
+    chunks are read ahead of the results.
+    '''
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(_collectChunk, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def collectStatistics(filename, chunk_size=100000, threads=1,
+                      kmer_size=7, nogroup=False):
+    '''compute statistics for :term:`fastq` formatted file `filename`.
+
+    Returns
+    -------
+    stats : FastqStatistics
+        Accumulated statistics
+    tracker : SequenceTracker
+        Sequence counts
+    '''
+
+    infile, process = openFastq(filename)
+    stats = FastqStatistics(kmer_size, nogroup)
+    tracker = SequenceTracker()
+
+    tasks = ((chunk, kmer_size, nogroup)
+             for chunk in iterateChunks(infile, chunk_size))
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = _iterateResults(pool, tasks, 2 * threads)
+    else:
+        pool = None
+        results = itertools.imap(_collectChunk, tasks)
+
+    try:
+        for chunk_stats, counts in results:
+            stats.merge(chunk_stats)
+            tracker.update(counts)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        infile.close()
+        if process is not None and process.wait() != 0:
+            raise OSError("decompression of %s failed" % filename)
+
+    return stats, tracker
+
+
+def readContaminants(filename):
+    '''read contaminants from FastQC formatted file `filename`.
+
+    Returns
+    -------
+    contaminants : list
+        List of tuples of (name, sequence).
+    '''
+    contaminants = []
+    with IOTools.openFile(filename) as inf:
+        for line in inf:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.split()
+            contaminants.append((" ".join(fields[:-1]), fields[-1].upper()))
+    return contaminants
+
+
+def findContaminant(sequence, contaminants):
+    '''return best hit of `sequence` in `contaminants`.
+
+    A hit requires an exact match of at least 20 bases or, for
+    shorter sequences, of the whole sequence. Both strands are
+    searched.
+    '''
+    reverse = "".join(COMPLEMENT.get(x, "N") for x in reversed(sequence))
+    best_size, best_name = 0, None
+    for name, contaminant in contaminants:
+        for query in (sequence, reverse):
+            match = difflib.SequenceMatcher(
+                None, query, contaminant, autojunk=False).find_longest_match(
+                    0, len(query), 0, len(contaminant))
+            if match.size < min(20, len(query)):
+                continue
+            if match.size > best_size:
+                best_size, best_name = match.size, name
+
+    if best_name is None:
+        return "No Hit"
+    return "%s (100%% over %ibp)" % (best_name, best_size)
+
+
+def getPercentiles(counts, fractions):
+    '''return percentiles of histograms in rows of `counts`.'''
+    cumulative = numpy.cumsum(counts, axis=1)
+    totals = cumulative[:, -1][:, None]
+    return [(cumulative < totals * fraction).sum(axis=1)
+            for fraction in fractions]
+
+
+def getStatus(value, warn, fail, higher_is_worse=True):
+    '''return pass/warn/fail status of `value`.'''
+    if not higher_is_worse:
+        value, warn, fail = -value, -warn, -fail
+    if value > fail:
+        return "fail"
+    elif value > warn:
+        return "warn"
+    return "pass"
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return "%.6g" % value
+    return str(value)
+
+
+def buildSections(stats, tracker, filename, contaminants=None):
+    '''build FastQC sections from `stats` and `tracker`.
+
+    Returns
+    -------
+    sections : list
+        List of tuples of (name, status, header, rows).
+    '''
+
+    sections = []
+
+    nreads = stats.nreads
+    if stats.min_quality < 64:
+        offset, encoding = 33, "Sanger / Illumina 1.9"
+    else:
+        offset, encoding = 64, "Illumina 1.5"
+
+    lengths = numpy.nonzero(stats.length_counts)[0]
+    if len(lengths) == 0:
+        length_range = "0"
+    elif lengths[0] == lengths[-1]:
+        length_range = str(lengths[0])
+    else:
+        length_range = "%i-%i" % (lengths[0], lengths[-1])
+
+    base_counts = stats.base_counts
+    total_acgt = base_counts[:, :4].sum()
+    if total_acgt > 0:
+        gc_content = 100 * base_counts[:, 1:3].sum() // total_acgt
+    else:
+        gc_content = 0
+
+    sections.append((
+        "Basic Statistics", "pass", ["Measure", "Value"],
+        [["Filename", os.path.basename(filename)],
+         ["File type", "Conventional base calls"],
+         ["Encoding", encoding],
+         ["Total Sequences", nreads],
+         ["Sequences flagged as poor quality", 0],
+         ["Sequence length", length_range],
+         ["%GC", gc_content]]))
+
+    maxlen = base_counts.shape[0]
+    starts = getGroupStarts(maxlen, stats.nogroup)
+    labels = getGroupLabels(starts, maxlen)
+
+    # per base quality, grouped positions
+    if maxlen > 0:
+        counts = numpy.add.reduceat(stats.quality_counts, starts, axis=0)
+    else:
+        counts = numpy.zeros((0, 128), dtype=numpy.int64)
+    totals = counts.sum(axis=1).astype(numpy.float64)
+    means = (counts * numpy.arange(128)).sum(axis=1) / totals - offset
+    p10, lower, median, upper, p90 = [
+        x - offset for x in getPercentiles(
+            counts, (0.1, 0.25, 0.5, 0.75, 0.9))]
+    status = "pass"
+    if len(labels):
+        status = max(getStatus(lower.min(), 10, 5, False),
+                     getStatus(median.min(), 25, 20, False),
+                     key=("pass", "warn", "fail").index)
+    sections.append((
+        "Per base sequence quality", status,
+        ["Base", "Mean", "Median", "Lower Quartile", "Upper Quartile",
+         "10th Percentile", "90th Percentile"],
+        zip(labels, means, median, lower, upper, p10, p90)))
+
+    # per sequence quality
+    scores = numpy.nonzero(stats.mean_quality_counts)[0]
+    if len(scores):
+        mode = stats.mean_quality_counts.argmax() - offset
+    else:
+        mode = 0
+    sections.append((
+        "Per sequence quality scores",
+        getStatus(mode, 27, 20, False),
+        ["Quality", "Count"],
+        [(x - offset, stats.mean_quality_counts[x]) for x in scores]))
+
+    # per base sequence content, percentages of A, C, G and T
+    if maxlen > 0:
+        counts = numpy.add.reduceat(base_counts, starts, axis=0)
+    else:
+        counts = numpy.zeros((0, 5), dtype=numpy.int64)
+    acgt = counts[:, :4].sum(axis=1).astype(numpy.float64)
+    acgt[acgt == 0] = 1
+    percent = 100.0 * counts[:, :4] / acgt[:, None]
+    a, c, g, t = percent.T
+    status = "pass"
+    if len(labels):
+        status = getStatus(
+            max(numpy.abs(a - t).max(), numpy.abs(g - c).max()), 10, 20)
+    sections.append((
+        "Per base sequence content", status,
+        ["Base", "G", "A", "T", "C"],
+        zip(labels, g, a, t, c)))
+
+    # GC content compared to normal distribution
+    gc_counts = stats.gc_counts
+    total = gc_counts.sum()
+    status = "pass"
+    if total > 0:
+        x = numpy.arange(101)
+        mean = (x * gc_counts).sum() / float(total)
+        sd = numpy.sqrt(((x - mean) ** 2 * gc_counts).sum() / float(total))
+        if sd > 0:
+            expected = scipy.stats.norm.pdf(x, mean, sd)
+            expected *= total / expected.sum()
+            deviation = 100.0 * numpy.abs(gc_counts - expected).sum() / total
+            status = getStatus(deviation, 15, 30)
+    sections.append((
+        "Per sequence GC content", status,
+        ["GC Content", "Count"],
+        zip(range(101), gc_counts)))
+
+    # N content
+    totals = counts.sum(axis=1).astype(numpy.float64)
+    totals[totals == 0] = 1
+    n_percent = 100.0 * counts[:, 4] / totals
+    status = "pass"
+    if len(labels):
+        status = getStatus(n_percent.max(), 5, 20)
+    sections.append((
+        "Per base N content", status,
+        ["Base", "N-Count"],
+        zip(labels, n_percent)))
+
+    # length distribution
+    if len(lengths) > 0 and lengths[0] == 0:
+        status = "fail"
+    elif len(lengths) > 1:
+        status = "warn"
+    else:
+        status = "pass"
+    sections.append((
+        "Sequence Length Distribution", status,
+        ["Length", "Count"],
+        [(x, stats.length_counts[x]) for x in lengths]))
+
+    # duplication levels
+    sequence_counts = tracker.getDuplicationCounts()
+    ndistinct = len(sequence_counts)
+    ntracked = sequence_counts.sum()
+    levels = numpy.searchsorted(DUPLICATION_BINS, sequence_counts)
+    distinct_per_level = numpy.bincount(
+        levels, minlength=len(DUPLICATION_LABELS))
+    reads_per_level = numpy.bincount(
+        levels, weights=sequence_counts,
+        minlength=len(DUPLICATION_LABELS))
+    if ntracked > 0:
+        deduplicated = 100.0 * ndistinct / ntracked
+        distinct_percent = 100.0 * distinct_per_level / ndistinct
+        reads_percent = 100.0 * reads_per_level / ntracked
+    else:
+        deduplicated = 100.0
+        distinct_percent = reads_percent = numpy.zeros(
+            len(DUPLICATION_LABELS))
+    sections.append((
+        "Sequence Duplication Levels",
+        getStatus(deduplicated, 80, 50, False),
+        ["Duplication Level", "Percentage of deduplicated",
+         "Percentage of total"],
+        zip(DUPLICATION_LABELS, distinct_percent, reads_percent),
+        ("Total Deduplicated Percentage", deduplicated)))
+
+    # overrepresented sequences
+    overrepresented = sorted(
+        [(count, sequence) for sequence, count in tracker.counts.items()
+         if count > nreads * 0.001], reverse=True)
+    rows = []
+    max_percent = 0
+    for count, sequence in overrepresented:
+        percent = 100.0 * count / nreads
+        max_percent = max(max_percent, percent)
+        if contaminants:
+            source = findContaminant(sequence, contaminants)
+        else:
+            source = "No Hit"
+        rows.append((sequence, count, percent, source))
+    header = None
+    if rows:
+        header = ["Sequence", "Count", "Percentage", "Possible Source"]
+    sections.append((
+        "Overrepresented sequences", getStatus(max_percent, 0.1, 1),
+        header, rows))
+
+    # kmer content
+    sections.append(buildKmerSection(stats))
+
+    return sections
+
+
+def buildKmerSection(stats, max_kmers=20):
+    '''build section with kmers enriched at some positions.
+
+    The expected count of a kmer at a position is derived from its
+    frequency across all positions. Enrichment is tested with a
+    binomial test, corrected for the number of kmers tested.
+    '''
+    k = stats.kmer_size
+    counts = stats.kmer_counts
+    header = ["Sequence", "Count", "PValue", "Obs/Exp Max",
+              "Max Obs/Exp Position"]
+
+    total = counts.sum()
+    if total == 0:
+        return ("Kmer Content", "pass", header, [])
+
+    kmer_totals = counts.sum(axis=0)
+    position_totals = counts.sum(axis=1)
+    frequency = kmer_totals / float(total)
+    expected = position_totals[:, None] * frequency[None, :]
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratio = numpy.where(expected > 0, counts / expected, 0)
+
+    # test only kmers that are at least 5-fold enriched somewhere
+    candidates = numpy.nonzero(ratio.max(axis=0) >= 5)[0]
+    rows = []
+    min_pvalue = 1.0
+    for kmer in candidates:
+        pvalues = scipy.stats.binom.sf(
+            counts[:, kmer] - 1, position_totals, frequency[kmer])
+        pvalues = numpy.minimum(pvalues * 4 ** k, 1.0)
+        best = ratio[:, kmer].argmax()
+        if pvalues[best] >= 0.01:
+            continue
+        min_pvalue = min(min_pvalue, pvalues[best])
+        rows.append((kmer, kmer_totals[kmer], pvalues[best],
+                     ratio[best, kmer], best))
+
+    rows.sort(key=lambda x: (x[2], -x[3]))
+    rows = rows[:max_kmers]
+
+    # groups of kmer start positions
+    npositions = stats.base_counts.shape[0] - k + 1
+    labels = getGroupLabels(getGroupStarts(npositions, stats.nogroup),
+                            npositions)
+
+    def decode(kmer):
+        bases = []
+        for x in range(k):
+            bases.append("ACGT"[kmer % 4])
+            kmer //= 4
+        return "".join(reversed(bases))
+
+    rows = [(decode(kmer), count, pvalue, obs_exp, labels[position])
+            for kmer, count, pvalue, obs_exp, position in rows]
+
+    if not rows:
+        status = "pass"
+    else:
+        status = getStatus(-numpy.log10(max(min_pvalue, 1e-300)), 2, 5)
+
+    return ("Kmer Content", status, header, rows)
+
+
+def getOutputName(filename):
+    '''return FastQC output name for `filename`.'''
+    name = os.path.basename(filename)
+    for suffix in (".gz", ".bz2"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    for suffix in (".fastq", ".fq", ".txt"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name + "_fastqc"
+
+
+def writeSections(outdir, sections, filename):
+    '''write `sections` in FastQC format to `outdir`.'''
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    with IOTools.openFile(os.path.join(outdir, "fastqc_data.txt"),
+                          "w") as outf:
+        outf.write("##FastQC\tcgat_fastq_stats\n")
+        for section in sections:
+            name, status, header, rows = section[:4]
+            outf.write(">>%s\t%s\n" % (name, status))
+            for extra in section[4:]:
+                outf.write("#%s\n" % "\t".join(map(formatValue, extra)))
+            if header:
+                outf.write("#%s\n" % "\t".join(header))
+            for row in rows:
+                outf.write("%s\n" % "\t".join(map(formatValue, row)))
+            outf.write(">>END_MODULE\n")
+
+    with IOTools.openFile(os.path.join(outdir, "summary.txt"), "w") as outf:
+        for section in sections:
+            outf.write("%s\t%s\t%s\n" % (
+                section[1].upper(), section[0], os.path.basename(filename)))
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "-o", "--outdir", dest="outdir", type="string",
+        help="output directory [%default].")
+
+    parser.add_option(
+        "-t", "--threads", dest="threads", type="int",
+        help="number of worker processes [%default].")
+
+    parser.add_option(
+        "--chunk-size", dest="chunk_size", type="int",
+        help="number of reads per chunk [%default].")
+
+    parser.add_option(
+        "-k", "--kmer-size", dest="kmer_size", type="int",
+        help="size of kmers [%default].")
+
+    parser.add_option(
+        "--nogroup", dest="nogroup", action="store_true",
+        help="do not group positions [%default].")
+
+    parser.add_option(
+        "-a", "--contaminants", dest="contaminants", type="string",
+        help="file with contaminant sequences in FastQC format "
+        "[%default].")
+
+    parser.set_defaults(
+        outdir=".",
+        threads=1,
+        chunk_size=100000,
+        kmer_size=7,
+        nogroup=False,
+        contaminants=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if len(args) == 0:
+        raise ValueError("please supply one or more fastq files")
+
+    if options.contaminants:
+        contaminants = readContaminants(options.contaminants)
+    else:
+        contaminants = None
+
+    for filename in args:
+        E.info("processing %s" % filename)
+        stats, tracker = collectStatistics(
+            filename,
+            chunk_size=options.chunk_size,
+            threads=options.threads,
+            kmer_size=options.kmer_size,
+            nogroup=options.nogroup)
+
+        sections = buildSections(stats, tracker, filename, contaminants)
+        outdir = os.path.join(options.outdir, getOutputName(filename))
+        writeSections(outdir, sections, filename)
+
+        E.info("%s: %i reads, output in %s" %
+               (filename, stats.nreads, outdir))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
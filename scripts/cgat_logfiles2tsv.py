@@ -41,6 +41,16 @@ time, child process user time and child process system time.
 
 The last line contains the sum total.
 
+In ``file`` mode, logfiles are scanned in parallel (see option
+``--threads``). Only the ``# job finished`` lines are parsed, the
+remainder of each file is skipped over in large blocks. For very
+large logfiles, the option ``--tail-bytes`` restricts scanning to
+the end of each file where the footer of the last job is located.
+
+Summaries can be cached between runs with the option
+``--cache-file``. Logfiles whose size and modification time have not
+changed since the last run are not read again.
+
 Type::
 
    python cgat_logfiles2tsv.py --help
@@ -53,12 +63,130 @@ Command line options
 '''
 import sys
 import re
+import os
 import gzip
 import glob
+import fnmatch
+import multiprocessing
 
 import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
 import CGAT.Logfile as Logfile
 
+# tag marking the end of a job in a logfile
+FINISHED_TAG = "# job finished"
+
+# size of blocks to read
+BLOCK_SIZE = 1024 * 1024
+
+# fields in a per-file summary
+SUMMARY_FIELDS = ("mNChunks", "mWall", "mUser", "mSys",
+                  "mChildUser", "mChildSys")
+
+
+def scanLogfile(args):
+    '''collect summary of ``# job finished`` lines in a logfile.
+
+    Only lines containing the tag are parsed. If `tail_bytes` is
+    positive, only the last `tail_bytes` bytes of an uncompressed
+    file are examined.
+
+    Returns a tuple of (filename, size, mtime, summary), where summary
+    is a tuple of values in the order of :data:`SUMMARY_FIELDS`.
+    '''
+    filename, tail_bytes = args
+
+    st = os.stat(filename)
+    data = Logfile.LogFileData()
+
+    if filename.endswith(".gz"):
+        infile = gzip.open(filename, "r")
+    else:
+        infile = open(filename, "r")
+        if tail_bytes > 0 and st.st_size > tail_bytes:
+            infile.seek(st.st_size - tail_bytes)
+            # skip incomplete first line
+            infile.readline()
+
+    remainder = ""
+    while True:
+        block = infile.read(BLOCK_SIZE)
+        if not block:
+            break
+        block = remainder + block
+        # keep incomplete last line for next block
+        last_newline = block.rfind("\n")
+        if last_newline < 0:
+            remainder = block
+            continue
+        remainder = block[last_newline + 1:]
+        start = block.find(FINISHED_TAG, 0, last_newline)
+        while start >= 0:
+            end = block.find("\n", start)
+            # only consider tag at start of line
+            if start == 0 or block[start - 1] == "\n":
+                data.add(block[start:end])
+            start = block.find(FINISHED_TAG, end, last_newline)
+
+    if remainder.startswith(FINISHED_TAG):
+        data.add(remainder)
+
+    infile.close()
+
+    return filename, st.st_size, st.st_mtime, \
+        tuple([getattr(data, x) for x in SUMMARY_FIELDS])
+
+
+def summary2data(summary):
+    '''build a :class:`Logfile.LogFileData` object from a summary.'''
+    data = Logfile.LogFileData()
+    for field, value in zip(SUMMARY_FIELDS, summary):
+        setattr(data, field, value)
+    return data
+
+
+def readCache(filename):
+    '''read per-file summaries from cache.
+
+    Returns a dictionary mapping filenames to tuples of
+    (size, mtime, summary).
+    '''
+    cache = {}
+    if filename is None or not os.path.exists(filename):
+        return cache
+
+    with IOTools.openFile(filename) as inf:
+        for line in inf:
+            if line.startswith("#") or line.startswith("filename\t"):
+                continue
+            fields = line[:-1].split("\t")
+            fn, size, mtime = fields[0], int(fields[1]), float(fields[2])
+            summary = (int(fields[3]), int(fields[4])) + \
+                tuple(map(float, fields[5:]))
+            cache[fn] = (size, mtime, summary)
+    return cache
+
+
+def writeCache(filename, cache):
+    '''write per-file summaries to cache.'''
+    tmpfile = filename + ".tmp"
+    with IOTools.openFile(tmpfile, "w") as outf:
+        outf.write("filename\tsize\tmtime\t%s\n" %
+                   "\t".join(SUMMARY_FIELDS))
+        for fn, (size, mtime, summary) in sorted(cache.items()):
+            outf.write("%s\t%i\t%r\t%s\n" % (
+                fn, size, mtime, "\t".join(map(repr, summary))))
+    os.rename(tmpfile, filename)
+
+
+def collectFiles(pattern, root="."):
+    '''recursively collect files from `root` matching `pattern`.'''
+    filenames = []
+    for dirpath, dirnames, files in os.walk(root):
+        for fn in fnmatch.filter(files, pattern):
+            filenames.append(os.path.normpath(os.path.join(dirpath, fn)))
+    return filenames
+
 
 def main(argv=None):
     """script main.
@@ -90,17 +218,38 @@ def main(argv=None):
         help="recursively look for logfiles from current directory "
         "[%default].")
 
+    parser.add_option(
+        "-p", "--threads", dest="threads", type="int",
+        help="number of processes to use for scanning logfiles "
+        "in file mode [%default].")
+
+    parser.add_option(
+        "--tail-bytes", dest="tail_bytes", type="int",
+        help="only examine the last number of bytes of each uncompressed "
+        "logfile. If 0, examine the whole file [%default].")
+
+    parser.add_option(
+        "--cache-file", dest="cache_file", type="string",
+        help="filename to cache per-file summaries in. Logfiles "
+        "that have not changed since the last run are not read "
+        "[%default].")
+
     parser.set_defaults(
         truncate_sites_list=0,
         glob_pattern="*.log",
         mode="file",
         recursive=False,
+        threads=1,
+        tail_bytes=0,
+        cache_file=None,
     )
 
     (options, args) = E.Start(parser)
 
     if args:
         filenames = args
+    elif options.recursive:
+        filenames = collectFiles(options.glob_pattern)
     elif options.glob_pattern:
         filenames = glob.glob(options.glob_pattern)
 
@@ -112,20 +261,50 @@ def main(argv=None):
 
         options.stdout.write("file\t%s\n" % totals.getHeader())
 
+        cache = readCache(options.cache_file)
+
+        summaries, todo = {}, []
         for filename in filenames:
             if filename == "-":
-                infile = sys.stdin
-            elif filename[-3:] == ".gz":
-                infile = gzip.open(filename, "r")
-            else:
-                infile = open(filename, "r")
+                subtotals = Logfile.LogFileData()
+                for line in sys.stdin:
+                    subtotals.add(line)
+                summaries[filename] = tuple(
+                    [getattr(subtotals, x) for x in SUMMARY_FIELDS])
+                continue
+
+            if filename in cache:
+                size, mtime, summary = cache[filename]
+                st = os.stat(filename)
+                if st.st_size == size and st.st_mtime == mtime:
+                    summaries[filename] = summary
+                    continue
+            todo.append((filename, options.tail_bytes))
 
-            subtotals = Logfile.LogFileData()
-            for line in infile:
-                subtotals.add(line)
+        E.info("scanning %i files, %i summaries taken from cache" %
+               (len(todo), len(summaries)))
+
+        if options.threads > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(options.threads)
+            results = pool.imap_unordered(scanLogfile, todo,
+                                          chunksize=100)
+        else:
+            pool = None
+            results = map(scanLogfile, todo)
+
+        for filename, size, mtime, summary in results:
+            summaries[filename] = summary
+            cache[filename] = (size, mtime, summary)
 
-            infile.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+        if options.cache_file:
+            writeCache(options.cache_file, cache)
+
+        for filename in filenames:
+            subtotals = summary2data(summaries[filename])
             options.stdout.write("%s\t%s\n" % (filename, str(subtotals)))
             totals += subtotals
 
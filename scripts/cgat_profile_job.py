@@ -0,0 +1,228 @@
+'''cgat_profile_job.py - sample resource usage of a process tree
+===============================================================
+
+:Author: Andreas Heger
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+This script periodically samples the resource usage of a process and
+all its descendants by reading the :file:`/proc` file system. It runs
+until the process has finished.
+
+The script is used by :mod:`Pipeline` to record the resource usage of
+jobs if the parameter ``job_profile_interval`` is set. As the
+descendants of a job are recorded individually, the output can be
+used to find out which command within a pipe of commands uses most
+memory or CPU time.
+
+Usage
+-----
+
+To sample the process 12345 every 5 seconds, type::
+
+   python cgat_profile_job.py --pid=12345 --sampling-interval=5
+
+The output is a tab-separated table with one row per process and
+sample:
+
++---------+--------------------------------------------+
+|*Column* |*Content*                                   |
++---------+--------------------------------------------+
+|time     |seconds since start of sampling             |
++---------+--------------------------------------------+
+|pid      |process id                                  |
++---------+--------------------------------------------+
+|ppid     |process id of parent                        |
++---------+--------------------------------------------+
+|command  |name of executable                          |
++---------+--------------------------------------------+
+|threads  |number of threads                           |
++---------+--------------------------------------------+
+|rss      |resident set size in kB                     |
++---------+--------------------------------------------+
+|utime    |user CPU time in seconds                    |
++---------+--------------------------------------------+
+|stime    |system CPU time in seconds                  |
++---------+--------------------------------------------+
+|rchar    |bytes read (including pipes)                |
++---------+--------------------------------------------+
+|wchar    |bytes written (including pipes)             |
++---------+--------------------------------------------+
+
+Each sample is followed by a row with the command ``total``
+summarizing the whole process tree.
+
+Type::
+
+   python cgat_profile_job.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import time
+
+import CGAT.Experiment as E
+
+# clock ticks per second for CPU times in /proc/<pid>/stat
+CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+
+# page size in kB for resident set size in /proc/<pid>/stat
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") / 1024
+
+HEADER = ("time", "pid", "ppid", "command", "threads",
+          "rss", "utime", "stime", "rchar", "wchar")
+
+
+def readStat(pid):
+    '''read process information from /proc/<pid>/stat.
+
+    Returns a tuple of (ppid, command, threads, rss, utime, stime) or
+    None if the process does not exist any more.
+    '''
+    try:
+        with open("/proc/%i/stat" % pid) as inf:
+            data = inf.read()
+    except IOError:
+        return None
+
+    # command can contain spaces and brackets
+    left, right = data.index("("), data.rindex(")")
+    command = data[left + 1:right]
+    fields = data[right + 2:].split()
+    # fields start at column 3 (state) of stat
+    ppid = int(fields[1])
+    utime = int(fields[11]) / CLOCK_TICKS
+    stime = int(fields[12]) / CLOCK_TICKS
+    threads = int(fields[17])
+    rss = int(fields[21]) * PAGE_SIZE
+    return ppid, command, threads, rss, utime, stime
+
+
+def readIO(pid):
+    '''read number of bytes read and written from /proc/<pid>/io.
+
+    Returns a tuple of (rchar, wchar). Values are 0 if not available.
+    '''
+    rchar, wchar = 0, 0
+    try:
+        with open("/proc/%i/io" % pid) as inf:
+            for line in inf:
+                key, value = line.split(":")
+                if key == "rchar":
+                    rchar = int(value)
+                elif key == "wchar":
+                    wchar = int(value)
+    except (IOError, ValueError):
+        pass
+    return rchar, wchar
+
+
+def getProcessTree(root):
+    '''return list of process ids of `root` and all its descendants.'''
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        stat = readStat(pid)
+        if stat is None:
+            continue
+        children.setdefault(stat[0], []).append(pid)
+
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+def sampleProcessTree(root, exclude=()):
+    '''sample resource usage of all processes in tree below `root`.
+
+    Returns a list of tuples with sampled values for each process.
+    '''
+    samples = []
+    for pid in getProcessTree(root):
+        if pid in exclude:
+            continue
+        stat = readStat(pid)
+        if stat is None:
+            continue
+        ppid, command, threads, rss, utime, stime = stat
+        rchar, wchar = readIO(pid)
+        samples.append((pid, ppid, command, threads, rss,
+                        utime, stime, rchar, wchar))
+    return samples
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option(
+        "-p", "--pid", dest="pid", type="int",
+        help="process id of process to sample [%default].")
+
+    parser.add_option(
+        "-i", "--sampling-interval", dest="sampling_interval", type="float",
+        help="interval between samples in seconds [%default].")
+
+    parser.set_defaults(
+        pid=None,
+        sampling_interval=10.0,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.pid is None:
+        raise ValueError("please specify a process id with --pid")
+
+    outf = options.stdout
+    outf.write("\t".join(HEADER) + "\n")
+
+    exclude = set((os.getpid(),))
+    start = time.time()
+    nsamples = 0
+    while os.path.exists("/proc/%i" % options.pid):
+        elapsed = "%.1f" % (time.time() - start)
+        samples = sampleProcessTree(options.pid, exclude=exclude)
+        if not samples:
+            break
+
+        for sample in samples:
+            outf.write("%s\t%i\t%i\t%s\t%i\t%i\t%.2f\t%.2f\t%i\t%i\n" %
+                       ((elapsed,) + sample))
+
+        totals = [sum(x) for x in zip(*samples)[3:]]
+        outf.write("%s\t%i\t%i\ttotal\t%i\t%i\t%.2f\t%.2f\t%i\t%i\n" %
+                   tuple([elapsed, options.pid, 0] + totals))
+        # make sure data is available if job is killed
+        outf.flush()
+        nsamples += 1
+        time.sleep(options.sampling_interval)
+
+    E.info("collected %i samples" % nsamples)
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))